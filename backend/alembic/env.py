@@ -9,13 +9,13 @@ import os
 import sys
 from pathlib import Path
 
-# Add the parent directory to sys.path
-current_path = Path(__file__).parent.parent
-sys.path.append(str(current_path))
+# Корень репозитория в sys.path: backend импортируется как пакет
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
 
 # Import your models
-import models
-from database import Base
+from backend import models
+from backend.database import Base, SQLALCHEMY_DATABASE_URL
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -23,8 +23,11 @@ config = context.config
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
-if config.config_file_name is not None:
-    fileConfig(config.config_file_name)
+if config.config_file_name is not None and not config.attributes.get("connection"):
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+# База та же, что у приложения (backend.database), а не из alembic.ini
+config.set_main_option("sqlalchemy.url", SQLALCHEMY_DATABASE_URL)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
@@ -67,6 +70,20 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
+    # backend.migrations передаёт своё соединение (на нём же держится блокировка миграций)
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        # Каждая ревизия — своя транзакция: прерванный upgrade продолжается со следующей ревизии
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=True,
+            transaction_per_migration=True,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
@@ -75,7 +92,10 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=True,
+            transaction_per_migration=True,
         )
 
         with context.begin_transaction():
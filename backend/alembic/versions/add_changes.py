@@ -0,0 +1,46 @@
+"""add changes (журнал для /sync/)
+
+Revision ID: add_changes
+Revises: add_refresh_sessions
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from backend.migrations import has_index, has_table
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_changes'
+down_revision = 'add_refresh_sessions'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not has_table('changes'):
+        op.create_table('changes',
+            sa.Column('seq', sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column('table_name', sa.String(), nullable=False),
+            sa.Column('row_id', sa.Integer(), nullable=False),
+            sa.Column('op', sa.String(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=True),
+            sa.Column('other_user_id', sa.Integer(), nullable=True),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+            sa.PrimaryKeyConstraint('seq'),
+            sqlite_autoincrement=True
+        )
+    if not has_index('changes', 'ix_changes_table_row'):
+        op.create_index('ix_changes_table_row', 'changes', ['table_name', 'row_id'], unique=True)
+    for column in ('user_id', 'other_user_id'):
+        name = op.f(f'ix_changes_{column}')
+        if not has_index('changes', name):
+            op.create_index(name, 'changes', [column], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_changes_other_user_id'), table_name='changes')
+    op.drop_index(op.f('ix_changes_user_id'), table_name='changes')
+    op.drop_index('ix_changes_table_row', table_name='changes')
+    op.drop_table('changes')
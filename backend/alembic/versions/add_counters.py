@@ -0,0 +1,37 @@
+"""add counters and users.completed_deals
+
+Revision ID: add_counters
+Revises: update_schema
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from backend.migrations import has_column, has_table
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_counters'
+down_revision = 'update_schema'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not has_table('counters'):
+        op.create_table('counters',
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('shard', sa.Integer(), nullable=False),
+            sa.Column('value', sa.Float(), nullable=False),
+            sa.PrimaryKeyConstraint('name', 'shard')
+        )
+    if not has_column('users', 'completed_deals'):
+        with op.batch_alter_table('users') as batch_op:
+            batch_op.add_column(sa.Column('completed_deals', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('completed_deals')
+    op.drop_table('counters')
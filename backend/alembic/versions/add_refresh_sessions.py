@@ -0,0 +1,44 @@
+"""add refresh_sessions
+
+Revision ID: add_refresh_sessions
+Revises: add_counters
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from backend.migrations import has_index, has_table
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_refresh_sessions'
+down_revision = 'add_counters'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not has_table('refresh_sessions'):
+        op.create_table('refresh_sessions',
+            sa.Column('jti', sa.String(), nullable=False),
+            sa.Column('family_id', sa.String(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+            sa.Column('expires_at', sa.DateTime(), nullable=False),
+            sa.Column('used_at', sa.DateTime(), nullable=True),
+            sa.Column('revoked_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+            sa.PrimaryKeyConstraint('jti')
+        )
+    for column in ('family_id', 'user_id', 'revoked_at'):
+        name = op.f(f'ix_refresh_sessions_{column}')
+        if not has_index('refresh_sessions', name):
+            op.create_index(name, 'refresh_sessions', [column], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_refresh_sessions_revoked_at'), table_name='refresh_sessions')
+    op.drop_index(op.f('ix_refresh_sessions_user_id'), table_name='refresh_sessions')
+    op.drop_index(op.f('ix_refresh_sessions_family_id'), table_name='refresh_sessions')
+    op.drop_table('refresh_sessions')
@@ -0,0 +1,63 @@
+"""backfill counters и users.completed_deals
+
+Раньше счётчики пересчитывались при старте воркера (полные COUNT и UPDATE всех users под
+блокировкой миграций). Теперь — один раз здесь: агрегаты — одним INSERT ... SELECT,
+если таблица counters пуста, completed_deals — порциями (run_in_batches; прерванная
+ревизия продолжает с ещё не заполненных пользователей).
+
+Revision ID: backfill_counters
+Revises: widen_telegram_id
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from backend.migrations import run_in_batches
+
+
+# revision identifiers, used by Alembic.
+revision = 'backfill_counters'
+down_revision = 'widen_telegram_id'
+branch_labels = None
+depends_on = None
+
+# Имена счётчиков — как в backend.counters (users, hours_exchanged, listings:<status>:<type>)
+FILL_COUNTERS = """
+    INSERT INTO counters (name, shard, value)
+    SELECT 'users', 0, COUNT(*) FROM users
+    UNION ALL
+    SELECT 'hours_exchanged', 0, COALESCE(SUM(hours), 0) FROM listings WHERE status = 'completed'
+    UNION ALL
+    SELECT 'listings:' || COALESCE(status, 'active') || ':' || listing_type, 0, COUNT(*)
+    FROM listings WHERE listing_type IS NOT NULL
+    GROUP BY COALESCE(status, 'active'), listing_type
+"""
+# Ещё не заполнены: completed_deals = 0 у участника хотя бы одной завершённой сделки
+PENDING_USERS = """
+    SELECT id FROM users
+    WHERE completed_deals = 0 AND id IN (
+        SELECT user_id FROM listings WHERE status = 'completed'
+        UNION
+        SELECT worker_id FROM listings WHERE status = 'completed' AND worker_id IS NOT NULL
+    )
+"""
+DEALS_PENDING = f"SELECT COUNT(*) FROM ({PENDING_USERS}) AS pending"
+DEALS_BATCH = f"""
+    UPDATE users SET completed_deals = (
+        SELECT COUNT(*) FROM listings
+        WHERE listings.status = 'completed' AND (listings.user_id = users.id OR listings.worker_id = users.id)
+    )
+    WHERE id IN (SELECT id FROM ({PENDING_USERS} ORDER BY id LIMIT :limit) AS batch)
+"""
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.execute(sa.text("SELECT 1 FROM counters LIMIT 1")).first() is None:
+        op.execute(FILL_COUNTERS)
+    run_in_batches('users.completed_deals', DEALS_PENDING, DEALS_BATCH)
+
+
+def downgrade():
+    pass
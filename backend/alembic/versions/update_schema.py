@@ -1,5 +1,9 @@
 """update schema
 
+Базовая схема. Таблицы и колонки создаются, только если их нет: так же до head доводятся базы,
+созданные через create_all или старыми скриптами (update_schema.py — listings.prepayment_transaction_id,
+update_transaction_schema.py — transactions.transaction_type, update_telegram_id.py — см. widen_telegram_id).
+
 Revision ID: update_schema
 Revises: 
 Create Date: 2024-02-14 12:00:00.000000
@@ -9,6 +13,8 @@ from alembic import op
 import sqlalchemy as sa
 from sqlalchemy.sql import func
 
+from backend.migrations import has_column, has_index, has_table
+
 
 # revision identifiers, used by Alembic.
 revision = 'update_schema'
@@ -19,66 +25,81 @@ depends_on = None
 
 def upgrade():
     # Create users table
-    op.create_table('users',
-        sa.Column('id', sa.Integer(), nullable=False),
-        sa.Column('telegram_id', sa.Integer(), nullable=False),
-        sa.Column('username', sa.String(), nullable=False),
-        sa.Column('avatar', sa.String(), nullable=True),
-        sa.Column('balance', sa.Float(), server_default='5.0', nullable=False),
-        sa.Column('earned_hours', sa.Float(), server_default='0.0', nullable=False),
-        sa.Column('spent_hours', sa.Float(), server_default='0.0', nullable=False),
-        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
-        sa.PrimaryKeyConstraint('id')
-    )
-    op.create_index('ix_users_telegram_id', 'users', ['telegram_id'], unique=True)
-    op.create_index('ix_users_username', 'users', ['username'])
+    if not has_table('users'):
+        op.create_table('users',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('telegram_id', sa.Integer(), nullable=False),
+            sa.Column('username', sa.String(), nullable=False),
+            sa.Column('avatar', sa.String(), nullable=True),
+            sa.Column('balance', sa.Float(), server_default='5.0', nullable=False),
+            sa.Column('earned_hours', sa.Float(), server_default='0.0', nullable=False),
+            sa.Column('spent_hours', sa.Float(), server_default='0.0', nullable=False),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if not has_index('users', 'ix_users_telegram_id'):
+        op.create_index('ix_users_telegram_id', 'users', ['telegram_id'], unique=True)
+    if not has_index('users', 'ix_users_username'):
+        op.create_index('ix_users_username', 'users', ['username'])
 
     # Create transactions table
-    op.create_table('transactions',
-        sa.Column('id', sa.Integer(), nullable=False),
-        sa.Column('from_user_id', sa.Integer(), nullable=False),
-        sa.Column('to_user_id', sa.Integer(), nullable=False),
-        sa.Column('hours', sa.Float(), nullable=False),
-        sa.Column('description', sa.String(), nullable=False),
-        sa.Column('transaction_type', sa.String(), server_default='payment', nullable=False),
-        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
-        sa.ForeignKeyConstraint(['from_user_id'], ['users.id'], ),
-        sa.ForeignKeyConstraint(['to_user_id'], ['users.id'], ),
-        sa.PrimaryKeyConstraint('id')
-    )
+    if not has_table('transactions'):
+        op.create_table('transactions',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('from_user_id', sa.Integer(), nullable=False),
+            sa.Column('to_user_id', sa.Integer(), nullable=False),
+            sa.Column('hours', sa.Float(), nullable=False),
+            sa.Column('description', sa.String(), nullable=False),
+            sa.Column('transaction_type', sa.String(), server_default='payment', nullable=False),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+            sa.ForeignKeyConstraint(['from_user_id'], ['users.id'], ),
+            sa.ForeignKeyConstraint(['to_user_id'], ['users.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+    elif not has_column('transactions', 'transaction_type'):
+        # Бывший update_transaction_schema.py
+        with op.batch_alter_table('transactions') as batch_op:
+            batch_op.add_column(sa.Column('transaction_type', sa.String(), server_default='payment'))
 
     # Create listings table
-    op.create_table('listings',
-        sa.Column('id', sa.Integer(), nullable=False),
-        sa.Column('user_id', sa.Integer(), nullable=False),
-        sa.Column('worker_id', sa.Integer(), nullable=True),
-        sa.Column('title', sa.String(), nullable=False),
-        sa.Column('description', sa.String(), nullable=False),
-        sa.Column('hours', sa.Float(), nullable=False),
-        sa.Column('status', sa.String(), server_default='active', nullable=False),
-        sa.Column('listing_type', sa.String(), nullable=False),
-        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
-        sa.Column('prepayment_transaction_id', sa.Integer(), nullable=True),
-        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
-        sa.ForeignKeyConstraint(['worker_id'], ['users.id'], ),
-        sa.ForeignKeyConstraint(['prepayment_transaction_id'], ['transactions.id'], ),
-        sa.PrimaryKeyConstraint('id')
-    )
-    op.create_index('ix_listings_title', 'listings', ['title'])
+    if not has_table('listings'):
+        op.create_table('listings',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('worker_id', sa.Integer(), nullable=True),
+            sa.Column('title', sa.String(), nullable=False),
+            sa.Column('description', sa.String(), nullable=False),
+            sa.Column('hours', sa.Float(), nullable=False),
+            sa.Column('status', sa.String(), server_default='active', nullable=False),
+            sa.Column('listing_type', sa.String(), nullable=False),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+            sa.Column('prepayment_transaction_id', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+            sa.ForeignKeyConstraint(['worker_id'], ['users.id'], ),
+            sa.ForeignKeyConstraint(['prepayment_transaction_id'], ['transactions.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+    elif not has_column('listings', 'prepayment_transaction_id'):
+        # Бывший update_schema.py
+        with op.batch_alter_table('listings') as batch_op:
+            batch_op.add_column(sa.Column('prepayment_transaction_id', sa.Integer(), sa.ForeignKey('transactions.id', name='fk_listings_prepayment_transaction_id'), nullable=True))
+    if not has_index('listings', 'ix_listings_title'):
+        op.create_index('ix_listings_title', 'listings', ['title'])
 
     # Create friends table
-    op.create_table('friends',
-        sa.Column('id', sa.Integer(), nullable=False),
-        sa.Column('user_id', sa.Integer(), nullable=False),
-        sa.Column('friend_id', sa.Integer(), nullable=False),
-        sa.Column('status', sa.String(), server_default='pending', nullable=False),
-        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
-        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
-        sa.ForeignKeyConstraint(['friend_id'], ['users.id'], ),
-        sa.PrimaryKeyConstraint('id')
-    )
-    op.create_index('ix_friends_user_id', 'friends', ['user_id'])
-    op.create_index('ix_friends_friend_id', 'friends', ['friend_id'])
+    if not has_table('friends'):
+        op.create_table('friends',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('friend_id', sa.Integer(), nullable=False),
+            sa.Column('status', sa.String(), server_default='pending', nullable=False),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+            sa.ForeignKeyConstraint(['friend_id'], ['users.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_friends_user_id', 'friends', ['user_id'])
+        op.create_index('ix_friends_friend_id', 'friends', ['friend_id'])
 
 
 def downgrade():
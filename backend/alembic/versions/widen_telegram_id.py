@@ -0,0 +1,90 @@
+"""users.telegram_id -> BIGINT
+
+Telegram выдаёт идентификаторы больше 2^31. В SQLite INTEGER и так 64-битный — ревизия ничего
+не делает (бывший update_telegram_id.py копировал таблицу зря). В PostgreSQL ALTER COLUMN TYPE
+переписал бы таблицу под эксклюзивной блокировкой, поэтому колонка расширяется онлайн:
+новая колонка, перенос значений порциями (run_in_batches; прерванный перенос продолжается
+с оставшихся строк), уникальный индекс CONCURRENTLY и короткая замена колонок в конце.
+NOT NULL новой колонке возвращается после замены через CHECK ... NOT VALID и VALIDATE:
+проверка строк идёт без блокировки записи, а SET NOT NULL использует проверенный CHECK
+вместо повторного прохода по таблице (PostgreSQL 12+).
+
+Revision ID: widen_telegram_id
+Revises: add_changes
+Create Date: 2026-10-19 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from backend.migrations import has_column, has_index, run_in_batches
+
+
+# revision identifiers, used by Alembic.
+revision = 'widen_telegram_id'
+down_revision = 'add_changes'
+branch_labels = None
+depends_on = None
+
+COPY_PENDING = "SELECT count(*) FROM users WHERE telegram_id_big IS NULL AND telegram_id IS NOT NULL"
+COPY_BATCH = """
+    UPDATE users SET telegram_id_big = telegram_id
+    WHERE id IN (
+        SELECT id FROM users
+        WHERE telegram_id_big IS NULL AND telegram_id IS NOT NULL
+        ORDER BY id LIMIT :limit
+    )
+"""
+
+
+NOT_NULL_CHECK = 'ck_users_telegram_id_not_null'
+
+
+def _telegram_id_column():
+    bind = op.get_bind()
+    return next(c for c in sa.inspect(bind).get_columns('users') if c['name'] == 'telegram_id')
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    if not isinstance(_telegram_id_column()['type'], sa.BigInteger):
+        _swap_to_bigint()
+    if _telegram_id_column()['nullable']:
+        _restore_not_null()
+
+
+def _swap_to_bigint():
+    if not has_column('users', 'telegram_id_big'):
+        op.add_column('users', sa.Column('telegram_id_big', sa.BigInteger(), nullable=True))
+    run_in_batches('users.telegram_id -> telegram_id_big', COPY_PENDING, COPY_BATCH)
+    if not has_index('users', 'ix_users_telegram_id_big'):
+        with op.get_context().autocommit_block():
+            op.create_index(
+                'ix_users_telegram_id_big', 'users', ['telegram_id_big'],
+                unique=True, postgresql_concurrently=True
+            )
+
+    # Замена колонок: строки, добавленные во время переноса, и переименование — одной транзакцией
+    op.execute("LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE")
+    op.execute("UPDATE users SET telegram_id_big = telegram_id WHERE telegram_id_big IS NULL AND telegram_id IS NOT NULL")
+    op.drop_index('ix_users_telegram_id', table_name='users')
+    op.drop_column('users', 'telegram_id')
+    op.alter_column('users', 'telegram_id_big', new_column_name='telegram_id')
+    op.execute("ALTER INDEX ix_users_telegram_id_big RENAME TO ix_users_telegram_id")
+
+
+def _restore_not_null():
+    # Вне транзакции замены: её ACCESS EXCLUSIVE отпущена, проверка строк не держит запись
+    with op.get_context().autocommit_block():
+        op.execute(f"ALTER TABLE users DROP CONSTRAINT IF EXISTS {NOT_NULL_CHECK}")
+        op.execute(f"ALTER TABLE users ADD CONSTRAINT {NOT_NULL_CHECK} CHECK (telegram_id IS NOT NULL) NOT VALID")
+        op.execute(f"ALTER TABLE users VALIDATE CONSTRAINT {NOT_NULL_CHECK}")
+        op.execute("ALTER TABLE users ALTER COLUMN telegram_id SET NOT NULL")
+        op.execute(f"ALTER TABLE users DROP CONSTRAINT {NOT_NULL_CHECK}")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.alter_column('users', 'telegram_id', type_=sa.Integer(), existing_type=sa.BigInteger())
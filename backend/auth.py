@@ -4,11 +4,11 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from datetime import datetime, timedelta
 import hmac
 import hashlib
+import os
+import threading
 import time
 import logging
-import sys
-from logging.handlers import RotatingFileHandler
-from typing import Dict, Union
+from typing import Dict, Iterable, Optional, Union
 from .config import (
     JWT_SECRET_KEY,
     JWT_ALGORITHM,
@@ -17,50 +17,28 @@ from .config import (
 )
 import re
 import urllib.parse
+from collections import OrderedDict
+
+from .tracing import traced
 
 # ---------------------------------------------------------------------------
-# logging setup
+# logging: handlers are configured once in logging_setup (category "auth")
 # ---------------------------------------------------------------------------
-# Create logs directory if it doesn't exist
-import os
-os.makedirs('logs', exist_ok=True)
-
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-# Clear existing handlers
-if logger.handlers:
-    logger.handlers = []
-
-# Add console handler
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.DEBUG)
-console_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
-
-# Add file handler
-file_handler = RotatingFileHandler(
-    'logs/auth.log',
-    maxBytes=10*1024*1024,  # 10MB
-    backupCount=5
-)
-file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-
-logger.info("="*80)
-logger.info("Authentication module initialized")
-logger.info(f"BOT_TOKEN: {BOT_TOKEN[:5]}...{BOT_TOKEN[-5:]} (length: {len(BOT_TOKEN)})")
-logger.info("="*80)
 
 security = HTTPBearer()
 
+# Вход по init_data: возраст auth_date и повторное использование одного и того же init_data
+TELEGRAM_AUTH_MAX_AGE = int(os.environ.get("TELEGRAM_AUTH_MAX_AGE", 24 * 60 * 60))
+TELEGRAM_AUTH_CLOCK_SKEW = 60
+TELEGRAM_LOGIN_CACHE_SIZE = int(os.environ.get("TELEGRAM_LOGIN_CACHE_SIZE", 1024))
+TELEGRAM_LOGIN_REUSE_SECONDS = int(os.environ.get("TELEGRAM_LOGIN_REUSE_SECONDS", 60))
+
 # ---------------------------------------------------------------------------
 # Telegram Web‑App hash verification
 # ---------------------------------------------------------------------------
 
+@traced("telegram.verify_hash")
 def verify_telegram_hash(init_data: str, received_hash: str) -> bool:
     """Validate init_data received from Telegram Mini‑app.
     https://core.telegram.org/bots/webapps#validating-data-received-via-the-web-app
@@ -175,13 +153,96 @@ def verify_telegram_hash(init_data: str, received_hash: str) -> bool:
         return False
 
 
+def check_auth_date(data: Dict[str, str]) -> None:
+    """
+    auth_date из init_data (подписан вместе с остальными полями) не старше
+    TELEGRAM_AUTH_MAX_AGE секунд и не из будущего. Иначе 401.
+    """
+    try:
+        auth_date = int(data.get("auth_date", ""))
+    except ValueError:
+        logger.warning("init_data without valid auth_date")
+        raise HTTPException(status_code=401, detail="Missing auth_date")
+    age = time.time() - auth_date
+    if age > TELEGRAM_AUTH_MAX_AGE:
+        logger.warning("Stale init_data: auth_date is %ds old (max %ds)", age, TELEGRAM_AUTH_MAX_AGE)
+        raise HTTPException(status_code=401, detail="init_data expired")
+    if age < -TELEGRAM_AUTH_CLOCK_SKEW:
+        logger.warning("init_data auth_date is %ds in the future", -age)
+        raise HTTPException(status_code=401, detail="Invalid auth_date")
+
+
+class RecentLogins:
+    """
+    Ограниченный LRU недавно принятых init_data: hash -> выданная пара токенов.
+    Повтор того же init_data в пределах TELEGRAM_LOGIN_REUSE_SECONDS получает ту же пару
+    без проверки HMAC, записи в БД и подписи JWT (переподключения Mini App).
+
+    Кэш у каждого воркера свой, а сменить или отозвать семейство может любой другой. Поэтому
+    вызывающий перед выдачей проверяет по БД, что refresh-сессия записи (jti) всё ещё текущая
+    (sessions.is_current); discard_family — лишь быстрый путь для своего воркера.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(init_data: str) -> bytes:
+        return hashlib.sha256(init_data.encode()).digest()
+
+    def get(self, hash_value: str, init_data: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(hash_value)
+            if entry is None:
+                return None
+            if time.monotonic() - entry["issued_at"] > self.ttl:
+                del self._entries[hash_value]
+                return None
+            self._entries.move_to_end(hash_value)
+        # Тот же hash с другими данными — не повтор, а подделка: пусть проверяет verify_telegram_hash
+        if not hmac.compare_digest(entry["digest"], self._digest(init_data)):
+            return None
+        if entry["family_id"] in revoked_sessions:
+            return None
+        return entry
+
+    def put(
+        self, hash_value: str, init_data: str, family_id: str, jti: str, access_token: str, refresh_token: str, user: dict
+    ) -> None:
+        if self.max_size <= 0:
+            return
+        entry = {
+            "digest": self._digest(init_data),
+            "issued_at": time.monotonic(),
+            "family_id": family_id,
+            "jti": jti,
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "user": user,
+        }
+        with self._lock:
+            self._entries[hash_value] = entry
+            self._entries.move_to_end(hash_value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard_family(self, family_id: str) -> None:
+        """Refresh-токен семейства сменился или отозван — старую пару выдавать нельзя."""
+        with self._lock:
+            for hash_value in [key for key, entry in self._entries.items() if entry["family_id"] == family_id]:
+                del self._entries[hash_value]
+
+
 # ---------------------------------------------------------------------------
 # JWT helpers
 # ---------------------------------------------------------------------------
 
-def create_access_token(data: Dict) -> str:
-    """Generate signed JWT access token."""
-    expire = datetime.utcnow() + timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRE_MINUTES)
+def create_access_token(data: Dict, expires_at: Optional[datetime] = None) -> str:
+    """Generate signed JWT; expires after the access-token lifetime unless expires_at is given."""
+    expire = expires_at or datetime.utcnow() + timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode = {**data, "exp": expire}
     token = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
     logger.debug("JWT created for %s (exp %s)", data.get("username"), expire)
@@ -209,24 +270,122 @@ def verify_token(token: str) -> dict:
         raise HTTPException(status_code=401, detail=f"Token verification failed: {str(e)}")
 
 
-def get_current_user(request: Request) -> dict:
+# ---------------------------------------------------------------------------
+# Текущий пользователь: токен проверяется один раз на запрос
+# ---------------------------------------------------------------------------
+
+class RevokedSessions:
     """
-    Проверяет наличие токена доступа в заголовке запроса.
-    Возвращает данные пользователя из токена.
+    Отозванные семейства refresh-сессий (claim sid) — хэши в памяти, без обращения к БД.
+    Наполняется из sessions: сразу при локальном отзыве и периодически из таблицы.
     """
-    token = None
-    
-    # Сначала проверяем в cookie
-    if "access_token" in request.cookies:
-        token = request.cookies.get("access_token")
-    
-    # Если нет в cookie, проверяем в заголовке
+
+    def __init__(self):
+        self._digests: frozenset = frozenset()
+        # Локальные отзывы: хэш -> время; переживают перечитывание, пока оно их не догонит
+        self._local: Dict[bytes, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(family_id: str) -> bytes:
+        return hashlib.blake2b(family_id.encode(), digest_size=8).digest()
+
+    def __contains__(self, family_id: str) -> bool:
+        return self._digest(family_id) in self._digests
+
+    def add(self, family_id: str) -> None:
+        digest = self._digest(family_id)
+        with self._lock:
+            self._local[digest] = time.monotonic()
+            self._digests = self._digests | {digest}
+
+    def replace(self, family_ids: Iterable[str], max_age: float) -> None:
+        loaded = {self._digest(family_id) for family_id in family_ids}
+        with self._lock:
+            cutoff = time.monotonic() - max_age
+            self._local = {digest: added for digest, added in self._local.items() if added > cutoff}
+            self._digests = frozenset(loaded | set(self._local))
+
+
+revoked_sessions = RevokedSessions()
+recent_logins = RecentLogins(TELEGRAM_LOGIN_CACHE_SIZE, TELEGRAM_LOGIN_REUSE_SECONDS)
+
+
+def extract_token(request: Request) -> Optional[str]:
+    """Access-токен из cookie, а если его там нет — из заголовка Authorization: Bearer."""
+    token = request.cookies.get("access_token")
     if not token:
         auth_header = request.headers.get("Authorization")
         if auth_header and auth_header.startswith("Bearer "):
-            token = auth_header.replace("Bearer ", "")
-    
+            token = auth_header[len("Bearer "):]
+    return token or None
+
+
+def authenticate(request: Request) -> Optional[dict]:
+    """
+    Проверяет access-токен запроса (подпись, срок, отзыв сессии — всё в памяти)
+    и запоминает результат в request.state:
+    auth_claims (payload или None), auth_error (HTTPException для ответа) и user_id.
+    Повторные вызовы в том же запросе токен не разбирают.
+    """
+    state = request.state
+    if hasattr(state, "auth_claims"):
+        return state.auth_claims
+
+    claims, error = None, None
+    token = extract_token(request)
+    if token:
+        try:
+            claims = verify_token(token)
+            if claims.get("type") == "refresh":
+                raise HTTPException(status_code=401, detail="Invalid token type")
+            if claims.get("sid") and claims["sid"] in revoked_sessions:
+                raise HTTPException(status_code=401, detail="Session revoked")
+        except HTTPException as exc:
+            claims, error = None, exc
+    else:
+        error = HTTPException(status_code=401, detail="Not authenticated")
+
+    state.auth_claims = claims
+    state.auth_error = error
+    state.user_id = claims.get("sub") if claims else None
+    return claims
+
+
+def get_current_user(request: Request) -> dict:
+    """
+    Зависимость для защищённых маршрутов: payload access-токена или 401.
+    """
+    claims = authenticate(request)
+    if claims is None:
+        raise request.state.auth_error
+    return claims
+
+
+def get_optional_user(request: Request) -> Optional[dict]:
+    """Зависимость для маршрутов, доступных и без входа: payload или None."""
+    return authenticate(request)
+
+
+def verify_refresh_token(request: Request) -> dict:
+    """Payload refresh-токена из cookie; 401, если его нет, он истёк или это не refresh."""
+    token = request.cookies.get("refresh_token")
     if not token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    return verify_token(token)
+        logger.error("No refresh token in cookies")
+        raise HTTPException(status_code=401, detail="No refresh token")
+    try:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        logger.error("Refresh token expired")
+        raise HTTPException(status_code=401, detail="Refresh token expired")
+    except jwt.JWTError as e:
+        logger.error("Invalid refresh token: %s", e)
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+    if payload.get("type") != "refresh":
+        logger.error("Invalid token type in refresh token")
+        raise HTTPException(status_code=401, detail="Invalid token type")
+    if not payload.get("sub"):
+        logger.error("No user ID in refresh token")
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
@@ -0,0 +1,100 @@
+"""
+Замер холодного старта воркера: импорт backend.main и lifespan до готовности принимать запросы.
+
+    python -m backend.bench_startup [--runs 5] [--top 15] [--max-ms 0]
+
+Каждый прогон — свежие процессы: `python -X importtime -c "import backend.main"` для разбивки
+по модулям и отдельный процесс, который после импорта проходит старт lifespan, как uvicorn
+перед первым запросом. Печатаются медианы и самые дорогие модули (собственное и накопленное время).
+--max-ms N — код возврата 1, если медиана «импорт + старт» больше N мс (для CI).
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+RESULT_PREFIX = "BENCH_STARTUP "
+
+_STARTUP_CODE = f"""
+import asyncio, json, time
+started = time.perf_counter()
+from backend.main import app
+imported = time.perf_counter()
+
+async def startup():
+    async with app.router.lifespan_context(app):
+        return time.perf_counter()
+
+ready = asyncio.run(startup())
+print({RESULT_PREFIX!r} + json.dumps({{"import_ms": (imported - started) * 1000, "startup_ms": (ready - imported) * 1000}}))
+"""
+
+
+def _run(args: List[str]) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=ROOT_DIR, capture_output=True, text=True, check=True)
+
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """Строки `import time: self [us] | cumulative | module` -> {module: (self_us, cumulative_us)}."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure_startup() -> dict:
+    output = _run(["-c", _STARTUP_CODE]).stdout
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError("startup probe printed no result")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-ms", type=float, default=0, help="порог для медианы импорт + старт, 0 — без проверки")
+    args = parser.parse_args(argv)
+
+    per_module = defaultdict(lambda: ([], []))
+    startups = []
+    for _ in range(args.runs):
+        modules = parse_importtime(_run(["-X", "importtime", "-c", "import backend.main"]).stderr)
+        for name, (self_us, cumulative_us) in modules.items():
+            per_module[name][0].append(self_us)
+            per_module[name][1].append(cumulative_us)
+        startups.append(measure_startup())
+
+    import_ms = statistics.median(run["import_ms"] for run in startups)
+    startup_ms = statistics.median(run["startup_ms"] for run in startups)
+    print(f"runs: {args.runs}")
+    print(f"import backend.main: {import_ms:8.1f} ms (median)")
+    print(f"lifespan startup:    {startup_ms:8.1f} ms (median)")
+    print(f"ready:               {import_ms + startup_ms:8.1f} ms")
+
+    medians = {
+        name: (statistics.median(self_us), statistics.median(cumulative_us))
+        for name, (self_us, cumulative_us) in per_module.items()
+    }
+    for title, index in (("self", 0), ("cumulative", 1)):
+        print(f"\ntop {args.top} modules by {title} import time:")
+        for name, times in sorted(medians.items(), key=lambda item: item[1][index], reverse=True)[: args.top]:
+            print(f"  {times[index] / 1000:8.1f} ms  {name}")
+
+    if args.max_ms and import_ms + startup_ms > args.max_ms:
+        print(f"\nFAIL: {import_ms + startup_ms:.1f} ms > {args.max_ms:.1f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
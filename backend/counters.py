@@ -0,0 +1,164 @@
+"""
+Инкрементальные счётчики площадки для GET /stats/.
+
+Счётчики меняются в той же транзакции, что и данные: after_flush смотрит на новые
+и изменённые листинги/пользователей и прибавляет дельты к шардированным строкам counters.
+Чтение — сумма по COUNTER_SHARDS строкам на счётчик, без сканирования таблиц.
+
+Начальные значения на существующей базе заполняет миграция backfill_counters; при старте
+воркера — только проверка. Пересчитать заново (если разошлись): python -m backend.counters rebuild.
+"""
+import logging
+import random
+import sys
+from collections import defaultdict
+from typing import Dict
+
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+from .database import SessionLocal
+
+COUNTER_SHARDS = 4
+
+logger = logging.getLogger(__name__)
+
+USERS = "users"
+HOURS_EXCHANGED = "hours_exchanged"
+LISTING_STATUSES = [status.value for status in models.ListingStatus]
+LISTING_TYPES = [listing_type.value for listing_type in models.ListingType]
+
+
+def listing_counter(status: str, listing_type: str) -> str:
+    return f"listings:{status}:{listing_type}"
+
+
+def _upsert_statement(dialect_name: str):
+    dialect = postgresql if dialect_name == "postgresql" else sqlite
+    table = models.Counter.__table__
+    stmt = dialect.insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.name, table.c.shard],
+        set_={"value": table.c.value + stmt.excluded.value},
+    )
+
+
+def apply_deltas(connection, deltas: Dict[str, float]) -> None:
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    shard = random.randrange(COUNTER_SHARDS)
+    connection.execute(
+        _upsert_statement(connection.dialect.name),
+        [{"name": name, "shard": shard, "value": delta} for name, delta in deltas.items()],
+    )
+
+
+def _collect_deltas(session: Session, flush_context) -> None:
+    deltas = defaultdict(float)
+
+    for obj in session.new:
+        if isinstance(obj, models.User):
+            deltas[USERS] += 1
+        elif isinstance(obj, models.Listing):
+            deltas[listing_counter(obj.status or "active", obj.listing_type)] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, models.User):
+            deltas[USERS] -= 1
+        elif isinstance(obj, models.Listing):
+            deltas[listing_counter(obj.status, obj.listing_type)] -= 1
+
+    for obj in session.dirty:
+        if not isinstance(obj, models.Listing):
+            continue
+        history = inspect(obj).attrs.status.history
+        if not history.has_changes():
+            continue
+        old_status = history.deleted[0] if history.deleted else None
+        new_status = obj.status
+        if old_status == new_status:
+            continue
+        if old_status:
+            deltas[listing_counter(old_status, obj.listing_type)] -= 1
+        deltas[listing_counter(new_status, obj.listing_type)] += 1
+        if new_status == "completed":
+            deltas[HOURS_EXCHANGED] += obj.hours or 0
+
+    apply_deltas(session.connection(), deltas)
+
+
+event.listen(SessionLocal, "after_flush", _collect_deltas)
+
+
+def read_counters(db: Session) -> Dict[str, float]:
+    rows = (
+        db.query(models.Counter.name, func.sum(models.Counter.value))
+        .group_by(models.Counter.name)
+        .all()
+    )
+    return {name: value or 0 for name, value in rows}
+
+
+def get_stats(db: Session) -> schemas.Stats:
+    values = read_counters(db)
+    listings = {
+        status: schemas.ListingCounts(
+            **{listing_type: int(values.get(listing_counter(status, listing_type), 0)) for listing_type in LISTING_TYPES}
+        )
+        for status in LISTING_STATUSES
+    }
+    completed = listings["completed"]
+    return schemas.Stats(
+        listings=listings,
+        completed_deals=completed.request + completed.offer,
+        hours_exchanged=round(values.get(HOURS_EXCHANGED, 0.0), 1),
+        users=int(values.get(USERS, 0)),
+    )
+
+
+def rebuild_counters(db: Session) -> None:
+    """
+    Полный пересчёт из таблиц, включая users.completed_deals. Сканирует таблицы целиком —
+    для ручного восстановления, не для старта.
+    """
+    db.query(models.Counter).delete()
+    deltas = {USERS: db.query(func.count(models.User.id)).scalar() or 0}
+    for status, listing_type, count in (
+        db.query(models.Listing.status, models.Listing.listing_type, func.count(models.Listing.id))
+        .group_by(models.Listing.status, models.Listing.listing_type)
+        .all()
+    ):
+        deltas[listing_counter(status, listing_type)] = count
+    deltas[HOURS_EXCHANGED] = (
+        db.query(func.sum(models.Listing.hours)).filter(models.Listing.status == "completed").scalar() or 0
+    )
+    apply_deltas(db.connection(), deltas)
+
+    db.execute(
+        text(
+            "UPDATE users SET completed_deals = ("
+            "SELECT COUNT(*) FROM listings WHERE listings.status = 'completed' "
+            "AND (listings.user_id = users.id OR listings.worker_id = users.id))"
+        )
+    )
+    db.commit()
+
+
+def ensure_counters(db: Session) -> None:
+    """Проверка при старте: два запроса по одной строке, без пересчёта."""
+    if db.query(models.Counter.name).first() is None and db.query(models.User.id).first() is not None:
+        logger.warning("Counters are empty on a non-empty database, /stats/ is off; run python -m backend.counters rebuild")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["rebuild"]:
+        session = SessionLocal()
+        try:
+            rebuild_counters(session)
+        finally:
+            session.close()
+    else:
+        print("usage: python -m backend.counters rebuild")
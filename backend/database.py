@@ -1,12 +1,35 @@
+import os
+from pathlib import Path
+
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from .metrics import DB_POOL_WAIT
+
+# По умолчанию — time_banking.db в корне репозитория, откуда бы ни запускали процесс
+SQLALCHEMY_DATABASE_URL = os.environ.get(
+    "DATABASE_URL", f"sqlite:///{Path(__file__).resolve().parent.parent / 'time_banking.db'}"
+)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, который отдаёт в метрики время ожидания свободного соединения."""
+
+    # Логи пула остаются под sqlalchemy.*, а не уходят в backend.* (debug.log)
+    _sqla_logger_namespace = "sqlalchemy.pool.impl.QueuePool"
+
+    def _do_get(self):
+        with DB_POOL_WAIT.time():
+            return super()._do_get()
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///../time_banking.db"
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else {},
+    poolclass=TimedQueuePool,
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base() 
\ No newline at end of file
+Base = declarative_base()
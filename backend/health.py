@@ -0,0 +1,177 @@
+"""
+Проверки состояния для балансировщика и мониторинга.
+
+* /healthz — процесс жив и event loop отвечает; ни БД, ни диска.
+* /readyz — воркер принимает трафик: старт завершён и остановка не началась (app.state.ready),
+  БД отвечает на SELECT 1 соединением из пула за READINESS_TIMEOUT секунд, схема не отстаёт
+  от миграций кода. Одновременные проверки ждут одну и ту же (в БД ходит не больше одного
+  потока на воркер, даже если она зависла). Схема новее кода — миграции следующего релиза
+  при поэтапном развёртывании — готовности не мешает.
+* /diagnostics — сводка (БД, счётчики, файлы), которую фоновый поток пересчитывает раз
+  в DIAGNOSTICS_REFRESH_SECONDS; запрос отдаёт последний результат с временем расчёта.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import FrozenSet, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from . import counters
+from .config import BOT_TOKEN, JWT_ACCESS_TOKEN_EXPIRE_MINUTES, JWT_ALGORITHM
+from .database import SessionLocal, engine
+from .logging_setup import LOG_DIR
+
+READINESS_TIMEOUT = float(os.environ.get("READINESS_TIMEOUT", 1.0))
+DIAGNOSTICS_REFRESH_SECONDS = float(os.environ.get("DIAGNOSTICS_REFRESH_SECONDS", 30))
+ROOT_DIR = Path(__file__).parent.parent
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------
+# Готовность
+# ---------------------------------------------------------------------------
+@lru_cache(maxsize=1)
+def _known_revisions() -> Tuple[Optional[str], FrozenSet[str]]:
+    """Head и все ревизии кода; alembic импортируется при первой проверке, а не при старте."""
+    from alembic.script import ScriptDirectory
+
+    from .migrations import alembic_config
+
+    script = ScriptDirectory.from_config(alembic_config())
+    return script.get_current_head(), frozenset(revision.revision for revision in script.walk_revisions())
+
+
+def _check_database() -> Optional[str]:
+    """None, если БД готова, иначе причина."""
+    head, known = _known_revisions()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        try:
+            current = connection.execute(text("SELECT version_num FROM alembic_version")).scalar()
+        except DBAPIError:
+            return "database schema is not under migrations"
+    if current != head and (current is None or current in known):
+        return f"database schema {current} is behind {head}"
+    return None
+
+
+_check_in_flight: Optional[asyncio.Future] = None
+
+
+async def check_ready() -> Optional[str]:
+    global _check_in_flight
+    if _check_in_flight is None or _check_in_flight.done():
+        _check_in_flight = asyncio.ensure_future(run_in_threadpool(_check_database))
+    try:
+        return await asyncio.wait_for(asyncio.shield(_check_in_flight), READINESS_TIMEOUT)
+    except asyncio.TimeoutError:
+        return f"database did not answer in {READINESS_TIMEOUT:g}s"
+    except Exception as e:
+        logger.warning("Readiness check failed: %s", e)
+        return f"database error: {type(e).__name__}"
+
+
+# ---------------------------------------------------------------------------
+# Диагностика (кэш, пересчитывается в фоне)
+# ---------------------------------------------------------------------------
+def collect_diagnostics() -> dict:
+    db_connection_ok = False
+    db_error = None
+    user_count = 0
+    db = SessionLocal()
+    try:
+        user_count = counters.get_stats(db).users
+        db_connection_ok = True
+    except Exception as e:
+        db_error = str(e)
+        logger.error(f"Database connection error: {e}")
+    finally:
+        db.close()
+
+    db_file = Path(engine.url.database) if engine.url.get_backend_name() == "sqlite" and engine.url.database else None
+    db_file_exists = db_file is not None and db_file.exists()
+    return {
+        "api_status": "ok",
+        "database": {
+            "connection": db_connection_ok,
+            "error": db_error,
+            "user_count": user_count,
+        },
+        "auth_config": {
+            "jwt_algorithm": JWT_ALGORITHM,
+            "jwt_expiry_minutes": JWT_ACCESS_TOKEN_EXPIRE_MINUTES,
+            "bot_token_configured": bool(BOT_TOKEN),
+        },
+        "filesystem": {
+            "uploads_dir_exists": (ROOT_DIR / "uploads").exists(),
+            "logs_dir_exists": LOG_DIR.exists(),
+            "db_file_exists": db_file_exists,
+            "db_file_size": db_file.stat().st_size if db_file_exists else 0,
+        },
+        "computed_at": datetime.utcnow().isoformat(),
+    }
+
+
+_diagnostics: Optional[dict] = None
+_diagnostics_computed: float = 0.0
+_diagnostics_lock = threading.Lock()
+
+
+def refresh_diagnostics() -> dict:
+    global _diagnostics, _diagnostics_computed
+    with _diagnostics_lock:
+        try:
+            result = collect_diagnostics()
+        except Exception as e:
+            logger.error(f"Diagnostics collection error: {e}")
+            result = {"api_status": "error", "error": str(e), "computed_at": datetime.utcnow().isoformat()}
+        _diagnostics, _diagnostics_computed = result, time.monotonic()
+        return result
+
+
+def get_diagnostics() -> dict:
+    """Последняя сводка; считается на месте, только если фоновый поток её ещё не посчитал."""
+    result = _diagnostics
+    if result is None:
+        result = refresh_diagnostics()
+    return {
+        **result,
+        "age_seconds": round(time.monotonic() - _diagnostics_computed, 1),
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+
+
+def _refresh_diagnostics(stop: threading.Event) -> None:
+    while True:
+        refresh_diagnostics()
+        if stop.wait(DIAGNOSTICS_REFRESH_SECONDS):
+            return
+
+
+_refresher_stop: Optional[threading.Event] = None
+
+
+def start_diagnostics_refresher() -> None:
+    global _refresher_stop
+    if _refresher_stop is not None:
+        return
+    _refresher_stop = threading.Event()
+    threading.Thread(
+        target=_refresh_diagnostics, args=(_refresher_stop,), name="diagnostics-refresher", daemon=True
+    ).start()
+
+
+def stop_diagnostics_refresher() -> None:
+    global _refresher_stop
+    if _refresher_stop is not None:
+        _refresher_stop.set()
+        _refresher_stop = None
@@ -0,0 +1,355 @@
+"""
+Настройка логирования: неблокирующая очередь и маршрутизация по категориям.
+
+Код приложения пишет в логгеры как обычно, но единственный обработчик на корневом
+логгере — QueueHandler: он только кладёт запись в ограниченную очередь. Запись в файлы,
+ротацию и вывод в консоль делает один поток QueueListener. Каждая запись уходит в файл
+своей категории (requests/auth/slow/debug) и, если это ошибка, дополнительно в error.log.
+При переполнении очереди записи отбрасываются и считаются, а не блокируют event loop.
+
+Настройки (переменные окружения):
+  LOG_LEVEL     — уровень (по умолчанию DEBUG в разработке, INFO в продакшене);
+  LOG_FORMAT    — text (как раньше) или json: одна JSON-строка на событие с request_id;
+  LOG_SAMPLING  — доля сохраняемых записей ниже WARNING по логгерам,
+                  например "backend.requests=0.1,backend.auth=0.5";
+  LOG_QUEUE_SIZE — размер очереди;
+  LOG_COMPRESS  — gzip (по умолчанию): ротированные файлы сжимаются в фоне в name.log.N.gz;
+                  none — хранить как есть.
+"""
+import atexit
+import contextvars
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Optional
+
+from .config import IS_DEVELOPMENT
+
+LOG_DIR = Path(os.environ.get("LOG_DIR", Path(__file__).parent.parent / "logs"))
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG" if IS_DEVELOPMENT else "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "")
+LOG_COMPRESS = os.environ.get("LOG_COMPRESS", "gzip").lower()
+COMPRESSED_SUFFIX = ".gz"
+
+# id текущего запроса; выставляется middleware и попадает в каждую запись
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Категория -> префиксы имён логгеров. Всё остальное из backend.* пишется в debug.log,
+# сторонние библиотеки (uvicorn, sqlalchemy, ...) — только в консоль и error.log.
+CATEGORY_LOGGERS = {
+    "requests": ("backend.requests",),
+    "auth": ("backend.auth",),
+    "traces": ("backend.traces",),
+    "slow": ("backend.slow",),
+    "debug": ("backend",),
+}
+# Категории, которые пишутся только в свой файл и всегда как есть (готовые JSON-строки)
+RAW_CATEGORIES = {"traces"}
+
+CONSOLE_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+FILE_FORMATS = {
+    "debug": CONSOLE_FORMAT,
+    "requests": "%(asctime)s - %(message)s",
+    "auth": "%(asctime)s - AUTH - %(levelname)s - %(message)s",
+    "traces": "%(message)s",
+    "slow": "%(asctime)s - %(message)s",
+    "error": "%(asctime)s - %(name)s - %(levelname)s - %(message)s\n%(pathname)s:%(lineno)d\n",
+}
+
+
+def parse_sampling(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in spec.split(","):
+        if "=" not in part:
+            continue
+        name, rate = part.split("=", 1)
+        rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю записей ниже WARNING; предупреждения и ошибки не сэмплируются."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        # Самый длинный префикс выигрывает
+        self.rates = sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        for prefix, rate in self.rates:
+            if record.name == prefix or record.name.startswith(prefix + "."):
+                return rate >= 1.0 or random.random() < rate
+        return True
+
+
+# Стандартные атрибуты LogRecord: всё остальное пришло через extra= и попадает в JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                event[key] = value
+        if record.exc_text:
+            event["exc"] = record.exc_text
+        if record.stack_info:
+            event["stack"] = record.stack_info
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Текстовый формат; сообщения, записанные внутри запроса, начинаются с [request_id]."""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            record.message = f"[{request_id}] {record.message}"
+        return super().formatMessage(record)
+
+
+def category_for(logger_name: str) -> Optional[str]:
+    for category, prefixes in CATEGORY_LOGGERS.items():
+        for prefix in prefixes:
+            if logger_name == prefix or logger_name.startswith(prefix + "."):
+                return category
+    return None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не ждёт места в очереди: лишние записи отбрасываются и считаются."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._unreported = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        В потоке вызывающего только подставляем аргументы в сообщение и фиксируем request_id;
+        форматирование строки (время, JSON) делает поток записи.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self._unreported:
+                self._report_dropped()
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+
+    def _report_dropped(self) -> None:
+        with self._lock:
+            count, self._unreported = self._unreported, 0
+        notice = logging.LogRecord(
+            "backend.logging", logging.WARNING, __file__, 0,
+            "Log queue overflow: dropped %d records", (count,), None,
+        )
+        try:
+            self.queue.put_nowait(self.prepare(notice))
+        except queue.Full:
+            with self._lock:
+                self._unreported += count
+            raise
+
+
+class CategoryRouter(logging.Handler):
+    """Обработчик внутри потока QueueListener: отправляет запись только в нужные файлы."""
+
+    def __init__(self, console: logging.Handler, files: dict, errors: logging.Handler):
+        super().__init__()
+        self.console = console
+        self.files = files
+        self.errors = errors
+
+    def emit(self, record: logging.LogRecord) -> None:
+        category = category_for(record.name)
+        if category in RAW_CATEGORIES:
+            self.files[category].handle(record)
+            return
+        if record.levelno >= self.console.level:
+            self.console.handle(record)
+        target = self.files.get(category)
+        if target is not None and record.levelno >= target.level:
+            target.handle(record)
+        if record.levelno >= logging.ERROR:
+            self.errors.handle(record)
+
+    def close(self) -> None:
+        for handler in (self.console, self.errors, *self.files.values()):
+            handler.close()
+        super().close()
+
+
+def _compress_file(source: str, dest: str) -> None:
+    tmp = dest + ".tmp"
+    with open(source, "rb") as src, gzip.open(tmp, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp, dest)
+    os.remove(source)
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    При ротации файл только переименовывается в name.log.1, а сжатие в name.log.1.gz
+    идёт в отдельном потоке — поток записи логов не ждёт gzip. Пока сжатие не закончено,
+    читатели видят несжатый name.log.1 (см. logsearch.segments).
+    """
+
+    _compressor: Optional[ThreadPoolExecutor] = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + COMPRESSED_SUFFIX
+        self._pending: Optional[Future] = None
+        # Несжатые сегменты, оставшиеся после аварийной остановки
+        for i in range(1, self.backupCount + 1):
+            staged = f"{self.baseFilename}.{i}"
+            if not os.path.exists(staged):
+                continue
+            if os.path.exists(staged + COMPRESSED_SUFFIX):
+                # .gz появляется только целиком, значит сжатие успело закончиться
+                os.remove(staged)
+            else:
+                self._pending = self._submit(staged, staged + COMPRESSED_SUFFIX)
+
+    @classmethod
+    def _submit(cls, source: str, dest: str) -> Future:
+        if cls._compressor is None:
+            cls._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-compress")
+        return cls._compressor.submit(_compress_file, source, dest)
+
+    def rotate(self, source: str, dest: str) -> None:
+        staged = dest[: -len(COMPRESSED_SUFFIX)]
+        if os.path.exists(source):
+            os.rename(source, staged)
+            self._pending = self._submit(staged, dest)
+
+    def doRollover(self) -> None:
+        # Сдвиг .1.gz -> .2.gz должен начаться после того, как предыдущее сжатие закончилось
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+        super().doRollover()
+
+    @classmethod
+    def wait_for_compression(cls) -> None:
+        if cls._compressor is not None:
+            cls._compressor.shutdown(wait=True)
+            cls._compressor = None
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[DroppingQueueHandler] = None
+
+
+def _formatter(fmt: str) -> logging.Formatter:
+    return JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(fmt)
+
+
+def _file_handler(name: str, level: int) -> logging.Handler:
+    handler_class = (
+        CompressingRotatingFileHandler if LOG_COMPRESS == "gzip" else logging.handlers.RotatingFileHandler
+    )
+    handler = handler_class(
+        LOG_DIR / f"{name}.log",
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8",
+    )
+    handler.setLevel(level)
+    if name in RAW_CATEGORIES:
+        handler.setFormatter(logging.Formatter(FILE_FORMATS[name]))
+    else:
+        handler.setFormatter(_formatter(FILE_FORMATS[name]))
+    return handler
+
+
+def setup_logging(level: Optional[int] = None) -> None:
+    """Идемпотентно: повторный вызов (reload, тесты) ничего не делает."""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    if level is None:
+        level = logging.getLevelName(LOG_LEVEL)
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(level)
+    console.setFormatter(_formatter(CONSOLE_FORMAT))
+
+    router = CategoryRouter(
+        console=console,
+        files={
+            "debug": _file_handler("debug", logging.DEBUG),
+            "requests": _file_handler("requests", logging.INFO),
+            "auth": _file_handler("auth", logging.DEBUG),
+            "traces": _file_handler("traces", logging.INFO),
+            "slow": _file_handler("slow", logging.INFO),
+        },
+        errors=_file_handler("error", logging.ERROR),
+    )
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    sampling = parse_sampling(LOG_SAMPLING)
+    if sampling:
+        _queue_handler.addFilter(SamplingFilter(sampling))
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, router)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Дописывает очередь и закрывает файлы."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    CompressingRotatingFileHandler.wait_for_compression()
+    _listener = None
+
+
+def dropped_records() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
@@ -0,0 +1,389 @@
+"""
+Поиск по логам для GET /admin/logs/{log_name}/.
+
+Файлы (включая ротированные name.log.1 … name.log.N) читаются через mmap, без чтения
+целиком в память; сжатые сегменты name.log.N.gz распаковываются при чтении. Запись — строка с временем в начале (текстовый или JSON-формат) плюс
+строки продолжения (traceback); в traces.log запись — строка OTLP/JSON, время и request_id берутся
+из корневого span'а (время — UTC, как в JSON-логах). Для каждого сегмента рядом, в logs/.index/, хранится
+индекс: смещения записей через каждые SPARSE_INDEX_BYTES по времени и смещения записей
+по request_id. Индекс привязан к inode, поэтому переживает переименование при ротации;
+для текущего файла он дополняется с места, где остановился. Сжатые сегменты неизменны:
+если по индексу в сегменте нет нужного request_id или он целиком раньше since,
+сегмент даже не распаковывается.
+"""
+import bisect
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .logging_setup import COMPRESSED_SUFFIX, LOG_BACKUP_COUNT, LOG_DIR
+
+INDEX_DIR = LOG_DIR / ".index"
+INDEX_VERSION = 3
+SPARSE_INDEX_BYTES = 64 * 1024
+HEAD_BYTES = 256
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+_TEXT_TS = re.compile(rb"^(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2})")
+_JSON_TS = re.compile(rb'^\{"ts": "(\d{4}-\d{2}-\d{2})T(\d{2}:\d{2}:\d{2})')
+# Трейс (tracing): первый span — корневой, на нём же атрибут request_id
+_OTLP_RECORD = re.compile(rb'^\{"resourceSpans":')
+_OTLP_START = re.compile(rb'"startTimeUnixNano":"(\d+)"')
+_TEXT_LEVEL = re.compile(rb" - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - ")
+_JSON_LEVEL = re.compile(rb'"level": "(DEBUG|INFO|WARNING|ERROR|CRITICAL)"')
+# В тексте id отличается от тегов вида [GetUserMe] тем, что содержит цифры
+_TEXT_REQUEST_ID = re.compile(rb" - \[(?=[^\]]*\d)([0-9A-Za-z_.:-]{6,128})\] ")
+_JSON_REQUEST_ID = re.compile(rb'"request_id": "([0-9A-Za-z_.:-]{6,128})"')
+_OTLP_REQUEST_ID = re.compile(rb'\{"key":"request_id","value":\{"stringValue":"([0-9A-Za-z_.:-]{6,128})"\}\}')
+
+
+def segments(log_name: str) -> List[Path]:
+    """
+    Сегменты от старого к новому: name.log.N, …, name.log.1, name.log. Для ротированных
+    берётся несжатый файл, если он есть (сжатие ещё идёт), иначе .gz.
+    """
+    base = LOG_DIR / f"{log_name}.log"
+    paths = []
+    for i in range(LOG_BACKUP_COUNT, 0, -1):
+        plain = Path(f"{base}.{i}")
+        compressed = Path(f"{plain}{COMPRESSED_SUFFIX}")
+        if plain.exists():
+            paths.append(plain)
+        elif compressed.exists():
+            paths.append(compressed)
+    if base.exists():
+        paths.append(base)
+    return paths
+
+
+def is_compressed(path: Path) -> bool:
+    return path.name.endswith(COMPRESSED_SUFFIX)
+
+
+@contextmanager
+def open_segment(path: Path) -> Iterator[bytes]:
+    """Содержимое сегмента как буфер с find/rfind/срезами (mmap или распакованный .gz)."""
+    if is_compressed(path):
+        with gzip.open(path, "rb") as f:
+            yield f.read()
+        return
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            yield b""
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def _is_record_start(head: bytes) -> bool:
+    return bool(_TEXT_TS.match(head) or _JSON_TS.match(head) or _OTLP_RECORD.match(head))
+
+
+def _timestamp(first_line: bytes) -> Optional[str]:
+    match = _TEXT_TS.match(first_line) or _JSON_TS.match(first_line)
+    if match:
+        return f"{match.group(1).decode()} {match.group(2).decode()}"
+    if _OTLP_RECORD.match(first_line):
+        start = _OTLP_START.search(first_line)
+        if start:
+            seconds = int(start.group(1)) // 1_000_000_000
+            return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return None
+
+
+def _line_end(buf, start: int) -> int:
+    end = buf.find(b"\n", start)
+    return len(buf) if end == -1 else end + 1
+
+
+def iter_records(buf, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, int, str]]:
+    """(начало, конец, время) каждой записи, начинающейся в [start, stop)."""
+    stop = len(buf) if stop is None else stop
+    pos = next_record(buf, start)
+    while pos < stop:
+        ts = _timestamp(buf[pos : _line_end(buf, pos)])
+        end = next_record(buf, _line_end(buf, pos))
+        yield pos, end, ts
+        pos = end
+
+
+def next_record(buf, pos: int) -> int:
+    """Начало первой записи с позиции pos (строки продолжения пропускаются)."""
+    size = len(buf)
+    while pos < size and not _is_record_start(buf[pos : pos + 40]):
+        pos = _line_end(buf, pos)
+    return pos
+
+
+def record_start(buf, pos: int) -> int:
+    """Начало записи, в которую попадает позиция pos."""
+    line_start = buf.rfind(b"\n", 0, pos) + 1
+    while line_start > 0 and not _is_record_start(buf[line_start : line_start + 40]):
+        line_start = buf.rfind(b"\n", 0, line_start - 1) + 1
+    return line_start
+
+
+def _record_level(first_line: bytes) -> Optional[str]:
+    match = _TEXT_LEVEL.search(first_line) or _JSON_LEVEL.search(first_line)
+    return match.group(1).decode() if match else None
+
+
+def _record_request_id(first_line: bytes) -> Optional[str]:
+    if _OTLP_RECORD.match(first_line):
+        match = _OTLP_REQUEST_ID.search(first_line)
+    else:
+        match = _JSON_REQUEST_ID.search(first_line) or _TEXT_REQUEST_ID.search(first_line)
+    return match.group(1).decode() if match else None
+
+
+# ---------------------------------------------------------------------------
+# Индекс
+# ---------------------------------------------------------------------------
+class SegmentIndex:
+    def __init__(
+        self,
+        head: str,
+        size: int,
+        times: List[Tuple[str, int]],
+        request_ids: Dict[str, List[int]],
+        last_ts: Optional[str] = None,
+        stat: Optional[List[int]] = None,
+    ):
+        self.head = head
+        self.size = size
+        self.times = times
+        self.request_ids = request_ids
+        self.last_ts = last_ts
+        # (размер, mtime) файла на диске — по ним сжатый сегмент узнаётся без распаковки
+        self.stat = stat
+
+    def offset_for_time(self, since: str) -> int:
+        """Смещение, с которого достаточно читать записи не раньше since."""
+        position = bisect.bisect_left([ts for ts, _ in self.times], since)
+        return self.times[position - 1][1] if position > 0 else 0
+
+    def extend(self, buf, start: int) -> None:
+        next_sparse = self.times[-1][1] + SPARSE_INDEX_BYTES if self.times else 0
+        for begin, end, ts in iter_records(buf, start):
+            if ts is not None and begin >= next_sparse:
+                self.times.append((ts, begin))
+                next_sparse = begin + SPARSE_INDEX_BYTES
+            request_id = _record_request_id(buf[begin : _line_end(buf, begin)])
+            if request_id:
+                self.request_ids.setdefault(request_id, []).append(begin)
+            if ts is not None:
+                self.last_ts = ts
+        self.size = len(buf)
+
+    def to_json(self) -> dict:
+        return {
+            "version": INDEX_VERSION,
+            "head": self.head,
+            "size": self.size,
+            "times": self.times,
+            "request_ids": self.request_ids,
+            "last_ts": self.last_ts,
+            "stat": self.stat,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "SegmentIndex":
+        return cls(
+            data["head"],
+            data["size"],
+            [tuple(item) for item in data["times"]],
+            data["request_ids"],
+            data.get("last_ts"),
+            data.get("stat"),
+        )
+
+
+def _head_digest(buf) -> str:
+    return hashlib.sha1(buf[:HEAD_BYTES]).hexdigest()
+
+
+def _index_path(log_name: str, path: Path) -> Path:
+    return INDEX_DIR / f"{log_name}-{os.stat(path).st_ino}.json"
+
+
+def _file_stat(path: Path) -> List[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _read_index(index_path: Path) -> Optional[dict]:
+    try:
+        data = json.loads(index_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return data if data.get("version") == INDEX_VERSION else None
+
+
+def cached_index(log_name: str, path: Path) -> Optional[SegmentIndex]:
+    """Индекс сжатого сегмента без его распаковки (файл не менялся с момента индексации)."""
+    if not is_compressed(path):
+        return None
+    data = _read_index(_index_path(log_name, path))
+    if data is None or data.get("stat") != _file_stat(path):
+        return None
+    return SegmentIndex.from_json(data)
+
+
+def load_index(log_name: str, path: Path, buf) -> SegmentIndex:
+    """
+    Индекс сегмента: готовый, дополненный (файл дописывался) или построенный заново
+    (новый файл или inode достался другому файлу).
+    """
+    index_path = _index_path(log_name, path)
+    head = _head_digest(buf)
+    stat = _file_stat(path)
+    index = None
+    data = _read_index(index_path)
+    if data is not None and data.get("head") == head and data.get("size", len(buf) + 1) <= len(buf):
+        index = SegmentIndex.from_json(data)
+
+    if index is not None and index.size == len(buf):
+        if index.stat != stat:
+            index.stat = stat
+            _save_index(index_path, index)
+        return index
+    if index is None:
+        index = SegmentIndex(head, 0, [], {})
+    # Последняя запись могла быть недописана — начинаем с её начала
+    start = record_start(buf, index.size) if index.size else 0
+    for offsets in index.request_ids.values():
+        while offsets and offsets[-1] >= start:
+            offsets.pop()
+    while index.times and index.times[-1][1] >= start:
+        index.times.pop()
+    index.extend(buf, start)
+    index.stat = stat
+    _save_index(index_path, index)
+    return index
+
+
+def _save_index(index_path: Path, index: SegmentIndex) -> None:
+    INDEX_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(index.to_json()), encoding="utf-8")
+    os.replace(tmp_path, index_path)
+
+
+def prune_indexes(log_name: str) -> None:
+    """Удаляет индексы сегментов, которых больше нет (вытеснены ротацией)."""
+    if not INDEX_DIR.exists():
+        return
+    alive = {_index_path(log_name, path).name for path in segments(log_name)}
+    for index_path in INDEX_DIR.glob(f"{log_name}-*.json"):
+        if index_path.name not in alive:
+            index_path.unlink(missing_ok=True)
+
+
+# ---------------------------------------------------------------------------
+# Поиск
+# ---------------------------------------------------------------------------
+def _candidates(buf, index: SegmentIndex, request_id: Optional[str], since: Optional[str], contains: Optional[bytes]):
+    if request_id is not None:
+        for begin in index.request_ids.get(request_id, []):
+            yield begin, next_record(buf, _line_end(buf, begin))
+        return
+
+    pos = index.offset_for_time(since) if since else 0
+    if contains is None:
+        for begin, end, _ in iter_records(buf, pos):
+            yield begin, end
+        return
+
+    # Прыжки по вхождениям подстроки вместо разбора каждой записи
+    size = len(buf)
+    while pos < size:
+        found = buf.find(contains, pos)
+        if found == -1:
+            return
+        begin = record_start(buf, found)
+        end = next_record(buf, _line_end(buf, found))
+        yield begin, end
+        pos = end
+
+
+def search(
+    log_name: str,
+    request_id: Optional[str] = None,
+    since: Optional[str] = None,
+    level: Optional[str] = None,
+    contains: Optional[str] = None,
+    limit: int = 1000,
+) -> Iterator[dict]:
+    """
+    Записи, подходящие под все фильтры, от старых к новым.
+    since — "YYYY-MM-DD HH:MM:SS" (или его префикс), level — минимальный уровень.
+    """
+    min_level = LEVELS[level] if level else None
+    needle = contains.encode() if contains else None
+    since = since.replace("T", " ") if since else None
+    found = 0
+    prune_indexes(log_name)
+
+    for path in segments(log_name):
+        index = cached_index(log_name, path)
+        if index is not None:
+            if request_id is not None and request_id not in index.request_ids:
+                continue
+            if since and index.last_ts is not None and index.last_ts < since:
+                continue
+        with open_segment(path) as buf:
+            if not buf:
+                continue
+            index = load_index(log_name, path, buf)
+            for begin, end in _candidates(buf, index, request_id, since, needle):
+                record = buf[begin:end]
+                first_line = record.split(b"\n", 1)[0]
+                ts = _timestamp(first_line)
+                if since and (ts is None or ts < since):
+                    continue
+                record_level = _record_level(first_line)
+                if min_level is not None and LEVELS.get(record_level, LEVELS["INFO"]) < min_level:
+                    continue
+                if needle is not None and needle not in record:
+                    continue
+                if request_id is not None and _record_request_id(first_line) != request_id:
+                    continue
+                yield {
+                    "segment": path.name,
+                    "offset": begin,
+                    "ts": ts,
+                    "level": record_level,
+                    "request_id": _record_request_id(first_line),
+                    "text": record.decode("utf-8", errors="replace").rstrip("\n"),
+                }
+                found += 1
+                if found >= limit:
+                    return
+
+
+def tail(log_name: str, lines: int) -> List[str]:
+    """Последние lines строк текущего файла: поиск переводов строк с конца по mmap."""
+    path = LOG_DIR / f"{log_name}.log"
+    with open_segment(path) as buf:
+        end = len(buf)
+        if end and buf[end - 1 : end] == b"\n":
+            end -= 1
+        pos = end
+        for _ in range(lines):
+            pos = buf.rfind(b"\n", 0, pos)
+            if pos == -1:
+                break
+        start = 0 if pos == -1 else pos + 1
+        return buf[start:end].decode("utf-8", errors="replace").split("\n") if end else []
@@ -3,13 +3,10 @@ import shutil
 import time
 import json
 import logging
-import sys
 import traceback
-import uuid
-import jwt  # Убедитесь, что установлен PyJWT
-from jwt import ExpiredSignatureError, InvalidTokenError
 import asyncio
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from datetime import datetime
 from pathlib import Path
 from typing import List, Optional
 
@@ -19,125 +16,97 @@ from fastapi import (
     Depends,
     UploadFile,
     File,
+    Header,
     Query,
     Request,
     Response,
 )
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from starlette.requests import ClientDisconnect
+from sqlalchemy import Boolean, literal, literal_column, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy.exc import IntegrityError
 from pydantic import ValidationError
 
-from . import models, schemas
+from . import models, schemas, sync, counters, metrics, querystats, tracing, logsearch, profiler, slowlog, sessions
+from . import health, ratelimit, singleflight
+from .metrics import MetricsMiddleware
+from .logging_setup import LOG_DIR, setup_logging
+from .request_logging import RequestLoggingMiddleware
+from .tracing import TracedJSONResponse, TracedRoute, TracingMiddleware
+from .projection import (
+    Projection,
+    LISTING_RELATIONS,
+    TRANSACTION_RELATIONS,
+    FRIEND_RELATIONS,
+)
 from .database import SessionLocal, engine
-from .auth import verify_telegram_hash, create_access_token, verify_token, get_current_user
+from .auth import (
+    verify_telegram_hash,
+    verify_token,
+    get_current_user,
+    get_optional_user,
+    verify_refresh_token,
+    check_auth_date,
+    recent_logins,
+)
 from .config import (
     BOT_TOKEN,
-    JWT_ALGORITHM,
-    JWT_ACCESS_TOKEN_EXPIRE_MINUTES,
-    JWT_SECRET_KEY,
     ENVIRONMENT,
     IS_DEVELOPMENT,
 )
 
 # ========================================================================
-# Константы и директории
+# Константы и директории (создаются при старте, см. lifespan)
 # ========================================================================
 BASE_DIR = Path(__file__).parent  # Папка "backend"
-
-# Убедимся, что директории static/avatars существуют
 STATIC_DIR = BASE_DIR / "static"
 AVATAR_DIR = STATIC_DIR / "avatars"
-STATIC_DIR.mkdir(parents=True, exist_ok=True)
-AVATAR_DIR.mkdir(parents=True, exist_ok=True)
+UPLOAD_DIR = BASE_DIR.parent / "uploads"
+
+logger = logging.getLogger(__name__)
+# Категории: backend.auth -> auth.log, остальное -> debug.log (requests.log пишет request_logging)
+auth_logger = logging.getLogger("backend.auth")
 
-# Создаём логи, если не существует
-os.makedirs(BASE_DIR.parent / "logs", exist_ok=True)
 
 # ========================================================================
-# Конфигурация логирования
+# Старт и остановка воркера
 # ========================================================================
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    stream=sys.stdout,
-)
+# Импорт модуля ничего не создаёт и не ходит в БД: логирование, директории, схема, счётчики,
+# тестовый пользователь и фоновые задачи поднимаются здесь (замер — python -m backend.bench_startup).
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Очередь + отдельный поток записи, см. logging_setup
+    setup_logging()
+    logger.info("=" * 80)
+    logger.info("Starting Time Banking API (%s)", ENVIRONMENT)
+    logger.info("=" * 80)
+    if not BOT_TOKEN:
+        logger.warning("BOT_TOKEN is not configured, Telegram login will fail")
+
+    for directory in (STATIC_DIR, AVATAR_DIR, UPLOAD_DIR):
+        directory.mkdir(parents=True, exist_ok=True)
+    await run_in_threadpool(init_database)
+
+    app.state.loop_lag_monitor = asyncio.create_task(metrics.monitor_event_loop_lag())
+    profiler.start_trigger_watcher()
+    await run_in_threadpool(sessions.start_revocation_refresher)
+    health.start_diagnostics_refresher()
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        app.state.loop_lag_monitor.cancel()
+        profiler.stop_trigger_watcher()
+        sessions.stop_revocation_refresher()
+        health.stop_diagnostics_refresher()
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.handlers = []
-
-# Консольный обработчик
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.DEBUG)
-console_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
-
-# Файл-обработчик debug.log
-debug_file_handler = logging.handlers.RotatingFileHandler(
-    BASE_DIR.parent / "logs" / "debug.log",
-    maxBytes=10 * 1024 * 1024,
-    backupCount=10,
-)
-debug_file_handler.setLevel(logging.DEBUG)
-debug_file_handler.setFormatter(console_formatter)
-logger.addHandler(debug_file_handler)
-
-# Файл-обработчик error.log
-error_file_handler = logging.handlers.RotatingFileHandler(
-    BASE_DIR.parent / "logs" / "error.log",
-    maxBytes=10 * 1024 * 1024,
-    backupCount=10,
-)
-error_file_handler.setLevel(logging.ERROR)
-error_formatter = logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s\n%(pathname)s:%(lineno)d\n%(message)s\n"
-)
-error_file_handler.setFormatter(error_formatter)
-logger.addHandler(error_file_handler)
-
-# Файл-обработчик requests.log
-requests_file_handler = logging.handlers.RotatingFileHandler(
-    BASE_DIR.parent / "logs" / "requests.log",
-    maxBytes=10 * 1024 * 1024,
-    backupCount=10,
-)
-requests_file_handler.setLevel(logging.INFO)
-requests_formatter = logging.Formatter("%(asctime)s - %(message)s")
-requests_file_handler.setFormatter(requests_formatter)
-logger.addHandler(requests_file_handler)
-
-# Файл-обработчик auth.log
-auth_file_handler = logging.handlers.RotatingFileHandler(
-    BASE_DIR.parent / "logs" / "auth.log",
-    maxBytes=10 * 1024 * 1024,
-    backupCount=10,
-)
-auth_file_handler.setLevel(logging.DEBUG)
-auth_formatter = logging.Formatter("%(asctime)s - AUTH - %(levelname)s - %(message)s")
-auth_file_handler.setFormatter(auth_formatter)
-logger.addHandler(auth_file_handler)
-
-logger.propagate = False
-
-# Логгер модуля auth
-auth_logger = logging.getLogger("auth")
-auth_logger.setLevel(logging.DEBUG)
-auth_logger.handlers = []
-auth_logger.addHandler(console_handler)
-auth_logger.addHandler(auth_file_handler)
-auth_logger.propagate = False
-
-# Логируем запуск сервиса
-logger.info("=" * 80)
-logger.info("Starting Time Banking API")
-logger.info("=" * 80)
-logger.info(f"Bot token: {BOT_TOKEN[:5]}...{BOT_TOKEN[-5:]} (length: {len(BOT_TOKEN)})")
 
 # ========================================================================
 # Инициализация FastAPI
@@ -146,7 +115,18 @@ app = FastAPI(
     title="Time Banking API",
     description="API for Time Banking service",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=TracedJSONResponse,
+    # Лимиты частоты по роуту и пользователю/IP (см. ratelimit)
+    dependencies=[Depends(ratelimit.enforce)],
 )
+# Обработчики и их зависимости попадают в трейс отдельными span'ами (см. tracing)
+app.router.route_class = TracedRoute
+
+# Одинаковые одновременные запросы получают один ответ (см. singleflight).
+# Добавляется первым, то есть оказывается внутри остальных middleware: журнал, метрики,
+# CORS и X-Request-ID у каждого склеенного запроса свои.
+app.add_middleware(singleflight.CoalescingMiddleware)
 
 # ========================================================================
 # CORS Middleware
@@ -171,62 +151,80 @@ app.add_middleware(
 )
 
 # ========================================================================
-# Монтирование статических файлов (avatars, css и т.д.)
+# Трассировка: сэмплированные запросы пишутся в logs/traces.log (OTLP/JSON)
 # ========================================================================
-app.mount(
-    "/static",
-    StaticFiles(directory=STATIC_DIR),
-    name="static",
-)
+app.add_middleware(TracingMiddleware)
+tracing.instrument_engine(engine)
 
 # ========================================================================
-# Зависимость: доступ к сессии БД
+# Профилирование по запросу (см. profiler): только при заданном PROFILER_SECRET
 # ========================================================================
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+if profiler.PROFILER_ENABLED:
+    app.add_middleware(profiler.ProfilerMiddleware)
 
+# ========================================================================
+# Журнал запросов: одна запись на запрос (см. request_logging)
+# ========================================================================
+app.add_middleware(RequestLoggingMiddleware)
 
 # ========================================================================
-# Middleware для логирования всех входящих запросов и ответов
+# Метрики Prometheus (см. metrics, отдаются на GET /metrics)
 # ========================================================================
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    request_id = str(uuid.uuid4())
-    client_host = request.client.host if request.client else "unknown"
-    client_port = request.client.port if request.client else "unknown"
+app.add_middleware(MetricsMiddleware)
+metrics.instrument_engine(engine)
+
+# Допуск к БД: по умолчанию столько запросов, сколько соединений может выдать пул
+ratelimit.db_admission.configure(engine)
 
-    logger.info(f"[{request_id}] Request from {client_host}:{client_port} - {request.method} {request.url.path}")
+# Учёт SQL на запрос и поиск N+1 (см. querystats)
+querystats.instrument_engine(engine)
+# Медленные SQL-выражения с планом выполнения в slow.log (см. slowlog)
+slowlog.instrument_engine(engine)
 
-    if request.query_params:
-        logger.info(f"[{request_id}] Query params: {dict(request.query_params)}")
 
-    if request.method not in ("POST", "PUT", "PATCH"):
+# ========================================================================
+# Монтирование статических файлов (avatars, css и т.д.)
+# ========================================================================
+app.mount(
+    "/static",
+    StaticFiles(directory=STATIC_DIR, check_dir=False),
+    name="static",
+)
+
+# ========================================================================
+# Зависимость: доступ к сессии БД
+# ========================================================================
+def get_db(request: Request):
+    # Не больше ratelimit.db_admission.capacity запросов работают с БД одновременно, иначе 503
+    with ratelimit.db_admission.admit(getattr(request.scope.get("route"), "path", "")):
+        with tracing.span("get_db"):
+            db = SessionLocal()
         try:
-            body = await request.body()
-            if body:
-                logger.info(f"[{request_id}] Request body: {body.decode()}")
-        except Exception as e:
-            logger.debug(f"[{request_id}] Could not log request body: {str(e)}")
-    else:
-        logger.info(f"[{request_id}] Request body for {request.method} will be processed by endpoint.")
+            yield db
+        finally:
+            with tracing.span("get_db.close"):
+                db.close()
 
-    start_time = time.time()
 
-    try:
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        logger.info(f"[{request_id}] Response status: {response.status_code} - Completed in {process_time:.4f}s")
-        return response
-    except Exception as e:
-        process_time = time.time() - start_time
-        logger.error(f"[{request_id}] Error during request processing: {str(e)}")
-        logger.error(f"[{request_id}] Error details: {traceback.format_exc()}")
-        logger.error(f"[{request_id}] Failed after {process_time:.4f}s")
-        raise
+# ========================================================================
+# Зависимость: строка User текущего пользователя
+# ========================================================================
+def get_current_db_user(
+    request: Request,
+    token_data: dict = Depends(get_current_user),
+    db: Session = Depends(get_db),
+) -> models.User:
+    """
+    Не больше одной выборки на запрос: строка запоминается в request.state.user,
+    а db.get() сначала смотрит в identity map сессии.
+    """
+    user = getattr(request.state, "user", None)
+    if user is None:
+        user = db.get(models.User, int(token_data["sub"]))
+        if user is None:
+            raise HTTPException(status_code=404, detail="User from token not found")
+        request.state.user = user
+    return user
 
 
 # ========================================================================
@@ -259,6 +257,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     return JSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail},
+        headers=getattr(exc, "headers", None),
     )
 
 
@@ -270,13 +269,45 @@ async def root():
     return {"message": "Time Banking API is running"}
 
 
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Живость процесса: без обращений к БД и диску (см. health)."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Готовность воркера для балансировщика: старт завершён, остановка не началась (см. serve),
+    БД отвечает и схема не отстаёт от миграций (см. health)."""
+    if not getattr(app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "not ready"})
+    problem = await health.check_ready()
+    if problem is not None:
+        return JSONResponse(status_code=503, content={"status": "not ready", "reason": problem})
+    return {"status": "ready"}
+
+
 # --------------------------------------------------
-# Инициализация базы, создание тестового пользователя
+# Инициализация базы, создание тестового пользователя (вызываются из lifespan)
 # --------------------------------------------------
-UPLOAD_DIR = BASE_DIR.parent / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+def init_database():
+    # Воркеры стартуют одновременно: схема и начальные данные — по очереди, под блокировкой миграций
+    from . import migrations
 
-models.Base.metadata.create_all(bind=engine)
+    with engine.connect() as connection, migrations.migration_lock(connection):
+        # Схема — только миграциями alembic; AUTO_MIGRATE=0 — их запускают отдельно (backend.serve)
+        if migrations.AUTO_MIGRATE:
+            migrations.upgrade(connection)
+        create_test_user()
+    init_counters()
+
+
+def init_counters():
+    db = SessionLocal()
+    try:
+        counters.ensure_counters(db)
+    finally:
+        db.close()
 
 
 def create_test_user():
@@ -297,64 +328,33 @@ def create_test_user():
         db.close()
 
 
-create_test_user()
+# --------------------------------------------------
+# Метрики Prometheus
+# --------------------------------------------------
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(content=metrics.render_metrics(), media_type=metrics.CONTENT_TYPE_LATEST)
 
 
 # --------------------------------------------------
 # Диагностический эндпоинт
 # --------------------------------------------------
 @app.get("/diagnostics")
-async def diagnostics(db: Session = Depends(get_db)):
+def diagnostics():
     """
     Диагностический эндпоинт для проверки состояния системы.
+    Отдаёт сводку, которую фоновый поток пересчитывает раз в DIAGNOSTICS_REFRESH_SECONDS
+    (computed_at, age_seconds), и сам в БД не ходит.
     """
-    try:
-        db_connection_ok = False
-        db_error = None
-        user_count = 0
+    return health.get_diagnostics()
 
-        try:
-            user_count = db.query(models.User).count()
-            db_connection_ok = True
-        except Exception as e:
-            db_error = str(e)
-            logger.error(f"Database connection error: {e}")
-
-        auth_config = {
-            "jwt_algorithm": JWT_ALGORITHM,
-            "jwt_expiry_minutes": JWT_ACCESS_TOKEN_EXPIRE_MINUTES,
-            "bot_token_length": len(BOT_TOKEN) if BOT_TOKEN else 0,
-            "bot_token_first_chars": BOT_TOKEN[:4] if BOT_TOKEN else None,
-            "bot_token_last_chars": BOT_TOKEN[-4:] if BOT_TOKEN else None,
-        }
-
-        fs_status = {
-            "uploads_dir_exists": os.path.exists(BASE_DIR.parent / "uploads"),
-            "logs_dir_exists": os.path.exists(BASE_DIR.parent / "logs"),
-            "db_file_exists": os.path.exists(BASE_DIR.parent / "time_banking.db"),
-            "db_file_size": os.path.getsize(BASE_DIR.parent / "time_banking.db")
-            if os.path.exists(BASE_DIR.parent / "time_banking.db")
-            else 0,
-        }
 
-        return {
-            "api_status": "ok",
-            "database": {
-                "connection": db_connection_ok,
-                "error": db_error,
-                "user_count": user_count,
-            },
-            "auth_config": auth_config,
-            "filesystem": fs_status,
-            "timestamp": datetime.utcnow().isoformat(),
-        }
-    except Exception as e:
-        logger.error(f"Diagnostics endpoint error: {e}")
-        return {
-            "api_status": "error",
-            "error": str(e),
-            "timestamp": datetime.utcnow().isoformat(),
-        }
+# --------------------------------------------------
+# Статистика площадки (из счётчиков, без COUNT по таблицам)
+# --------------------------------------------------
+@app.get("/stats/", response_model=schemas.Stats)
+def get_stats(db: Session = Depends(get_db)):
+    return counters.get_stats(db)
 
 
 # --------------------------------------------------
@@ -363,22 +363,8 @@ async def diagnostics(db: Session = Depends(get_db)):
 @app.get("/user/me/", response_model=schemas.UserProfile)
 def get_user_me(
     response: Response,
-    token_data: dict = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db_user: models.User = Depends(get_current_db_user),
 ):
-    logger.debug("[GetUserMe] Attempting to get current user.")
-    if not token_data:
-        logger.error("[GetUserMe] No token data received from get_current_user.")
-        raise HTTPException(status_code=401, detail="Not authenticated (no token data)")
-
-    user_id = token_data.get("sub")
-    logger.debug(f"[GetUserMe] Token SUB: {user_id}. Fetching user from DB.")
-
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
-    if db_user is None:
-        logger.warning(f"[GetUserMe] User ID {user_id} from token not found in DB.")
-        raise HTTPException(status_code=404, detail="User from token not found")
-
     logger.info(
         f"[GetUserMe] User {db_user.username} (ID: {db_user.id}) found. "
         f"Avatar path from DB to be returned: '{db_user.avatar}'"
@@ -392,37 +378,75 @@ def get_user_me(
     return db_user
 
 
+# --------------------------------------------------
+# Пакетное чтение по списку id
+# --------------------------------------------------
+MAX_BATCH_IDS = 100
+
+
+def _parse_ids(ids: str) -> List[int]:
+    try:
+        parsed = [int(part) for part in ids.split(",") if part.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    if len(parsed) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Too many ids (max {MAX_BATCH_IDS})")
+    return list(dict.fromkeys(parsed))
+
+
+def _in_requested_order(rows, requested_ids: List[int]) -> list:
+    by_id = {row.id: row for row in rows}
+    return [by_id[row_id] for row_id in requested_ids if row_id in by_id]
+
+
+@app.get("/users/", response_model=List[schemas.UserProfile])
+def get_users_by_ids(ids: str, db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)):
+    requested_ids = _parse_ids(ids)
+    users = db.query(models.User).filter(models.User.id.in_(requested_ids)).all()
+    return _in_requested_order(users, requested_ids)
+
+
 # --------------------------------------------------
 # Получить список всех листингов
 # --------------------------------------------------
 @app.get("/listings/", response_model=List[schemas.Listing])
 def get_listings(
-    request: Request,
     skip: int = 0,
     limit: int = 5,
     status: Optional[str] = None,
     listing_type: Optional[str] = None,
+    ids: Optional[str] = None,
+    fields: Optional[str] = None,
+    embed: str = "inline",
     db: Session = Depends(get_db),
+    token_data: Optional[dict] = Depends(get_optional_user),  # вход не обязателен
 ):
-    # Пытаемся аутентифицировать, но не требуем
-    try:
-        # Вместо get_current_user(request, db) — всего лишь request
-        get_current_user(request)
-    except HTTPException:
-        pass
-
-    query = db.query(models.Listing).options(
-        joinedload(models.Listing.creator), joinedload(models.Listing.worker)
-    )
+    """
+    Без ids — постраничный список. С ids=1,2,3 — пакетное чтение одним IN-запросом
+    в порядке запрошенных id (несуществующие пропускаются), skip/limit не применяются.
+    """
+    projection = Projection.from_params(models.Listing, schemas.ListingRef, LISTING_RELATIONS, fields, embed)
+    if projection is not None:
+        query = projection.query(db)
+    else:
+        query = db.query(models.Listing).options(
+            joinedload(models.Listing.creator), joinedload(models.Listing.worker)
+        )
 
     if status:
         query = query.filter(models.Listing.status == status)
     if listing_type:
         query = query.filter(models.Listing.listing_type == listing_type)
 
-    listings = (
-        query.order_by(models.Listing.created_at.desc()).offset(skip).limit(limit).all()
-    )
+    if ids is not None:
+        requested_ids = _parse_ids(ids)
+        listings = _in_requested_order(query.filter(models.Listing.id.in_(requested_ids)).all(), requested_ids)
+    else:
+        listings = (
+            query.order_by(models.Listing.created_at.desc()).offset(skip).limit(limit).all()
+        )
+    if projection is not None:
+        return projection.render(db, listings)
     return listings
 
 
@@ -433,15 +457,11 @@ def get_listings(
 def create_listing(
     listing: schemas.ListingCreate,
     db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
+    user: models.User = Depends(get_current_db_user),
 ):
-    if int(token_data["sub"]) != listing.user_id:
+    if user.id != listing.user_id:
         raise HTTPException(status_code=403, detail="Cannot create listing for another user")
 
-    user = db.query(models.User).filter(models.User.id == listing.user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
     if listing.listing_type == "request" and user.balance < listing.hours:
         raise HTTPException(status_code=400, detail="Insufficient balance")
 
@@ -453,69 +473,35 @@ def create_listing(
 
 
 # --------------------------------------------------
-# Откликнуться на листинг
+# Переходы состояний листинга
 # --------------------------------------------------
-@app.post("/listings/{listing_id}/apply/")
-def apply_for_listing(
-    listing_id: int,
-    db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
-):
+# Каждый переход проверяет все условия до первого изменения и ничего не коммитит:
+# коммитит вызывающий — одиночный эндпоинт или пакетный /listings/batch/.
+def _get_listing_or_404(db: Session, listing_id: int) -> models.Listing:
     listing = db.query(models.Listing).filter(models.Listing.id == listing_id).first()
     if not listing:
         raise HTTPException(status_code=404, detail="Listing not found")
+    return listing
+
 
+def _apply_for_listing(db: Session, listing: models.Listing, user_id: int):
     if listing.status != "active":
         raise HTTPException(status_code=400, detail="Listing is not active")
 
     if listing.listing_type == "offer":
-        worker = db.query(models.User).filter(models.User.id == int(token_data["sub"])).first()
+        worker = db.query(models.User).filter(models.User.id == user_id).first()
         if worker.balance < listing.hours:
             raise HTTPException(status_code=400, detail="Insufficient balance")
 
     listing.status = "pending_worker"
-    listing.worker_id = int(token_data["sub"])
-    db.commit()
-    db.refresh(listing)
-    return listing
-
+    listing.worker_id = user_id
 
-# --------------------------------------------------
-# Принять исполнителя
-# --------------------------------------------------
-@app.post("/listings/{listing_id}/accept/")
-def accept_worker(
-    listing_id: int,
-    db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
-):
-    listing = db.query(models.Listing).filter(models.Listing.id == listing_id).first()
-    if not listing:
-        raise HTTPException(status_code=404, detail="Listing not found")
-
-    if listing.user_id != int(token_data["sub"]):
-        raise HTTPException(status_code=403, detail="Only listing creator can accept workers")
-
-    if listing.status != "pending_worker":
-        raise HTTPException(status_code=400, detail="Listing is not pending worker acceptance")
 
+def _pay_prepayment(db: Session, listing: models.Listing, payer_id: int, receiver_id: int, description: str):
     prepayment_hours = round(listing.hours * 0.33, 1)
 
-    creator = db.query(models.User).filter(models.User.id == listing.user_id).first()
-    worker = db.query(models.User).filter(models.User.id == listing.worker_id).first()
-
-    if listing.listing_type == "request":
-        payer_id = listing.user_id
-        receiver_id = listing.worker_id
-        payer = creator
-        receiver = worker
-        description = f"Предоплата (33%) за помощь: {listing.title}"
-    else:
-        payer_id = listing.worker_id
-        receiver_id = listing.user_id
-        payer = worker
-        receiver = creator
-        description = f"Предоплата (33%) за услугу: {listing.title}"
+    payer = db.query(models.User).filter(models.User.id == payer_id).first()
+    receiver = db.query(models.User).filter(models.User.id == receiver_id).first()
 
     if payer.balance < prepayment_hours:
         raise HTTPException(status_code=400, detail="Недостаточно средств для предоплаты")
@@ -531,30 +517,31 @@ def accept_worker(
         transaction_type="prepayment",
     )
     db.add(transaction)
-    db.commit()
+    db.flush()
 
     listing.prepayment_transaction_id = transaction.id
     listing.status = "in_progress"
 
-    db.commit()
-    db.refresh(listing)
-    return listing
 
+def _accept_worker(db: Session, listing: models.Listing, user_id: int):
+    if listing.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Only listing creator can accept workers")
 
-# --------------------------------------------------
-# Отклонить отклик исполнителя
-# --------------------------------------------------
-@app.post("/listings/{listing_id}/reject/")
-def reject_worker(
-    listing_id: int,
-    db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
-):
-    listing = db.query(models.Listing).filter(models.Listing.id == listing_id).first()
-    if not listing:
-        raise HTTPException(status_code=404, detail="Listing not found")
+    if listing.status != "pending_worker":
+        raise HTTPException(status_code=400, detail="Listing is not pending worker acceptance")
 
-    if listing.user_id != int(token_data["sub"]):
+    if listing.listing_type == "request":
+        _pay_prepayment(
+            db, listing, listing.user_id, listing.worker_id, f"Предоплата (33%) за помощь: {listing.title}"
+        )
+    else:
+        _pay_prepayment(
+            db, listing, listing.worker_id, listing.user_id, f"Предоплата (33%) за услугу: {listing.title}"
+        )
+
+
+def _reject_worker(db: Session, listing: models.Listing, user_id: int):
+    if listing.user_id != user_id:
         raise HTTPException(status_code=403, detail="Only listing creator can reject workers")
 
     if listing.status != "pending_worker":
@@ -562,112 +549,40 @@ def reject_worker(
 
     listing.status = "active"
     listing.worker_id = None
-    db.commit()
-    db.refresh(listing)
-    return listing
 
 
-# --------------------------------------------------
-# Предоплата для offer-типов
-# --------------------------------------------------
-@app.post("/listings/{listing_id}/pay/")
-def make_payment(
-    listing_id: int,
-    db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
-):
-    listing = db.query(models.Listing).filter(models.Listing.id == listing_id).first()
-    if not listing:
-        raise HTTPException(status_code=404, detail="Listing not found")
-
-    if listing.worker_id != int(token_data["sub"]):
+def _make_payment(db: Session, listing: models.Listing, user_id: int):
+    if listing.worker_id != user_id:
         raise HTTPException(status_code=403, detail="Only worker can make payment")
 
     if listing.status != "pending_payment":
         raise HTTPException(status_code=400, detail="Listing is not pending payment")
 
-    prepayment_hours = round(listing.hours * 0.33, 1)
-
-    creator = db.query(models.User).filter(models.User.id == listing.user_id).first()
-    worker = db.query(models.User).filter(models.User.id == listing.worker_id).first()
-
-    payer_id = listing.worker_id
-    receiver_id = listing.user_id
-    payer = worker
-    receiver = creator
-    description = f"Предоплата (33%) за услугу: {listing.title}"
-
-    if payer.balance < prepayment_hours:
-        raise HTTPException(status_code=400, detail="Недостаточно средств для предоплаты")
-
-    payer.balance -= prepayment_hours
-    receiver.balance += prepayment_hours
-
-    transaction = models.Transaction(
-        from_user_id=payer_id,
-        to_user_id=receiver_id,
-        hours=prepayment_hours,
-        description=description,
-        transaction_type="prepayment",
+    _pay_prepayment(
+        db, listing, listing.worker_id, listing.user_id, f"Предоплата (33%) за услугу: {listing.title}"
     )
-    db.add(transaction)
-    db.commit()
 
-    listing.prepayment_transaction_id = transaction.id
-    listing.status = "in_progress"
-
-    db.commit()
-    db.refresh(listing)
-    return listing
-
-
-# --------------------------------------------------
-# Завершение листинга (worker/creator ставят “complete”)
-# --------------------------------------------------
-@app.post("/listings/{listing_id}/complete/")
-def complete_listing(
-    listing_id: int,
-    db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
-):
-    listing = db.query(models.Listing).filter(models.Listing.id == listing_id).first()
-    if not listing:
-        raise HTTPException(status_code=404, detail="Listing not found")
 
+def _complete_listing(db: Session, listing: models.Listing, user_id: int):
     if listing.listing_type == "request":
-        if listing.worker_id != int(token_data["sub"]):
+        if listing.worker_id != user_id:
             raise HTTPException(status_code=403, detail="Only worker can mark request as complete")
     else:
-        if listing.user_id != int(token_data["sub"]):
+        if listing.user_id != user_id:
             raise HTTPException(status_code=403, detail="Only creator can mark offer as complete")
 
     if listing.status != "in_progress":
         raise HTTPException(status_code=400, detail="Listing is not in progress")
 
     listing.status = "pending_confirmation"
-    db.commit()
-    db.refresh(listing)
-    return listing
-
 
-# --------------------------------------------------
-# Подтверждение завершения (creator/worker ставят “confirm”)
-# --------------------------------------------------
-@app.post("/listings/{listing_id}/confirm/")
-def confirm_completion(
-    listing_id: int,
-    db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
-):
-    listing = db.query(models.Listing).filter(models.Listing.id == listing_id).first()
-    if not listing:
-        raise HTTPException(status_code=404, detail="Listing not found")
 
+def _confirm_completion(db: Session, listing: models.Listing, user_id: int):
     if listing.listing_type == "request":
-        if listing.user_id != int(token_data["sub"]):
+        if listing.user_id != user_id:
             raise HTTPException(status_code=403, detail="Only listing creator can confirm request completion")
     else:
-        if listing.worker_id != int(token_data["sub"]):
+        if listing.worker_id != user_id:
             raise HTTPException(status_code=403, detail="Only worker can confirm offer completion")
 
     if listing.status != "pending_confirmation":
@@ -715,17 +630,118 @@ def confirm_completion(
         transaction_type="payment",
     )
     db.add(final_transaction)
-    db.commit()
 
     receiver_earned.earned_hours += listing.hours
     payer_spent.spent_hours += listing.hours
+    creator.completed_deals += 1
+    worker.completed_deals += 1
 
     listing.status = "completed"
-    db.commit()
-    db.refresh(listing)
+
+
+def _cancel_listing(db: Session, listing: models.Listing, user_id: int):
+    if listing.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Only listing creator can cancel listing")
+
+    if listing.status not in ["active", "pending_worker"]:
+        raise HTTPException(status_code=400, detail="Cannot cancel listing in current status")
+
+    listing.status = "cancelled"
+    listing.worker_id = None
+
+
+LISTING_ACTIONS = {
+    "apply": _apply_for_listing,
+    "accept": _accept_worker,
+    "reject": _reject_worker,
+    "pay": _make_payment,
+    "complete": _complete_listing,
+    "confirm": _confirm_completion,
+    "cancel": _cancel_listing,
+}
+
+
+def _run_listing_action(action: str, listing_id: int, db: Session, token_data: dict):
+    with tracing.span(f"listing.{action}", **{"listing.id": listing_id}):
+        listing = _get_listing_or_404(db, listing_id)
+        LISTING_ACTIONS[action](db, listing, int(token_data["sub"]))
+        db.commit()
+        db.refresh(listing)
     return listing
 
 
+# --------------------------------------------------
+# Откликнуться на листинг
+# --------------------------------------------------
+@app.post("/listings/{listing_id}/apply/")
+def apply_for_listing(
+    listing_id: int,
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    return _run_listing_action("apply", listing_id, db, token_data)
+
+
+# --------------------------------------------------
+# Принять исполнителя
+# --------------------------------------------------
+@app.post("/listings/{listing_id}/accept/")
+def accept_worker(
+    listing_id: int,
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    return _run_listing_action("accept", listing_id, db, token_data)
+
+
+# --------------------------------------------------
+# Отклонить отклик исполнителя
+# --------------------------------------------------
+@app.post("/listings/{listing_id}/reject/")
+def reject_worker(
+    listing_id: int,
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    return _run_listing_action("reject", listing_id, db, token_data)
+
+
+# --------------------------------------------------
+# Предоплата для offer-типов
+# --------------------------------------------------
+@app.post("/listings/{listing_id}/pay/")
+def make_payment(
+    listing_id: int,
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    return _run_listing_action("pay", listing_id, db, token_data)
+
+
+# --------------------------------------------------
+# Завершение листинга (worker/creator ставят “complete”)
+# --------------------------------------------------
+@app.post("/listings/{listing_id}/complete/")
+def complete_listing(
+    listing_id: int,
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    return _run_listing_action("complete", listing_id, db, token_data)
+
+
+# --------------------------------------------------
+# Подтверждение завершения (creator/worker ставят “confirm”)
+# --------------------------------------------------
+@app.post("/listings/{listing_id}/confirm/")
+def confirm_completion(
+    listing_id: int,
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    return _run_listing_action("confirm", listing_id, db, token_data)
+
+
 # --------------------------------------------------
 # Отмена листинга
 # --------------------------------------------------
@@ -735,39 +751,115 @@ def cancel_listing(
     db: Session = Depends(get_db),
     token_data: dict = Depends(get_current_user),
 ):
-    listing = db.query(models.Listing).filter(models.Listing.id == listing_id).first()
-    if not listing:
-        raise HTTPException(status_code=404, detail="Listing not found")
+    return _run_listing_action("cancel", listing_id, db, token_data)
 
-    if listing.user_id != int(token_data["sub"]):
-        raise HTTPException(status_code=403, detail="Only listing creator can cancel listing")
 
-    if listing.status not in ["active", "pending_worker"]:
-        raise HTTPException(status_code=400, detail="Cannot cancel listing in current status")
+# --------------------------------------------------
+# Пакетное применение переходов (одна транзакция)
+# --------------------------------------------------
+MAX_BATCH_SIZE = 100
+
+
+@app.post("/listings/batch/", response_model=List[schemas.ListingActionResult])
+def batch_listing_actions(
+    batch: schemas.ListingBatchRequest,
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    """
+    Применяет переходы по порядку в одной транзакции и возвращает результат по каждому.
+    Ошибочный элемент ничего не меняет (все проверки идут до изменений) и не мешает остальным;
+    при atomic=true первая ошибка откатывает весь пакет.
+    """
+    if len(batch.actions) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Too many actions (max {MAX_BATCH_SIZE})")
+
+    user_id = int(token_data["sub"])
+    listing_ids = {item.listing_id for item in batch.actions}
+    listings = {
+        listing.id: listing
+        for listing in db.query(models.Listing).filter(models.Listing.id.in_(listing_ids)).all()
+    }
+
+    results = []
+    failed = False
+    for item in batch.actions:
+        result = schemas.ListingActionResult(listing_id=item.listing_id, action=item.action, ok=False, status_code=200)
+        try:
+            if item.action not in LISTING_ACTIONS:
+                raise HTTPException(
+                    status_code=400, detail=f"Unknown action. Available: {', '.join(LISTING_ACTIONS)}"
+                )
+            listing = listings.get(item.listing_id)
+            if listing is None:
+                raise HTTPException(status_code=404, detail="Listing not found")
+            with tracing.span(f"listing.{item.action}", **{"listing.id": item.listing_id}):
+                LISTING_ACTIONS[item.action](db, listing, user_id)
+                db.flush()
+            result.ok = True
+            result.listing = schemas.ListingRef.model_validate(listing)
+        except HTTPException as e:
+            result.status_code = e.status_code
+            result.detail = e.detail
+            failed = True
+        results.append(result)
+        if failed and batch.atomic:
+            break
+
+    if failed and batch.atomic:
+        db.rollback()
+        failed_result = results[-1]
+        return [
+            failed_result
+            if index == len(results) - 1
+            else schemas.ListingActionResult(
+                listing_id=item.listing_id,
+                action=item.action,
+                ok=False,
+                status_code=409,
+                detail="Batch rolled back",
+            )
+            for index, item in enumerate(batch.actions)
+        ]
 
-    listing.status = "cancelled"
-    listing.worker_id = None
     db.commit()
-    db.refresh(listing)
-    return listing
+    return results
 
 
 # --------------------------------------------------
 # Получить список друзей
 # --------------------------------------------------
-@app.get("/friends/", response_model=List[schemas.Friend])
-def get_friends(db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)):
-    user_id = int(token_data["sub"])
-    friends = (
-        db.query(models.Friend)
+def _friends_query(db: Session, projection: Optional[Projection] = None):
+    if projection is not None:
+        return projection.query(db)
+    return db.query(models.Friend).options(joinedload(models.Friend.user), joinedload(models.Friend.friend))
+
+
+def _load_friends(db: Session, user_id: int, projection: Optional[Projection] = None) -> list:
+    return (
+        _friends_query(db, projection)
         .filter(
             ((models.Friend.user_id == user_id) | (models.Friend.friend_id == user_id))
             & (models.Friend.status == "accepted")
         )
-        .options(joinedload(models.Friend.user), joinedload(models.Friend.friend))
         .all()
     )
 
+
+@app.get("/friends/", response_model=List[schemas.Friend])
+def get_friends(
+    fields: Optional[str] = None,
+    embed: str = "inline",
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    user_id = int(token_data["sub"])
+    projection = Projection.from_params(models.Friend, schemas.FriendRef, FRIEND_RELATIONS, fields, embed)
+    if projection is not None:
+        return projection.render(db, _load_friends(db, user_id, projection))
+
+    friends = _load_friends(db, user_id)
+
     return [
         schemas.Friend(
             id=friend.id,
@@ -873,23 +965,35 @@ def reject_friend_request(
 # --------------------------------------------------
 @app.get("/transactions/{user_id}/", response_model=List[schemas.Transaction])
 def get_transactions(
-    user_id: int, db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)
+    user_id: int,
+    fields: Optional[str] = None,
+    embed: str = "inline",
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
 ):
     if int(token_data["sub"]) != user_id:
         raise HTTPException(status_code=403, detail="Cannot view transactions for another user")
 
+    projection = Projection.from_params(
+        models.Transaction, schemas.TransactionRef, TRANSACTION_RELATIONS, fields, embed
+    )
+    if projection is not None:
+        query = projection.query(db)
+    else:
+        query = db.query(models.Transaction).options(
+            joinedload(models.Transaction.from_user), joinedload(models.Transaction.to_user)
+        )
+
     transactions = (
-        db.query(models.Transaction)
-        .filter(
+        query.filter(
             (models.Transaction.from_user_id == user_id)
             | (models.Transaction.to_user_id == user_id)
         )
-        .options(
-            joinedload(models.Transaction.from_user), joinedload(models.Transaction.to_user)
-        )
         .order_by(models.Transaction.created_at.desc())
         .all()
     )
+    if projection is not None:
+        return projection.render(db, transactions)
     return transactions
 
 
@@ -901,7 +1005,7 @@ async def upload_avatar(
     user_id: int,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),                # <- Обязательно Depends(get_db)
-    token_data: dict = Depends(get_current_user),  # <- Данные токена
+    db_user: models.User = Depends(get_current_db_user),  # <- Пользователь из токена
 ):
     """
     Загружает аватар пользователя:
@@ -909,13 +1013,9 @@ async def upload_avatar(
     2. Сохраняем файл в backend/static/avatars/
     3. Сохраняем относительный URL (/static/avatars/...) в БД
     """
-    if token_data.get("sub") != str(user_id):
+    if db_user.id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
 
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not db_user:
-        raise HTTPException(status_code=404, detail="User not found")
-
     # Статические файлы уже созданы ранее
     file_extension = Path(file.filename).suffix
     timestamp = int(time.time())
@@ -950,9 +1050,27 @@ async def upload_avatar(
 # --------------------------------------------------
 # Получить все листинги пользователя (creator или worker)
 # --------------------------------------------------
+def _load_user_listings(db: Session, user_id: int, projection: Optional[Projection] = None) -> list:
+    if projection is not None:
+        query = projection.query(db)
+    else:
+        query = db.query(models.Listing).options(
+            joinedload(models.Listing.creator), joinedload(models.Listing.worker)
+        )
+    return (
+        query.filter((models.Listing.user_id == user_id) | (models.Listing.worker_id == user_id))
+        .order_by(models.Listing.created_at.desc())
+        .all()
+    )
+
+
 @app.get("/listings/user/{user_id}/", response_model=List[schemas.Listing])
 def get_user_listings(
-    user_id: int, db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)
+    user_id: int,
+    fields: Optional[str] = None,
+    embed: str = "inline",
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
 ):
     current_user_id = int(token_data["sub"])
     if current_user_id != user_id:
@@ -970,15 +1088,10 @@ def get_user_listings(
                 status_code=403, detail="You can only view listings of yourself or your friends"
             )
 
-    listings = (
-        db.query(models.Listing)
-        .filter((models.Listing.user_id == user_id) | (models.Listing.worker_id == user_id))
-        .options(joinedload(models.Listing.creator), joinedload(models.Listing.worker))
-        .order_by(models.Listing.created_at.desc())
-        .all()
-    )
-
-    return listings
+    projection = Projection.from_params(models.Listing, schemas.ListingRef, LISTING_RELATIONS, fields, embed)
+    if projection is not None:
+        return projection.render(db, _load_user_listings(db, user_id, projection))
+    return _load_user_listings(db, user_id)
 
 
 # --------------------------------------------------
@@ -1003,27 +1116,33 @@ def search_users(username: str, db: Session = Depends(get_db), token_data: dict
 # --------------------------------------------------
 # Получить входящие запросы в друзья
 # --------------------------------------------------
-@app.get("/friends/pending/", response_model=List[schemas.Friend])
-def get_pending_friend_requests(db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)):
-    user_id = int(token_data["sub"])
-
-    pending_requests = (
-        db.query(models.Friend)
+def _load_pending_friend_requests(db: Session, user_id: int, projection: Optional[Projection] = None) -> list:
+    return (
+        _friends_query(db, projection)
         .filter((models.Friend.friend_id == user_id) & (models.Friend.status == "pending"))
-        .options(joinedload(models.Friend.user), joinedload(models.Friend.friend))
         .all()
     )
 
-    return pending_requests
+
+@app.get("/friends/pending/", response_model=List[schemas.Friend])
+def get_pending_friend_requests(
+    fields: Optional[str] = None,
+    embed: str = "inline",
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    user_id = int(token_data["sub"])
+    projection = Projection.from_params(models.Friend, schemas.FriendRef, FRIEND_RELATIONS, fields, embed)
+    if projection is not None:
+        return projection.render(db, _load_pending_friend_requests(db, user_id, projection))
+    return _load_pending_friend_requests(db, user_id)
 
 
 # --------------------------------------------------
 # Получить список партнеров по завершённым сделкам
 # --------------------------------------------------
-@app.get("/users/transactions/", response_model=List[schemas.UserProfile])
-def get_transaction_partners(db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)):
-    user_id = int(token_data["sub"])
-    logger.info(f"[GetTransactionPartners] Fetching transaction partners for user_id: {user_id}")
+def _load_transaction_partners(db: Session, user_id: int) -> List[models.User]:
+    logger.info("[GetTransactionPartners] Fetching transaction partners for user_id: %s", user_id)
 
     listings = (
         db.query(models.Listing)
@@ -1033,44 +1152,123 @@ def get_transaction_partners(db: Session = Depends(get_db), token_data: dict = D
         )
         .all()
     )
-    logger.info(f"[GetTransactionPartners] Found {len(listings)} completed listings involving user {user_id}")
+    logger.info("[GetTransactionPartners] Found %s completed listings involving user %s", len(listings), user_id)
 
     partner_ids = set()
     for listing in listings:
         if listing.user_id == user_id and listing.worker_id:
             partner_ids.add(listing.worker_id)
             logger.debug(
-                f"[GetTransactionPartners] Added partner_id {listing.worker_id} "
-                f"(from listing {listing.id}, user was creator)"
+                "[GetTransactionPartners] Added partner_id %s (from listing %s, user was creator)",
+                listing.worker_id,
+                listing.id,
             )
         elif listing.worker_id == user_id and listing.user_id:
             partner_ids.add(listing.user_id)
             logger.debug(
-                f"[GetTransactionPartners] Added partner_id {listing.user_id} "
-                f"(from listing {listing.id}, user was worker)"
+                "[GetTransactionPartners] Added partner_id %s (from listing %s, user was worker)",
+                listing.user_id,
+                listing.id,
             )
 
-    logger.info(f"[GetTransactionPartners] Collected partner_ids: {partner_ids}")
+    logger.info("[GetTransactionPartners] Collected partner_ids: %s", partner_ids)
 
     if not partner_ids:
         logger.info("[GetTransactionPartners] No partner IDs found, returning empty list.")
         return []
 
     partners = db.query(models.User).filter(models.User.id.in_(partner_ids)).all()
-    logger.info(f"[GetTransactionPartners] Fetched {len(partners)} partner user objects from DB.")
+    logger.info("[GetTransactionPartners] Fetched %s partner user objects from DB.", len(partners))
 
-    if partners:
+    if partners and logger.isEnabledFor(logging.DEBUG):
         for p_idx, partner_user in enumerate(partners):
             logger.debug(
-                f"[GetTransactionPartners] Returning partner {p_idx + 1}: ID={partner_user.id}, "
-                f"Username={partner_user.username}"
+                "[GetTransactionPartners] Returning partner %s: ID=%s, Username=%s",
+                p_idx + 1,
+                partner_user.id,
+                partner_user.username,
             )
-    else:
+    elif not partners:
         logger.debug("[GetTransactionPartners] No partner objects to return after DB query.")
 
     return partners
 
 
+@app.get("/users/transactions/", response_model=List[schemas.UserProfile])
+def get_transaction_partners(db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)):
+    user_id = int(token_data["sub"])
+    return _load_transaction_partners(db, user_id)
+
+
+# --------------------------------------------------
+# Дашборд профиля: всё для экрана профиля за один запрос
+# --------------------------------------------------
+def _load_user(db: Session, user_id: int) -> Optional[models.User]:
+    return db.query(models.User).filter(models.User.id == user_id).first()
+
+
+@app.get("/me/dashboard/", response_model=schemas.Dashboard)
+def get_dashboard(response: Response, db: Session = Depends(get_db), token_data: dict = Depends(get_current_user)):
+    """
+    Заменяет пять запросов профиля (/user/me, /friends, /friends/pending,
+    /listings/user/{id}, /users/transactions) одним. Выборки идут одна за другой в сессии
+    запроса (одно соединение и один допуск к БД); профили пользователей собираются в карту
+    users, а списки ссылаются на них по id.
+    """
+    user_id = int(token_data["sub"])
+
+    user = _load_user(db, user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User from token not found")
+    friends = _load_friends(db, user_id)
+    pending_requests = _load_pending_friend_requests(db, user_id)
+    listings = _load_user_listings(db, user_id)
+    partners = _load_transaction_partners(db, user_id)
+
+    users = {user.id: user}
+    for friend in friends + pending_requests:
+        for embedded in (friend.user, friend.friend):
+            if embedded is not None:
+                users.setdefault(embedded.id, embedded)
+    for listing in listings:
+        for embedded in (listing.creator, listing.worker):
+            if embedded is not None:
+                users.setdefault(embedded.id, embedded)
+    for partner in partners:
+        users.setdefault(partner.id, partner)
+
+    response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, proxy-revalidate"
+
+    return schemas.Dashboard(
+        user=schemas.UserProfile.model_validate(user),
+        users={uid: schemas.UserProfile.model_validate(u) for uid, u in users.items()},
+        friends=[schemas.FriendRef.model_validate(f) for f in friends],
+        pending_requests=[schemas.FriendRef.model_validate(f) for f in pending_requests],
+        listings=[schemas.ListingRef.model_validate(l) for l in listings],
+        partner_ids=[p.id for p in partners],
+    )
+
+
+# --------------------------------------------------
+# Дельта-синхронизация: что изменилось после seq
+# --------------------------------------------------
+@app.get("/sync/", response_model=schemas.SyncResponse)
+def sync_changes(
+    since: Optional[int] = Query(None, ge=0),
+    limit: int = Query(sync.DEFAULT_SYNC_LIMIT, ge=1, le=5000),
+    db: Session = Depends(get_db),
+    token_data: dict = Depends(get_current_user),
+):
+    """
+    Без since возвращает только текущий seq — клиент загружает списки целиком и дальше
+    запрашивает /sync/?since=<seq>. Изменённые строки приходят без вложенных профилей,
+    удалённые — списком id в deleted.
+    """
+    if since is None:
+        return sync.cursor_response(db)
+    return sync.collect_changes(db, int(token_data["sub"]), since, limit)
+
+
 # --------------------------------------------------
 # Отладочный POST для создания тестового пользователя и получения токенов
 # --------------------------------------------------
@@ -1081,57 +1279,57 @@ async def debug_auth_post(request: Request, response: Response, db: Session = De
     Работает только в режиме разработки (IS_DEVELOPMENT=True).
     """
     if not IS_DEVELOPMENT:
-        logger.warning("Debug auth POST requested but server is in production mode - rejecting")
+        auth_logger.warning("Debug auth POST requested but server is in production mode - rejecting")
         raise HTTPException(status_code=403, detail="Debug endpoints are not allowed in production")
 
-    logger.warning("\n\n" + "*" * 80)
-    logger.warning("=== Starting Debug Auth POST ===")
-    logger.warning("*" * 80)
+    auth_logger.warning("\n\n" + "*" * 80)
+    auth_logger.warning("=== Starting Debug Auth POST ===")
+    auth_logger.warning("*" * 80)
 
     body_str = None
     data = None
 
     try:
-        logger.debug("Attempting to read request body for /debug/auth POST...")
+        auth_logger.debug("Attempting to read request body for /debug/auth POST...")
         body_bytes = await asyncio.wait_for(request.body(), timeout=10.0)
 
         if not body_bytes:
-            logger.error("Request body is empty for /debug/auth POST")
+            auth_logger.error("Request body is empty for /debug/auth POST")
             raise HTTPException(status_code=400, detail="Request body is empty for debug auth")
 
         body_str = body_bytes.decode("utf-8")
-        logger.info(f"Successfully read body for /debug/auth POST, length: {len(body_str)}")
-        logger.debug(f"Raw request body for /debug/auth POST: {body_str[:500]}...")
+        auth_logger.info(f"Successfully read body for /debug/auth POST, length: {len(body_str)}")
+        auth_logger.debug("Raw request body for /debug/auth POST: %s...", body_str[:500])
 
         data = json.loads(body_str)
-        logger.debug(f"Parsed JSON data for /debug/auth POST: {data}")
+        auth_logger.debug("Parsed JSON data for /debug/auth POST: %s", data)
 
     except asyncio.TimeoutError:
-        logger.error("Timeout (10s) reading request body for /debug/auth POST")
+        auth_logger.error("Timeout (10s) reading request body for /debug/auth POST")
         raise HTTPException(status_code=408, detail="Request timeout reading body for debug auth")
     except ClientDisconnect:
-        logger.error("ClientDisconnect while reading request body for /debug/auth POST")
+        auth_logger.error("ClientDisconnect while reading request body for /debug/auth POST")
         raise HTTPException(status_code=400, detail="Client disconnected during debug auth request")
     except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error for /debug/auth POST: {str(e)}. Body was: {body_str[:200]}...")
+        auth_logger.error(f"JSON decode error for /debug/auth POST: {str(e)}. Body was: {body_str[:200]}...")
         raise HTTPException(status_code=400, detail=f"Invalid JSON body for debug auth: {str(e)}")
     except Exception as e:
-        logger.error(f"Error processing request body for /debug/auth POST: {str(e)}", exc_info=True)
+        auth_logger.error(f"Error processing request body for /debug/auth POST: {str(e)}", exc_info=True)
         raise HTTPException(status_code=400, detail=f"Invalid request body for debug auth: {str(e)}")
 
     if not data or "telegram_id" not in data or "username" not in data:
-        logger.error(f"Missing telegram_id or username in parsed data for /debug/auth: {data}")
+        auth_logger.error(f"Missing telegram_id or username in parsed data for /debug/auth: {data}")
         raise HTTPException(status_code=400, detail="telegram_id and username are required in JSON body for debug auth")
 
     telegram_id = data["telegram_id"]
     username = data["username"]
 
-    logger.warning(f"Creating/fetching test user for /debug/auth: telegram_id={telegram_id}, username={username}")
+    auth_logger.warning(f"Creating/fetching test user for /debug/auth: telegram_id={telegram_id}, username={username}")
 
     user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
 
     if not user:
-        logger.warning(f"User {telegram_id} not found, creating new user")
+        auth_logger.warning(f"User {telegram_id} not found, creating new user")
         user = models.User(
             telegram_id=telegram_id,
             username=username,
@@ -1143,20 +1341,7 @@ async def debug_auth_post(request: Request, response: Response, db: Session = De
         db.commit()
         db.refresh(user)
     else:
-        logger.warning(f"User {telegram_id} found in database, using existing user")
-
-    access_token = create_access_token(
-        data={"sub": str(user.id), "telegram_id": user.telegram_id, "type": "access"}
-    )
-    refresh_token_val = create_access_token(
-        {
-            "sub": str(user.id),
-            "telegram_id": str(user.telegram_id),
-            "username": user.username,
-            "type": "refresh",
-            "exp": datetime.utcnow() + timedelta(days=7),
-        }
-    )
+        auth_logger.warning(f"User {telegram_id} found in database, using existing user")
 
     response = JSONResponse(
         content={
@@ -1170,19 +1355,7 @@ async def debug_auth_post(request: Request, response: Response, db: Session = De
             "test_mode": True,
         }
     )
-
-    cookie_options = {"httponly": True, "secure": True, "samesite": "none", "path": "/"}
-
-    response.set_cookie(
-        key="access_token",
-        value=access_token,
-        max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-        **cookie_options,
-    )
-
-    response.set_cookie(
-        key="refresh_token", value=refresh_token_val, max_age=60 * 60 * 24 * 7, **cookie_options
-    )
+    sessions.issue_tokens(db, response, user)
 
     return response
 
@@ -1198,12 +1371,12 @@ async def debug_auth(request: Request, db: Session = Depends(get_db)):
     Работает только в режиме разработки.
     """
     if not IS_DEVELOPMENT:
-        logger.warning("Debug auth endpoint requested but server is in production mode - rejecting")
+        auth_logger.warning("Debug auth endpoint requested but server is in production mode - rejecting")
         raise HTTPException(status_code=403, detail="Debug endpoints are not allowed in production")
 
-    logger.info("\n\n" + "*" * 80)
-    logger.info("=== Starting Auth Debug ===")
-    logger.info("*" * 80)
+    auth_logger.info("\n\n" + "*" * 80)
+    auth_logger.info("=== Starting Auth Debug ===")
+    auth_logger.info("*" * 80)
 
     headers = dict(request.headers)
     cookies = request.cookies
@@ -1245,7 +1418,7 @@ async def debug_auth(request: Request, db: Session = Depends(get_db)):
 
     fs_info = {
         "uploads_dir_exists": os.path.exists(BASE_DIR.parent / "uploads"),
-        "logs_dir_exists": os.path.exists(BASE_DIR.parent / "logs"),
+        "logs_dir_exists": LOG_DIR.exists(),
         "db_file_exists": os.path.exists(BASE_DIR.parent / "time_banking.db"),
         "db_file_size": os.path.getsize(BASE_DIR.parent / "time_banking.db")
         if os.path.exists(BASE_DIR.parent / "time_banking.db")
@@ -1268,9 +1441,9 @@ async def debug_auth(request: Request, db: Session = Depends(get_db)):
 
                 try:
                     verification_result = verify_telegram_hash(init_data, hash_value)
-                    logger.info(f"Hash verification result: {verification_result}")
+                    auth_logger.info(f"Hash verification result: {verification_result}")
                 except Exception as e:
-                    logger.error(f"Hash verification error: {str(e)}")
+                    auth_logger.error(f"Hash verification error: {str(e)}")
             else:
                 telegram_debug["hash_missing"] = True
 
@@ -1304,9 +1477,9 @@ async def debug_auth(request: Request, db: Session = Depends(get_db)):
         "telegram_debug": telegram_debug,
     }
 
-    logger.info(f"Auth debug complete: {debug_info}")
-    logger.info("=== Auth Debug Completed ===")
-    logger.info("*" * 80 + "\n\n")
+    auth_logger.info(f"Auth debug complete: {debug_info}")
+    auth_logger.info("=== Auth Debug Completed ===")
+    auth_logger.info("*" * 80 + "\n\n")
 
     return debug_info
 
@@ -1315,72 +1488,168 @@ async def debug_auth(request: Request, db: Session = Depends(get_db)):
 # Просмотр логов (admin)
 # --------------------------------------------------
 @app.get("/admin/logs/{log_name}/")
-async def view_logs(
-    log_name: str, lines: int = Query(100, ge=1, le=1000), db: Session = Depends(get_current_user)
+def view_logs(
+    log_name: str,
+    lines: int = Query(100, ge=1, le=1000),
+    request_id: Optional[str] = None,
+    since: Optional[str] = None,
+    level: Optional[str] = None,
+    q: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    token_data: dict = Depends(get_current_user),
 ):
     """
-    Просмотр логов приложения (debug, error, auth, requests).
+    Просмотр логов приложения (debug, error, auth, requests, traces, slow).
+
+    Без фильтров — последние lines строк текущего файла. С фильтрами (request_id, since,
+    level — минимальный уровень, q — подстрока) — поиск по всем сегментам, включая
+    ротированные; записи отдаются потоком NDJSON от старых к новым, не больше limit.
     """
-    valid_logs = ["debug", "error", "auth", "requests"]
+    valid_logs = ["debug", "error", "auth", "requests", "traces", "slow"]
     if log_name not in valid_logs:
         raise HTTPException(status_code=400, detail=f"Invalid log name. Available logs: {', '.join(valid_logs)}")
+    if level is not None:
+        level = level.upper()
+        if level not in logsearch.LEVELS:
+            raise HTTPException(status_code=400, detail=f"Invalid level. Available: {', '.join(logsearch.LEVELS)}")
+
+    if request_id or since or level or q:
+        records = logsearch.search(log_name, request_id=request_id, since=since, level=level, contains=q, limit=limit)
+        return StreamingResponse(
+            (json.dumps(record, ensure_ascii=False) + "\n" for record in records),
+            media_type="application/x-ndjson",
+        )
 
-    log_path = BASE_DIR.parent / "logs" / f"{log_name}.log"
+    log_path = LOG_DIR / f"{log_name}.log"
     if not os.path.exists(log_path):
         return {"status": "empty", "message": f"Log file {log_name}.log does not exist yet"}
 
     try:
-        result = []
-        with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-            try:
-                f.seek(0, os.SEEK_END)
-                file_size = f.tell()
-                if file_size == 0:
-                    return {"status": "empty", "message": f"Log file {log_name}.log is empty"}
-
-                bytes_to_read = min(8192, file_size)
-                lines_found = 0
-                chunks = []
-
-                while lines_found < lines and bytes_to_read <= file_size:
-                    f.seek(-bytes_to_read, os.SEEK_END)
-                    chunk = f.read(bytes_to_read)
-                    lines_in_chunk = chunk.count("\n")
-
-                    if lines_in_chunk >= lines:
-                        chunks.append(chunk)
-                        break
-                    else:
-                        chunks.append(chunk)
-                        lines_found += lines_in_chunk
-                        bytes_to_read *= 2
-                        if bytes_to_read > file_size:
-                            f.seek(0)
-                            chunks = [f.read()]
-                            break
-
-                content = "".join(chunks)
-                all_lines = content.split("\n")
-                result = all_lines[-lines - 1 :] if all_lines[-1] else all_lines[-lines - 2 :]
-            except Exception as e:
-                logger.error(f"Error reading log file {log_name}.log: {str(e)}")
-                f.seek(0)
-                result = f.readlines()[-lines:]
-
-        return {
-            "status": "success",
-            "log_name": log_name,
-            "lines_count": len(result),
-            "content": result,
-        }
-    except Exception as e:
-        logger.error(f"Error retrieving logs: {str(e)}")
+        result = logsearch.tail(log_name, lines)
+    except OSError as e:
+        logger.error("Error retrieving logs: %s", e)
         raise HTTPException(status_code=500, detail=f"Error retrieving logs: {str(e)}")
+    if not result:
+        return {"status": "empty", "message": f"Log file {log_name}.log is empty"}
+
+    return {
+        "status": "success",
+        "log_name": log_name,
+        "lines_count": len(result),
+        "content": result,
+    }
+
+
+# --------------------------------------------------
+# Профили (admin)
+# --------------------------------------------------
+def require_profiler_admin(x_profiler_signature: Optional[str] = Header(None)) -> None:
+    """
+    Профили — стеки всех воркеров, поэтому входа через Telegram мало: нужна подпись
+    PROFILER_SECRET, та же, что в X-Profile (python -m backend.profiler sign), в X-Profiler-Signature.
+    """
+    if not profiler.PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler is disabled")
+    if not x_profiler_signature or not profiler.verify_signature(x_profiler_signature):
+        raise HTTPException(status_code=403, detail="Profiler signature required")
+
+
+@app.post("/admin/profiles/", dependencies=[Depends(require_profiler_admin)])
+def start_profile_sampling(
+    seconds: int = Query(10, ge=1, le=profiler.MAX_GLOBAL_SECONDS),
+    token_data: dict = Depends(get_current_user),
+):
+    """
+    Запускает сэмплирование всех воркеров на seconds секунд. Каждый воркер пишет свой
+    файл sampling-<id>-<pid>.speedscope.json в logs/profiles/.
+    """
+    trigger = profiler.request_global_sampling(seconds)
+    logger.info("User %s requested %ss sampling profile %s", token_data.get("sub"), seconds, trigger["id"])
+    return {"status": "scheduled", "id": trigger["id"], "seconds": seconds}
+
+
+@app.get("/admin/profiles/", dependencies=[Depends(require_profiler_admin)])
+def list_profiles(token_data: dict = Depends(get_current_user)):
+    """Список сохранённых профилей (новые первыми)."""
+    return profiler.list_profiles()
+
+
+@app.get("/admin/profiles/{name}", dependencies=[Depends(require_profiler_admin)])
+def download_profile(name: str, token_data: dict = Depends(get_current_user)):
+    """Файл профиля; открывается в https://www.speedscope.app."""
+    path = profiler.profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json", filename=name)
 
 
 # --------------------------------------------------
 # Аутентификация через Telegram WebApp
 # --------------------------------------------------
+def _upsert_telegram_user(db: Session, telegram_id: int, user_info: dict) -> models.User:
+    """
+    Новый пользователь создаётся, у существующего переписываются только изменившиеся
+    username/avatar (пустые значения из Telegram ничего не затирают); если менять нечего,
+    пользователь читается по индексу telegram_id — без записи.
+
+    PostgreSQL: один INSERT ... ON CONFLICT (telegram_id) DO UPDATE ... WHERE ... IS DISTINCT FROM
+    ... RETURNING, вставку от обновления отличает xmax = 0. SQLite так отличить не может, поэтому
+    INSERT ... ON CONFLICT DO NOTHING RETURNING и, только если строка уже была, такой же условный
+    UPDATE ... RETURNING. В обоих случаях «создан» решает сама запись, а не чтение перед ней.
+
+    Запись идёт мимо flush, поэтому счётчик пользователей и журнал изменений для /sync/
+    обновляются здесь же, в той же транзакции. Коммит — за вызывающим (sessions.issue_tokens).
+    """
+    is_postgres = db.get_bind().dialect.name == "postgresql"
+    dialect = postgresql if is_postgres else sqlite
+    table = models.User.__table__
+    username, avatar = user_info.get("username"), user_info.get("photo_url")
+    # created_at — по умолчанию колонки (server_default)
+    stmt = dialect.insert(models.User).values(
+        telegram_id=telegram_id,
+        username=username or user_info.get("first_name") or f"user_{telegram_id}",
+        avatar=avatar,
+        balance=5.0,
+        earned_hours=0.0,
+        spent_hours=0.0,
+    )
+    updates = {"username": username, "avatar": avatar}
+    updates = {name: value for name, value in updates.items() if value}
+    changed = or_(*(table.c[name].is_distinct_from(value) for name, value in updates.items()))
+    execution_options = {"populate_existing": True}
+
+    if is_postgres and updates:
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.telegram_id], set_=updates, where=changed)
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[table.c.telegram_id])
+    # xmax = 0 только у строки, которую эта команда вставила, а не обновила
+    inserted_column = literal_column("xmax = 0", Boolean) if is_postgres else literal(True, Boolean)
+    row = db.execute(stmt.returning(models.User, inserted_column), execution_options=execution_options).one_or_none()
+
+    if row is None and not is_postgres and updates:
+        update_stmt = (
+            update(models.User)
+            .where(table.c.telegram_id == telegram_id, changed)
+            .values(**updates)
+            .returning(models.User, literal(False, Boolean))
+        )
+        row = db.execute(
+            update_stmt, execution_options={**execution_options, "synchronize_session": False}
+        ).one_or_none()
+    if row is None:
+        return db.query(models.User).filter(models.User.telegram_id == telegram_id).one()
+
+    user, inserted = row
+    connection = db.connection()
+    if inserted:
+        counters.apply_deltas(connection, {counters.USERS: 1})
+    sync.record_change(connection, "users", user.id)
+    auth_logger.info(
+        "%s user %s (ID: %s, Telegram ID: %s)", "Created" if inserted else "Updated", user.username, user.id, telegram_id
+    )
+    return user
+
+
 @app.get("/auth/telegram/")
 @app.post("/auth/telegram/")
 async def telegram_auth(
@@ -1391,15 +1660,16 @@ async def telegram_auth(
     import urllib.parse
 
     try:
-        logger.info("\n\n" + "*" * 80)
-        logger.info("=== Starting Telegram Authentication ===")
-        logger.info("*" * 80)
+        auth_logger.info("\n\n" + "*" * 80)
+        auth_logger.info("=== Starting Telegram Authentication ===")
+        auth_logger.info("*" * 80)
 
-        logger.debug("Request headers:")
-        for header, value in request.headers.items():
-            logger.debug(f"  {header}: {value}")
+        if auth_logger.isEnabledFor(logging.DEBUG):
+            auth_logger.debug("Request headers:")
+            for header, value in request.headers.items():
+                auth_logger.debug("  %s: %s", header, value)
 
-        logger.debug(f"Request method: {request.method}")
+        auth_logger.debug("Request method: %s", request.method)
 
         raw_init_data = None
         test_mode = False
@@ -1407,35 +1677,35 @@ async def telegram_auth(
         if request.method == "GET":
             if "init_data" in request.query_params:
                 raw_init_data = request.query_params.get("init_data", "")
-                logger.debug("Got init_data from query params (GET)")
+                auth_logger.debug("Got init_data from query params (GET)")
         else:
             raw_init_data = None
             body_str = None
 
-            logger.debug("POST request to /auth/telegram. Processing body...")
+            auth_logger.debug("POST request to /auth/telegram. Processing body...")
             try:
-                logger.debug("Attempt 1: Reading entire request body for POST with timeout...")
+                auth_logger.debug("Attempt 1: Reading entire request body for POST with timeout...")
                 body_bytes = await asyncio.wait_for(request.body(), timeout=10.0)
 
                 if body_bytes:
                     body_str = body_bytes.decode("utf-8")
-                    logger.info(f"Successfully read entire body (POST), length: {len(body_str)}")
-                    logger.debug(f"Raw request body (POST): {body_str[:500]}...")
+                    auth_logger.info(f"Successfully read entire body (POST), length: {len(body_str)}")
+                    auth_logger.debug("Raw request body (POST): %s...", body_str[:500])
 
                     try:
                         json_data = json.loads(body_str)
-                        logger.debug(f"Parsed JSON data: {json_data}")
+                        auth_logger.debug("Parsed JSON data: %s", json_data)
 
                         if "init_data" in json_data:
                             raw_init_data = json_data.get("init_data")
                             test_mode = json_data.get("test_mode", False)
-                            logger.info(f"Got init_data from JSON body (POST), test_mode={test_mode}")
+                            auth_logger.info(f"Got init_data from JSON body (POST), test_mode={test_mode}")
 
                             # Обработка тестового режима
                             if test_mode:
-                                logger.warning("Test mode detected in /auth/telegram! Creating test user...")
+                                auth_logger.warning("Test mode detected in /auth/telegram! Creating test user...")
                                 if not IS_DEVELOPMENT:
-                                    logger.error(
+                                    auth_logger.error(
                                         "Test mode for /auth/telegram requested but server is in production mode - rejecting"
                                     )
                                     raise HTTPException(
@@ -1445,7 +1715,7 @@ async def telegram_auth(
 
                                 test_user = db.query(models.User).filter(models.User.telegram_id == 12345).first()
                                 if not test_user:
-                                    logger.info("Creating test user with id 12345 for /auth/telegram")
+                                    auth_logger.info("Creating test user with id 12345 for /auth/telegram")
                                     test_user = models.User(
                                         telegram_id=12345,
                                         username="test_user",
@@ -1457,49 +1727,27 @@ async def telegram_auth(
                                     db.commit()
                                     db.refresh(test_user)
                                 else:
-                                    logger.info("Found existing test user for /auth/telegram")
-
-                                access_token = create_access_token(
-                                    {"sub": str(test_user.id), "telegram_id": str(test_user.telegram_id), "username": test_user.username, "type": "access"}
-                                )
-                                refresh_token_val = create_access_token(
-                                    {
-                                        "sub": str(test_user.id),
-                                        "telegram_id": str(test_user.telegram_id),
-                                        "username": test_user.username,
-                                        "type": "refresh",
-                                        "exp": datetime.utcnow() + timedelta(days=7),
-                                    }
-                                )
-
-                                cookie_options = {"httponly": True, "secure": True, "samesite": "none", "path": "/"}
-                                response.set_cookie(
-                                    key="access_token",
-                                    value=access_token,
-                                    max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-                                    **cookie_options,
-                                )
-                                response.set_cookie(
-                                    key="refresh_token", value=refresh_token_val, max_age=60 * 60 * 24 * 7, **cookie_options
-                                )
-
-                                logger.info("Returning test user data and token in cookies for /auth/telegram (test_mode=true)")
+                                    auth_logger.info("Found existing test user for /auth/telegram")
+
+                                sessions.issue_tokens(db, response, test_user)
+
+                                auth_logger.info("Returning test user data and token in cookies for /auth/telegram (test_mode=true)")
                                 return {"success": True, "user": test_user, "test_mode": True}
 
                     except json.JSONDecodeError:
-                        logger.warning(f"Body (POST) was not valid JSON. Content starts with: {body_str[:200]}...")
+                        auth_logger.warning(f"Body (POST) was not valid JSON. Content starts with: {body_str[:200]}...")
                 else:
-                    logger.warning("Attempt 1: Request body (POST) was empty after reading.")
+                    auth_logger.warning("Attempt 1: Request body (POST) was empty after reading.")
 
             except asyncio.TimeoutError:
-                logger.error("Attempt 1: Timeout (10s) reading request body (POST).")
+                auth_logger.error("Attempt 1: Timeout (10s) reading request body (POST).")
             except ClientDisconnect:
-                logger.error("Attempt 1: ClientDisconnect while reading request body (POST).")
+                auth_logger.error("Attempt 1: ClientDisconnect while reading request body (POST).")
             except Exception as e:
-                logger.error(f"Attempt 1: Error reading request body (POST): {str(e)}", exc_info=True)
+                auth_logger.error(f"Attempt 1: Error reading request body (POST): {str(e)}", exc_info=True)
 
             if not raw_init_data:
-                logger.info("Attempt 2: init_data not found in JSON body or body read failed/was not JSON. Trying to read as form data...")
+                auth_logger.info("Attempt 2: init_data not found in JSON body or body read failed/was not JSON. Trying to read as form data...")
                 try:
                     form_data = await asyncio.wait_for(request.form(), timeout=5.0)
                     if "init_data" in form_data:
@@ -1507,35 +1755,35 @@ async def telegram_auth(
                         test_mode_form = str(form_data.get("test_mode", "false")).lower() == "true"
                         if test_mode_form and not test_mode:
                             test_mode = True
-                        logger.info(f"Got init_data from form data (POST), test_mode from form: {test_mode}")
+                        auth_logger.info(f"Got init_data from form data (POST), test_mode from form: {test_mode}")
                     elif form_data:
-                        logger.warning(f"Attempt 2: init_data not in form data. Form fields: {list(form_data.keys())}")
+                        auth_logger.warning(f"Attempt 2: init_data not in form data. Form fields: {list(form_data.keys())}")
                     else:
-                        logger.warning("Attempt 2: Form data (POST) is empty.")
+                        auth_logger.warning("Attempt 2: Form data (POST) is empty.")
                 except asyncio.TimeoutError:
-                    logger.error("Attempt 2: Timeout (5s) reading form data (POST).")
+                    auth_logger.error("Attempt 2: Timeout (5s) reading form data (POST).")
                 except ClientDisconnect:
-                    logger.error("Attempt 2: ClientDisconnect while reading form data (POST).")
+                    auth_logger.error("Attempt 2: ClientDisconnect while reading form data (POST).")
                 except Exception as form_error:
-                    logger.error(f"Attempt 2: Error reading form data (POST): {str(form_error)}", exc_info=True)
+                    auth_logger.error(f"Attempt 2: Error reading form data (POST): {str(form_error)}", exc_info=True)
 
         if not raw_init_data:
-            logger.error("No init_data found in request")
+            auth_logger.error("No init_data found in request")
             raise HTTPException(status_code=400, detail="Missing init_data parameter")
 
-        logger.debug(f"Raw init_data: {raw_init_data}")
+        auth_logger.debug("Raw init_data: %s", raw_init_data)
 
         # Тестовый режим: сразу выдаём токены и пользователя
         if test_mode:
             if not IS_DEVELOPMENT:
-                logger.warning("Test mode requested but server is in production mode - rejecting")
+                auth_logger.warning("Test mode requested but server is in production mode - rejecting")
                 raise HTTPException(status_code=403, detail="Test mode is not allowed in production")
 
-            logger.warning("Test mode active - bypassing hash verification")
+            auth_logger.warning("Test mode active - bypassing hash verification")
             try:
                 test_user = db.query(models.User).filter(models.User.telegram_id == 12345).first()
                 if not test_user:
-                    logger.info("Creating test user with id 12345")
+                    auth_logger.info("Creating test user with id 12345")
                     test_user = models.User(
                         telegram_id=12345,
                         username="test_user",
@@ -1547,423 +1795,222 @@ async def telegram_auth(
                     db.commit()
                     db.refresh(test_user)
                 else:
-                    logger.info("Found existing test user for /auth/telegram")
-
-                access_token = create_access_token(
-                    {"sub": str(test_user.id), "telegram_id": str(test_user.telegram_id), "username": test_user.username, "type": "access"}
-                )
-                refresh_token = create_access_token(
-                    {
-                        "sub": str(test_user.id),
-                        "telegram_id": str(test_user.telegram_id),
-                        "username": test_user.username,
-                        "type": "refresh",
-                        "exp": datetime.utcnow() + timedelta(days=7),
-                    }
-                )
+                    auth_logger.info("Found existing test user for /auth/telegram")
 
-                cookie_options = {"httponly": True, "secure": True, "samesite": "none", "path": "/"}
-                response.set_cookie(
-                    key="access_token", value=access_token, max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60, **cookie_options
-                )
-                response.set_cookie(
-                    key="refresh_token", value=refresh_token, max_age=60 * 60 * 24 * 7, **cookie_options
-                )
+                sessions.issue_tokens(db, response, test_user)
 
-                logger.info("Returning test user data and token in cookies")
+                auth_logger.info("Returning test user data and token in cookies")
                 return {"success": True, "user": test_user, "test_mode": True}
             except Exception as test_error:
-                logger.error(f"Error in test mode: {str(test_error)}")
-                logger.exception(test_error)
+                auth_logger.error(f"Error in test mode: {str(test_error)}")
+                auth_logger.exception(test_error)
                 raise HTTPException(status_code=500, detail="Error in test mode")
 
         # ---------------------------------------------
         # Проверяем, что в raw_init_data есть "hash="
         # ---------------------------------------------
         if "hash=" not in raw_init_data:
-            logger.error("No hash parameter found in init_data")
+            auth_logger.error("No hash parameter found in init_data")
             raise HTTPException(status_code=400, detail="No hash provided")
 
         pairs = [s.split("=", 1) for s in raw_init_data.split("&") if "=" in s]
         data = {k: v for k, v in pairs}
 
-        logger.debug(f"Parsed data parameters count: {len(data)}")
-        for key in data:
-            if key not in ["hash", "user"]:
-                logger.debug(f"  {key}: {data[key]}")
-            else:
-                logger.debug(f"  {key}: [hidden for security]")
+        if auth_logger.isEnabledFor(logging.DEBUG):
+            auth_logger.debug("Parsed data parameters count: %s", len(data))
+            for key in data:
+                if key not in ["hash", "user"]:
+                    auth_logger.debug("  %s: %s", key, data[key])
+                else:
+                    auth_logger.debug("  %s: [hidden for security]", key)
 
         hash_value = data.get("hash")
         if not hash_value:
-            logger.error("No hash parameter found in parsed data")
+            auth_logger.error("No hash parameter found in parsed data")
             raise HTTPException(status_code=400, detail="No hash provided")
 
-        logger.debug(f"Extracted hash value length: {len(hash_value) if hash_value else 0}")
+        auth_logger.debug("Extracted hash value length: %s", len(hash_value) if hash_value else 0)
+
+        # ---------------------------------------------
+        # Свежесть auth_date и повтор недавнего входа
+        # ---------------------------------------------
+        check_auth_date(data)
+
+        recent = recent_logins.get(hash_value, raw_init_data)
+        if recent is not None and not sessions.is_current(db, recent["jti"]):
+            # Семейство сменили или отозвали в другом воркере — обычный вход
+            recent_logins.discard_family(recent["family_id"])
+            recent = None
+        if recent is not None:
+            auth_logger.info("Repeated init_data, returning tokens issued %.0fs ago", time.monotonic() - recent["issued_at"])
+            sessions.set_token_cookies(response, recent["access_token"], recent["refresh_token"])
+            return {"success": True, "user": recent["user"]}
 
         # ---------------------------------------------
         # Верифицируем hash через auth.verify_telegram_hash
         # ---------------------------------------------
-        logger.info("Verifying Telegram hash...")
+        auth_logger.info("Verifying Telegram hash...")
         hash_verified = verify_telegram_hash(raw_init_data, hash_value)
 
         if not hash_verified:
-            logger.warning("Hash verification failed")
+            auth_logger.warning("Hash verification failed")
             raise HTTPException(status_code=401, detail="Invalid hash")
         else:
-            logger.info("Hash verification successful")
+            auth_logger.info("Hash verification successful")
 
         # ---------------------------------------------
         # Извлекаем user_info из data["user"]
         # ---------------------------------------------
         try:
-            logger.info("Parsing user data...")
+            auth_logger.info("Parsing user data...")
             user_data = data.get("user", "")
-            logger.debug(f"Raw user data length: {len(user_data) if user_data else 0}")
+            auth_logger.debug("Raw user data length: %s", len(user_data) if user_data else 0)
 
             if not user_data:
-                logger.error("No user data found in init_data")
+                auth_logger.error("No user data found in init_data")
                 raise HTTPException(status_code=400, detail="Missing user data in init_data")
             else:
                 user_json = urllib.parse.unquote(user_data)
-                logger.debug(f"URL-decoded user data length: {len(user_json)}")
+                auth_logger.debug("URL-decoded user data length: %s", len(user_json))
                 try:
                     user_info = json.loads(user_json)
-                    logger.debug(f"Parsed user_info: ID={user_info.get('id')}, username={user_info.get('username')}")
+                    auth_logger.debug("Parsed user_info: ID=%s, username=%s", user_info.get('id'), user_info.get('username'))
                 except Exception as e:
-                    logger.error(f"Error parsing user JSON: {str(e)}")
+                    auth_logger.error(f"Error parsing user JSON: {str(e)}")
                     user_json = user_json.replace("'", '"')
-                    logger.debug(f"Cleaned user JSON length: {len(user_json)}")
+                    auth_logger.debug("Cleaned user JSON length: %s", len(user_json))
                     user_info = json.loads(user_json)
-                    logger.debug(f"Parsed user_info after cleaning: ID={user_info.get('id')}, username={user_info.get('username')}")
+                    auth_logger.debug("Parsed user_info after cleaning: ID=%s, username=%s", user_info.get('id'), user_info.get('username'))
 
             try:
                 telegram_id = int(user_info.get("id"))
-                logger.debug(f"Converted telegram_id to int: {telegram_id} (type: {type(telegram_id)})")
+                auth_logger.debug("Converted telegram_id to int: %s (type: %s)", telegram_id, type(telegram_id))
             except (TypeError, ValueError) as e:
-                logger.error(f"Error converting telegram_id to int: {str(e)}")
+                auth_logger.error(f"Error converting telegram_id to int: {str(e)}")
                 raise HTTPException(status_code=400, detail="Invalid user ID in data")
 
             if not telegram_id:
-                logger.error("No valid telegram_id found in user_info")
+                auth_logger.error("No valid telegram_id found in user_info")
                 raise HTTPException(status_code=400, detail="Missing user ID in data")
         except Exception as e:
-            logger.error(f"Error parsing user data: {str(e)}", exc_info=True)
+            auth_logger.error(f"Error parsing user data: {str(e)}", exc_info=True)
             raise HTTPException(status_code=400, detail=f"Invalid user data format: {str(e)}")
 
         # ---------------------------------------------
         # Ищем или создаём пользователя в БД
         # ---------------------------------------------
-        try:
-            logger.info(f"Looking up user with telegram_id: {telegram_id}")
-            user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
-
-            if not user:
-                logger.info(f"Creating new user with telegram_id: {telegram_id}")
-                username = user_info.get("username") or user_info.get("first_name") or f"user_{telegram_id}"
-                logger.debug(f"Using username: {username}")
-
-                try:
-                    user = models.User(
-                        telegram_id=telegram_id,
-                        username=username,
-                        avatar=user_info.get("photo_url"),
-                        balance=5.0,
-                        earned_hours=0.0,
-                        spent_hours=0.0,
-                    )
-                    db.add(user)
-                    db.commit()
-                    db.refresh(user)
-                    logger.info(
-                        f"New user created: {user.username} "
-                        f"(ID: {user.id}, Telegram ID: {user.telegram_id})"
-                    )
-                except IntegrityError:
-                    logger.warning("Concurrent user creation detected. Rolling back and retrying query.")
-                    db.rollback()
-                    user = db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
-                    if not user:
-                        logger.error("Failed to find or create user after integrity error")
-                        raise HTTPException(status_code=500, detail="User creation failed")
-                    logger.info(
-                        f"Found user after concurrent creation: {user.username} "
-                        f"(ID: {user.id}, Telegram ID: {user.telegram_id})"
-                    )
-            else:
-                logger.info(f"Found existing user: {user.username} (ID: {user.id}, Telegram ID: {user.telegram_id})")
-                changes_made = False
-
-                if user_info.get("username") and user_info.get("username") != user.username:
-                    old_username = user.username
-                    user.username = user_info.get("username")
-                    changes_made = True
-                    logger.info(f"Updated username from {old_username} to: {user.username}")
-
-                if user_info.get("photo_url") and user_info.get("photo_url") != user.avatar:
-                    user.avatar = user_info.get("photo_url")
-                    changes_made = True
-                    logger.info(f"Updated avatar URL to: {user.avatar}")
-
-                if changes_made:
-                    try:
-                        db.commit()
-                    except IntegrityError:
-                        logger.warning("Integrity error during user update, rolling back")
-                        db.rollback()
-
-        except Exception as e:
-            logger.error(f"Database error: {str(e)}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error")
+        with tracing.span("telegram_auth.upsert_user"):
+            try:
+                user = _upsert_telegram_user(db, telegram_id, user_info)
+            except Exception as e:
+                auth_logger.error(f"Database error: {str(e)}", exc_info=True)
+                raise HTTPException(status_code=500, detail="Database error")
 
         # ---------------------------------------------
         # Создаем JWT-токены (access + refresh)
         # ---------------------------------------------
-        try:
-            logger.info(f"Creating JWT tokens for user: {user.username}")
-            access_token_data = {
-                "sub": str(user.id),
-                "telegram_id": str(telegram_id),
-                "username": user.username,
-                "type": "access",
-            }
-            access_token = create_access_token(access_token_data)
-
-            refresh_token_data = {
-                "sub": str(user.id),
-                "telegram_id": str(telegram_id),
-                "username": user.username,
-                "type": "refresh",
-                "exp": datetime.utcnow() + timedelta(days=7),
-            }
-            refresh_token = create_access_token(refresh_token_data)
-
-            cookie_options = {"httponly": True, "secure": True, "samesite": "none", "path": "/"}
-
-            response.set_cookie(
-                key="access_token",
-                value=access_token,
-                max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-                **cookie_options,
-            )
-
-            response.set_cookie(
-                key="refresh_token", value=refresh_token, max_age=60 * 60 * 24 * 7, **cookie_options
-            )
-        except Exception as e:
-            logger.error(f"Error creating tokens: {str(e)}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Error creating authentication tokens")
+        with tracing.span("telegram_auth.issue_tokens"):
+            try:
+                auth_logger.info("Creating JWT tokens for user: %s", user.username)
+                access_token, refresh_token, family_id, jti = sessions.issue_tokens(db, response, user)
+                recent_logins.put(
+                    hash_value, raw_init_data, family_id, jti, access_token, refresh_token, jsonable_encoder(user)
+                )
+            except Exception as e:
+                auth_logger.error(f"Error creating tokens: {str(e)}", exc_info=True)
+                raise HTTPException(status_code=500, detail="Error creating authentication tokens")
 
-        logger.info("=== Authentication Successful ===")
-        logger.info("*" * 80 + "\n\n")
+        auth_logger.info("=== Authentication Successful ===")
+        auth_logger.info("*" * 80 + "\n\n")
 
         return {"success": True, "user": user}
 
     except HTTPException:
-        logger.error("Authentication failed with HTTPException")
+        auth_logger.error("Authentication failed with HTTPException")
         raise
     except Exception as e:
-        logger.error(f"Unexpected error in auth: {str(e)}", exc_info=True)
+        auth_logger.error(f"Unexpected error in auth: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
 # --------------------------------------------------
 # Обновление токена (refresh)
 # --------------------------------------------------
-@app.get("/auth/refresh/")
-async def refresh_token(request: Request, response: Response, db: Session = Depends(get_db)):
+def _refresh_tokens(request: Request, response: Response, db: Session) -> models.User:
     """
-    Обновление access token, используя refresh token из cookies.
+    Выдаёт новую пару токенов по refresh-токену из cookie (с ротацией, см. sessions).
+    При ошибке удаляет cookies и пробрасывает HTTPException.
     """
     try:
-        logger.info("=== Starting Token Refresh ===")
-
-        refresh_token = request.cookies.get("refresh_token")
-        if not refresh_token:
-            logger.error("No refresh token in cookies")
-            raise HTTPException(status_code=401, detail="No refresh token")
-
-        try:
-            payload = jwt.decode(refresh_token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-
-            if payload.get("type") != "refresh":
-                logger.error("Invalid token type in refresh token")
-                raise HTTPException(status_code=401, detail="Invalid token type")
-
-            user_id = payload.get("sub")
-            if not user_id:
-                logger.error("No user ID in refresh token")
-                raise HTTPException(status_code=401, detail="Invalid token")
-
-            user = db.query(models.User).filter(models.User.id == int(user_id)).first()
-            if not user:
-                logger.error(f"User with ID {user_id} not found")
-                raise HTTPException(status_code=404, detail="User not found")
-
-            access_token_data = {
-                "sub": str(user.id),
-                "telegram_id": str(user.telegram_id),
-                "username": user.username,
-                "type": "access",
-            }
-            new_access_token = create_access_token(access_token_data)
-
-            refresh_token_data = {
-                "sub": str(user.id),
-                "telegram_id": str(user.telegram_id),
-                "username": user.username,
-                "type": "refresh",
-                "exp": datetime.utcnow() + timedelta(days=7),
-            }
-            new_refresh_token = create_access_token(refresh_token_data)
-
-            cookie_options = {"httponly": True, "secure": True, "samesite": "none", "path": "/"}
-
-            response.set_cookie(
-                key="access_token",
-                value=new_access_token,
-                max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-                **cookie_options,
-            )
-
-            response.set_cookie(
-                key="refresh_token", value=new_refresh_token, max_age=60 * 60 * 24 * 7, **cookie_options
-            )
-
-            logger.info(f"Tokens refreshed for user {user.username}")
-
-            return {"success": True, "user": user}
-
-        except ExpiredSignatureError:
-            logger.error("Refresh token expired")
-            raise HTTPException(status_code=401, detail="Refresh token expired")
-        except InvalidTokenError as e:
-            logger.error(f"Invalid refresh token: {str(e)}")
-            raise HTTPException(status_code=401, detail="Invalid refresh token")
-
+        payload = verify_refresh_token(request)
+        user = sessions.rotate(db, payload, response)
     except HTTPException:
         response.delete_cookie(key="access_token")
         response.delete_cookie(key="refresh_token")
         raise
-    except Exception as e:
-        logger.error(f"Error refreshing token: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Internal server error")
+
+    auth_logger.info("Tokens refreshed for user %s", user.username)
+    return user
+
+
+@app.get("/auth/refresh/")
+def refresh_token(request: Request, response: Response, db: Session = Depends(get_db)):
+    """
+    Обновление access token, используя refresh token из cookies.
+    """
+    auth_logger.info("=== Starting Token Refresh ===")
+    user = _refresh_tokens(request, response, db)
+    return {"success": True, "user": user}
 
 
 # --------------------------------------------------
 # Защищённый маршрут, проверка access/refresh токена
 # --------------------------------------------------
 @app.get("/auth/protected/")
-async def protected_route(
+def protected_route(
     request: Request,
     response: Response,
     db: Session = Depends(get_db),
-    token_data: dict = Depends(get_current_user),
+    token_data: Optional[dict] = Depends(get_optional_user),
 ):
     """
     Пример защищённого маршрута.
-    Проверяет access token; если он истёк, пытается использовать refresh token.
+    Проверяет access token; если он истёк или отсутствует, пытается использовать refresh token.
     """
-    try:
-        access_token = request.cookies.get("access_token")
-        refresh_token = request.cookies.get("refresh_token")
-
-        if not access_token and not refresh_token:
-            logger.error("No tokens in cookies")
-            raise HTTPException(status_code=401, detail="Authentication required")
-
-        # Сначала проверяем access token
-        if access_token:
-            try:
-                payload = jwt.decode(access_token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-                # Если токен валиден, отдаем подтверждение
-                return {"authenticated": True}
-            except ExpiredSignatureError:
-                logger.info("Access token expired, trying refresh token")
-            except InvalidTokenError as e:
-                logger.error(f"JWT error in access token: {str(e)}")
-
-        # Если access невалиден или отсутствует, проверяем refresh
-        if refresh_token:
-            try:
-                payload = jwt.decode(refresh_token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-
-                if payload.get("type") != "refresh":
-                    logger.error("Invalid token type in refresh token")
-                    raise HTTPException(status_code=401, detail="Invalid token type")
-
-                user_id = payload.get("sub")
-                if not user_id:
-                    logger.error("No user ID in refresh token")
-                    raise HTTPException(status_code=401, detail="Invalid token")
-
-                user = db.query(models.User).filter(models.User.id == int(user_id)).first()
-                if not user:
-                    logger.error(f"User with ID {user_id} not found")
-                    raise HTTPException(status_code=404, detail="User not found")
-
-                access_token_data = {
-                    "sub": str(user.id),
-                    "telegram_id": str(user.telegram_id),
-                    "username": user.username,
-                    "type": "access",
-                }
-                new_access_token = create_access_token(access_token_data)
-
-                refresh_token_data = {
-                    "sub": str(user.id),
-                    "telegram_id": str(user.telegram_id),
-                    "username": user.username,
-                    "type": "refresh",
-                    "exp": datetime.utcnow() + timedelta(days=7),
-                }
-                new_refresh_token = create_access_token(refresh_token_data)
-
-                cookie_options = {"httponly": True, "secure": True, "samesite": "none", "path": "/"}
-
-                response.set_cookie(
-                    key="access_token",
-                    value=new_access_token,
-                    max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-                    **cookie_options,
-                )
-
-                response.set_cookie(
-                    key="refresh_token", value=new_refresh_token, max_age=60 * 60 * 24 * 7, **cookie_options
-                )
+    if token_data is not None:
+        return {"authenticated": True}
 
-                logger.info(f"Tokens refreshed for user {user.username}")
-                return {"authenticated": True, "refreshed": True, "user": user}
-
-            except ExpiredSignatureError:
-                logger.error("Refresh token expired")
-                response.delete_cookie(key="access_token")
-                response.delete_cookie(key="refresh_token")
-                raise HTTPException(status_code=401, detail="Refresh token expired")
-            except InvalidTokenError as e:
-                logger.error(f"JWT error in refresh token: {str(e)}")
-                response.delete_cookie(key="access_token")
-                response.delete_cookie(key="refresh_token")
-                raise HTTPException(status_code=401, detail="Invalid refresh token")
-
-        # Если оба невалидны
+    if "refresh_token" not in request.cookies:
+        auth_logger.error("No valid access token and no refresh token")
         raise HTTPException(status_code=401, detail="Authentication required")
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error in protected route: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Internal server error")
+    auth_logger.info("Access token missing or invalid, trying refresh token")
+    user = _refresh_tokens(request, response, db)
+    return {"authenticated": True, "refreshed": True, "user": user}
 
 
 # --------------------------------------------------
 # Logout: удаляем куки
 # --------------------------------------------------
 @app.post("/auth/logout/")
-async def logout(response: Response):
+def logout(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    token_data: Optional[dict] = Depends(get_optional_user),
+):
     """
-    Logout пользователя: очищаем access_token и refresh_token в cookies.
+    Logout пользователя: отзываем сессию (refresh-токены и access-токены этого входа)
+    и очищаем access_token и refresh_token в cookies.
     """
+    family_id = (token_data or {}).get("sid")
+    if family_id is None and "refresh_token" in request.cookies:
+        try:
+            family_id = verify_refresh_token(request).get("sid")
+        except HTTPException:
+            pass
+    if family_id:
+        sessions.revoke_family(db, family_id)
     response.delete_cookie(key="access_token")
     response.delete_cookie(key="refresh_token")
     return {"success": True, "message": "Logged out successfully"}
@@ -0,0 +1,187 @@
+"""
+Метрики Prometheus для GET /metrics.
+
+HTTP — по шаблону роута (/listings/{listing_id}/), а не по конкретному пути, чтобы число
+серий не росло вместе с id. БД — ожидание и удержание соединения из пула, число запросов
+к БД на HTTP-запрос, попадания в кэш скомпилированных SQL. Плюс задержка event loop.
+
+Несколько воркеров (uvicorn --workers, gunicorn): задайте PROMETHEUS_MULTIPROC_DIR —
+пустой каталог, общий для воркеров и очищаемый при рестарте. Тогда каждый процесс пишет
+значения в свои файлы, а /metrics любого воркера отдаёт сумму по всем.
+"""
+import asyncio
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CacheStats
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .querystats import track_queries
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+EVENT_LOOP_LAG_INTERVAL = 0.5
+UNMATCHED_ROUTE = "__unmatched__"
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests by route template, method and status",
+    ["method", "route", "status"],
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests currently being processed",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+DB_POOL_HOLD = Histogram(
+    "db_pool_connection_hold_seconds",
+    "Time a connection stays checked out of the pool",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+DB_POOL_IN_USE = Gauge(
+    "db_pool_connections_in_use",
+    "Connections currently checked out of the pool",
+    multiprocess_mode="livesum",
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request",
+    "SQL statements executed while serving one HTTP request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total",
+    "Cache lookups by cache name and result (hit/miss)",
+    ["cache", "result"],
+)
+REQUESTS_REJECTED = Counter(
+    "http_requests_rejected_total",
+    "Requests turned away before the handler: rate limit (429) or DB admission (503)",
+    ["route", "reason"],
+)
+REQUESTS_COALESCED = Counter(
+    "http_requests_coalesced_total",
+    "Requests answered with the response of an identical in-flight request",
+    ["route"],
+)
+DB_IN_FLIGHT = Gauge(
+    "db_admission_in_flight",
+    "Requests currently admitted to DB work",
+    multiprocess_mode="livesum",
+)
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Delay between a scheduled wake-up of the event loop and the actual one",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def _route_label(scope: Scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        with track_queries() as stats:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                duration = time.perf_counter() - start
+                HTTP_IN_FLIGHT.dec()
+                route = _route_label(scope)
+                HTTP_REQUESTS.labels(method=scope["method"], route=route, status=str(status_code)).inc()
+                HTTP_REQUEST_DURATION.labels(method=scope["method"], route=route).observe(duration)
+                DB_QUERIES_PER_REQUEST.labels(route=route).observe(stats.count)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """
+    Слушатели пула и кэша SQL; ожидание в пуле меряет database.TimedQueuePool,
+    число запросов — querystats.
+    """
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+        DB_POOL_IN_USE.inc()
+
+    @event.listens_for(engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            DB_POOL_IN_USE.dec()
+            DB_POOL_HOLD.observe(time.perf_counter() - checked_out_at)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _on_execute(conn, cursor, statement, parameters, context, executemany):
+        cache_hit = getattr(context, "cache_hit", None)
+        if cache_hit in (CacheStats.CACHE_HIT, CacheStats.CACHE_MISS):
+            record_cache_lookup("sql_compiled", cache_hit == CacheStats.CACHE_HIT)
+
+
+async def monitor_event_loop_lag(interval: float = EVENT_LOOP_LAG_INTERVAL) -> None:
+    """Фоновая задача: насколько позже запланированного просыпается sleep(interval)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - expected, 0.0))
+
+
+def render_metrics() -> bytes:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid: int) -> None:
+    """Для gunicorn child_exit: убирает live-gauge завершившегося воркера."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
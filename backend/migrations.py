@@ -0,0 +1,183 @@
+"""
+Миграции схемы (alembic) из кода: один раз на развёртывание, под блокировкой.
+
+    python -m backend.migrations            # upgrade head
+    python -m backend.migrations current    # текущая и целевая ревизии
+
+Вся схема — одна цепочка в alembic/versions. Ревизии идемпотентны (создают только то, чего нет),
+поэтому база, созданная раньше через create_all или старыми скриптами update_*.py, доводится
+до head тем же upgrade. Воркеры при старте тоже вызывают upgrade (см. main.init_database);
+AUTO_MIGRATE=0 это отключает — тогда миграции запускаются отдельно.
+
+Несколько одновременно стартующих процессов (воркеры, реплики) не гоняют миграции наперегонки:
+в PostgreSQL — pg_advisory_lock на соединении, которым идёт миграция (общая для всех хостов),
+в SQLite — flock на файле рядом с базой. Кто получил блокировку вторым, видит уже актуальную
+ревизию и ничего не делает.
+
+Переносы данных в больших таблицах — run_in_batches: порции по MIGRATION_BATCH_SIZE строк,
+каждая в своей транзакции, с прогрессом в логе; прерванная миграция продолжает с оставшихся строк.
+"""
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Iterator, Optional
+
+import sqlalchemy as sa
+from alembic import command, op
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy.engine import Connection
+
+from .database import engine
+
+try:
+    import fcntl
+except ImportError:  # Windows: локальная разработка, один процесс
+    fcntl = None
+
+BASE_DIR = Path(__file__).parent
+ALEMBIC_INI = BASE_DIR / "alembic.ini"
+# Произвольная константа: ключ advisory lock миграций в PostgreSQL
+MIGRATION_LOCK_ID = 720_145_118
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "1") == "1"
+MIGRATION_BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", 5000))
+# Пауза между порциями, чтобы не вытеснять рабочую нагрузку
+MIGRATION_BATCH_PAUSE = float(os.environ.get("MIGRATION_BATCH_PAUSE", 0))
+
+logger = logging.getLogger(__name__)
+
+
+def alembic_config(connection: Optional[Connection] = None) -> Config:
+    config = Config(str(ALEMBIC_INI))
+    config.set_main_option("script_location", str(BASE_DIR / "alembic"))
+    if connection is not None:
+        config.attributes["connection"] = connection
+    return config
+
+
+def head_revision() -> Optional[str]:
+    return ScriptDirectory.from_config(alembic_config()).get_current_head()
+
+
+def current_revision(connection: Connection) -> Optional[str]:
+    return MigrationContext.configure(connection).get_current_revision()
+
+
+def _lock_path(connection: Connection) -> Path:
+    database = connection.engine.url.database
+    if database and database != ":memory:":
+        return Path(database).with_name(Path(database).name + ".migrate.lock")
+    return BASE_DIR / ".migrate.lock"
+
+
+@contextmanager
+def migration_lock(connection: Connection) -> Iterator[None]:
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+        connection.commit()
+        try:
+            yield
+        finally:
+            connection.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+            connection.commit()
+        return
+
+    if fcntl is None:
+        yield
+        return
+    with open(_lock_path(connection), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def upgrade(connection: Connection) -> Optional[str]:
+    """Доводит схему до head; блокировку (migration_lock) держит вызывающий."""
+    head = head_revision()
+    current = current_revision(connection)
+    if current == head:
+        logger.info("Database schema is up to date (%s)", current)
+        return current
+    logger.info("Migrating database schema %s -> %s", current, head)
+    # Транзакциями ревизий управляет alembic (см. run_in_batches), а не открытая здесь неявно
+    connection.commit()
+    command.upgrade(alembic_config(connection), "head")
+    connection.commit()
+    current = current_revision(connection)
+    logger.info("Database schema migrated to %s", current)
+    return current
+
+
+def upgrade_to_head() -> Optional[str]:
+    """upgrade под блокировкой; возвращает итоговую ревизию."""
+    with engine.connect() as connection, migration_lock(connection):
+        return upgrade(connection)
+
+
+# ---------------------------------------------------------------------------
+# Помощники для ревизий (вызываются внутри upgrade()/downgrade() ревизии)
+# ---------------------------------------------------------------------------
+def has_table(table: str) -> bool:
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def has_column(table: str, column: str) -> bool:
+    return has_table(table) and column in {c["name"] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def has_index(table: str, index: str) -> bool:
+    return has_table(table) and index in {i["name"] for i in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def run_in_batches(description: str, pending_count_sql: str, batch_sql: str, batch_size: int = 0) -> int:
+    """
+    Повторяет batch_sql (UPDATE/INSERT, ограниченный LIMIT :limit по ещё не обработанным строкам),
+    пока он что-то меняет. Каждая порция коммитится отдельно, так что блокировки короткие,
+    а при повторном запуске обрабатывается только остаток.
+    """
+    batch_size = batch_size or MIGRATION_BATCH_SIZE
+    context = op.get_context()
+    bind = op.get_bind()
+    total = bind.execute(sa.text(pending_count_sql)).scalar() or 0
+    if not total:
+        return 0
+    done = 0
+    started = time.monotonic()
+    logger.info("%s: %d rows to process in batches of %d", description, total, batch_size)
+    # Транзакционный DDL (PostgreSQL): порции — вне транзакции ревизии, в autocommit.
+    # Без него (SQLite) alembic транзакцию не открывает, и порции коммитятся явно.
+    transactional = context.impl.transactional_ddl
+    with context.autocommit_block() if transactional else nullcontext():
+        while True:
+            changed = bind.execute(sa.text(batch_sql), {"limit": batch_size}).rowcount
+            if not transactional:
+                bind.commit()
+            if not changed:
+                break
+            done += changed
+            logger.info(
+                "%s: %d/%d (%.0f%%) in %.1fs",
+                description,
+                done,
+                total,
+                100 * min(done, total) / total,
+                time.monotonic() - started,
+            )
+            if MIGRATION_BATCH_PAUSE:
+                time.sleep(MIGRATION_BATCH_PAUSE)
+    return done
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if len(sys.argv) > 1 and sys.argv[1] == "current":
+        with engine.connect() as conn:
+            print(f"current: {current_revision(conn)}\nhead:    {head_revision()}")
+    else:
+        upgrade_to_head()
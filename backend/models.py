@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Enum, BigInteger
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Enum, BigInteger, Index
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, column_property
 from .database import Base
 import enum
 
@@ -27,6 +27,7 @@ class User(Base):
     balance = Column(Float, default=5.0)
     earned_hours = Column(Float, default=0.0)
     spent_hours = Column(Float, default=0.0)
+    completed_deals = Column(Integer, default=0, server_default="0", nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Listings where user is the creator
@@ -62,7 +63,8 @@ class Listing(Base):
     title = Column(String, index=True)
     description = Column(String)
     hours = Column(Float)
-    status = Column(String, default="active")
+    # active_history: старый статус нужен счётчикам даже после промежуточного commit (объект expired)
+    status = column_property(Column(String, default="active"), active_history=True)
     listing_type = Column(String)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     prepayment_transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
@@ -83,4 +85,58 @@ class Transaction(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     from_user = relationship("User", foreign_keys=[from_user_id], back_populates="transactions_sent")
-    to_user = relationship("User", foreign_keys=[to_user_id], back_populates="transactions_received") 
\ No newline at end of file
+    to_user = relationship("User", foreign_keys=[to_user_id], back_populates="transactions_received")
+
+
+class Change(Base):
+    """Журнал изменений для дельта-синхронизации (/sync/).
+
+    На каждую строку хранится только последнее изменение: повторное изменение той же
+    (table_name, row_id) обновляет запись на месте (INSERT ... ON CONFLICT DO UPDATE, см. sync)
+    и выдаёт ей новый seq, больше всех выданных. user_id/other_user_id — кому видно
+    изменение (NULL — видно всем).
+    """
+    __tablename__ = "changes"
+    __table_args__ = (
+        Index("ix_changes_table_row", "table_name", "row_id", unique=True),
+        {"sqlite_autoincrement": True},
+    )
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)  # upsert, delete
+    user_id = Column(Integer, nullable=True, index=True)
+    other_user_id = Column(Integer, nullable=True, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class Counter(Base):
+    """Счётчики для /stats/, которые поддерживаются при записи, а не считаются COUNT(*).
+
+    Каждый счётчик разбит на шарды, чтобы параллельные транзакции не упирались в одну строку;
+    значение — сумма по шардам.
+    """
+    __tablename__ = "counters"
+
+    name = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    value = Column(Float, nullable=False, default=0.0)
+
+
+class RefreshSession(Base):
+    """Refresh-токен на сервере: одна строка на выданный токен.
+
+    Токены одного входа образуют семейство (family_id): при обновлении старая строка
+    помечается used_at, а в семействе появляется новая. Повторное предъявление
+    использованного токена — признак кражи, и семейство отзывается целиком (revoked_at).
+    """
+    __tablename__ = "refresh_sessions"
+
+    jti = Column(String, primary_key=True)
+    family_id = Column(String, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime, nullable=False)
+    used_at = Column(DateTime, nullable=True)
+    revoked_at = Column(DateTime, nullable=True, index=True)
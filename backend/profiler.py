@@ -0,0 +1,255 @@
+"""
+Профилирование по запросу, без передеплоя.
+
+Включается переменной PROFILER_SECRET; без неё ничего не устанавливается — ни
+middleware, ни фоновых потоков, а эндпоинты /admin/profiles/ отвечают 404.
+
+Два режима, оба — статистический сэмплер стеков всех потоков процесса (sys._current_frames):
+  * один запрос: заголовок X-Profile: <expires>.<hmac_sha256(PROFILER_SECRET, expires)>
+    (значение печатает `python -m backend.profiler sign [seconds]`);
+  * все воркеры на N секунд: POST /admin/profiles/?seconds=N пишет logs/profiles/sampling.json,
+    который каждый воркер проверяет раз в секунду.
+
+/admin/profiles/ требуют ту же подпись в заголовке X-Profiler-Signature (не только вход).
+
+Результат — файлы формата speedscope (https://www.speedscope.app) в logs/profiles/,
+по профилю на поток.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .logging_setup import LOG_DIR, request_id_var
+
+PROFILER_SECRET = os.environ.get("PROFILER_SECRET", "")
+PROFILER_ENABLED = bool(PROFILER_SECRET)
+PROFILE_DIR = LOG_DIR / "profiles"
+TRIGGER_FILE = PROFILE_DIR / "sampling.json"
+PROFILE_HEADER = "x-profile"
+REQUEST_SAMPLE_INTERVAL = 0.001
+GLOBAL_SAMPLE_INTERVAL = 0.005
+MAX_GLOBAL_SECONDS = 120
+TRIGGER_POLL_INTERVAL = 1.0
+MAX_STACK_DEPTH = 128
+
+logger = logging.getLogger(__name__)
+
+
+class StackSampler:
+    """Фоновый поток, снимающий стеки остальных потоков каждые interval секунд."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.frames: List[dict] = []
+        self._frame_ids: Dict[Tuple[str, str, int], int] = {}
+        # поток -> (стеки, веса)
+        self.samples: Dict[int, Tuple[List[List[int]], List[float]]] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+
+    def start(self) -> "StackSampler":
+        self.started_at = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.stopped_at = time.perf_counter()
+
+    def _frame_id(self, code) -> int:
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        frame_id = self._frame_ids.get(key)
+        if frame_id is None:
+            frame_id = self._frame_ids[key] = len(self.frames)
+            self.frames.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+        return frame_id
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            weight, last = now - last, now
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(self._frame_id(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                stacks, weights = self.samples.setdefault(thread_id, ([], []))
+                stacks.append(stack)
+                weights.append(weight)
+
+    def to_speedscope(self, name: str) -> dict:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        duration = self.stopped_at - self.started_at
+        profiles = [
+            {
+                "type": "sampled",
+                "name": f"{thread_names.get(thread_id, 'thread')} ({thread_id})",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": duration,
+                "samples": stacks,
+                "weights": weights,
+            }
+            for thread_id, (stacks, weights) in self.samples.items()
+        ]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "time-banking-api",
+            "activeProfileIndex": 0,
+            "shared": {"frames": self.frames},
+            "profiles": profiles,
+        }
+
+    def save(self, filename: str, name: str) -> Path:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / filename
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.to_speedscope(name)), encoding="utf-8")
+        os.replace(tmp_path, path)
+        return path
+
+
+def sign(expires: int) -> str:
+    digest = hmac.new(PROFILER_SECRET.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{digest}"
+
+
+def verify_signature(value: str) -> bool:
+    expires, _, digest = value.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(sign(int(expires)), value)
+
+
+def _safe_name(value: str) -> str:
+    return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in value).strip("_")[:80]
+
+
+class ProfilerMiddleware:
+    """Профилирует запрос целиком, если в нём есть действительная подпись X-Profile."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        signature = Headers(scope=scope).get(PROFILE_HEADER)
+        if not signature or not verify_signature(signature):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = request_id_var.get() or str(time.time_ns())
+        filename = f"request-{time.strftime('%Y%m%d-%H%M%S')}-{_safe_name(request_id)}.speedscope.json"
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Profile-File", filename)
+            await send(message)
+
+        sampler = StackSampler(REQUEST_SAMPLE_INTERVAL).start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            route = getattr(scope.get("route"), "path", scope["path"])
+            path = sampler.save(filename, f"{scope['method']} {route}")
+            logger.info("Request profile written to %s", path)
+
+
+# ---------------------------------------------------------------------------
+# Сэмплирование всех воркеров
+# ---------------------------------------------------------------------------
+def request_global_sampling(seconds: int) -> dict:
+    """Просит все воркеры (каждый проверяет TRIGGER_FILE) сэмплировать seconds секунд."""
+    trigger = {"id": time.strftime("%Y%m%d-%H%M%S"), "until": time.time() + seconds}
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = TRIGGER_FILE.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(trigger), encoding="utf-8")
+    os.replace(tmp_path, TRIGGER_FILE)
+    return trigger
+
+
+def _watch_trigger(stop: threading.Event) -> None:
+    seen = None
+    while not stop.wait(TRIGGER_POLL_INTERVAL):
+        try:
+            trigger = json.loads(TRIGGER_FILE.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        remaining = trigger.get("until", 0) - time.time()
+        if trigger.get("id") == seen or remaining <= 0:
+            continue
+        seen = trigger["id"]
+        sampler = StackSampler(GLOBAL_SAMPLE_INTERVAL).start()
+        stop.wait(remaining)
+        sampler.stop()
+        path = sampler.save(f"sampling-{seen}-{os.getpid()}.speedscope.json", f"worker {os.getpid()}")
+        logger.info("Sampling profile written to %s", path)
+
+
+_watcher_stop: Optional[threading.Event] = None
+
+
+def start_trigger_watcher() -> None:
+    global _watcher_stop
+    if not PROFILER_ENABLED or _watcher_stop is not None:
+        return
+    _watcher_stop = threading.Event()
+    threading.Thread(target=_watch_trigger, args=(_watcher_stop,), name="profiler-trigger", daemon=True).start()
+
+
+def stop_trigger_watcher() -> None:
+    global _watcher_stop
+    if _watcher_stop is not None:
+        _watcher_stop.set()
+        _watcher_stop = None
+
+
+def list_profiles() -> List[dict]:
+    if not PROFILE_DIR.exists():
+        return []
+    files = sorted(PROFILE_DIR.glob("*.speedscope.json"), key=lambda path: path.stat().st_mtime, reverse=True)
+    return [
+        {
+            "name": path.name,
+            "size": path.stat().st_size,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(path.stat().st_mtime)),
+        }
+        for path in files
+    ]
+
+
+def profile_path(name: str) -> Optional[Path]:
+    if not name.endswith(".speedscope.json") or "/" in name or "\\" in name or name.startswith("."):
+        return None
+    path = PROFILE_DIR / name
+    return path if path.is_file() else None
+
+
+if __name__ == "__main__":
+    # python -m backend.profiler sign [seconds] — значение заголовков X-Profile и X-Profiler-Signature
+    if len(sys.argv) >= 2 and sys.argv[1] == "sign" and PROFILER_ENABLED:
+        print(sign(int(time.time()) + int(sys.argv[2] if len(sys.argv) > 2 else 300)))
+    else:
+        print("usage: PROFILER_SECRET=... python -m backend.profiler sign [seconds]")
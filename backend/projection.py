@@ -0,0 +1,106 @@
+"""
+Проекция полей (fields=) и режимы встраивания профилей (embed=) для списковых эндпоинтов.
+
+embed=inline  — как раньше: профили пользователей вложены в каждый элемент;
+embed=ids     — только внешние ключи (user_id, worker_id, ...), без профилей;
+embed=sidecar — {"items": [...], "users": {id: профиль}}: каждый профиль один раз.
+
+В БД выбираются только запрошенные колонки, а профили догружаются одним IN-запросом.
+"""
+from typing import Dict, List, Optional, Type
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+
+EMBED_MODES = ("ids", "inline", "sidecar")
+
+# Связь -> внешний ключ на users для каждой модели
+LISTING_RELATIONS = {"creator": "user_id", "worker": "worker_id"}
+TRANSACTION_RELATIONS = {"from_user": "from_user_id", "to_user": "to_user_id"}
+FRIEND_RELATIONS = {"user": "user_id", "friend": "friend_id"}
+
+
+class Projection:
+    def __init__(self, model, ref_schema: Type[BaseModel], relations: Dict[str, str], fields: List[str], embed: str):
+        self.model = model
+        self.ref_schema = ref_schema
+        self.relations = relations
+        self.fields = fields
+        self.embed = embed
+
+    @classmethod
+    def from_params(
+        cls,
+        model,
+        ref_schema: Type[BaseModel],
+        relations: Dict[str, str],
+        fields: Optional[str],
+        embed: str,
+    ) -> Optional["Projection"]:
+        """
+        Разбирает параметры запроса. Возвращает None, если клиент ничего не
+        просил (fields не задан, embed=inline) — тогда эндпоинт идёт старым путём.
+        """
+        if embed not in EMBED_MODES:
+            raise HTTPException(status_code=400, detail=f"Invalid embed mode. Available: {', '.join(EMBED_MODES)}")
+        if fields is None and embed == "inline":
+            return None
+
+        allowed = list(ref_schema.model_fields)
+        if fields is None:
+            selected = allowed
+        else:
+            requested = [f.strip() for f in fields.split(",") if f.strip()]
+            unknown = [f for f in requested if f not in allowed]
+            if unknown:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Unknown fields: {', '.join(unknown)}. Available fields: {', '.join(allowed)}",
+                )
+            # id и внешние ключи на пользователей нужны всегда, иначе не на что ссылаться
+            selected = ["id"] + [f for f in requested if f != "id"]
+            for fk in relations.values():
+                if fk not in selected:
+                    selected.append(fk)
+
+        return cls(model, ref_schema, relations, selected, embed)
+
+    @property
+    def columns(self):
+        return [getattr(self.model, name) for name in self.fields]
+
+    def query(self, db: Session):
+        """Запрос, выбирающий только нужные колонки (без joinedload профилей)."""
+        return db.query(*self.columns)
+
+    def _load_users(self, db: Session, items: List[dict]) -> Dict[int, dict]:
+        user_ids = {item[fk] for item in items for fk in self.relations.values() if item.get(fk) is not None}
+        if not user_ids:
+            return {}
+        profile_fields = list(schemas.UserProfile.model_fields)
+        rows = (
+            db.query(*[getattr(models.User, name) for name in profile_fields])
+            .filter(models.User.id.in_(user_ids))
+            .all()
+        )
+        return {row.id: row._asdict() for row in rows}
+
+    def render(self, db: Session, rows) -> JSONResponse:
+        items = [row._asdict() for row in rows]
+
+        if self.embed == "ids":
+            return JSONResponse(content=jsonable_encoder(items))
+
+        users = self._load_users(db, items)
+        if self.embed == "sidecar":
+            return JSONResponse(content=jsonable_encoder({"items": items, "users": users}))
+
+        for item in items:
+            for relation, fk in self.relations.items():
+                item[relation] = users.get(item[fk]) if item[fk] is not None else None
+        return JSONResponse(content=jsonable_encoder(items))
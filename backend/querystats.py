@@ -0,0 +1,168 @@
+"""
+Учёт SQL-запросов в пределах HTTP-запроса и поиск N+1.
+
+Слушатели движка считают выполненные выражения, их суммарное время и «формы» —
+текст SQL с параметрами, где IN (?, ?, ?) свёрнут в IN (?...). Если одна форма
+повторилась SQL_N_PLUS_ONE_THRESHOLD раз или всего запросов больше SQL_QUERY_LOG_THRESHOLD,
+в backend.sql пишется предупреждение с самыми частыми формами.
+
+В разработке (или при SQL_STATS_HEADER=1) ответ несёт X-DB-Queries и X-DB-Time-Ms —
+по ним живые тесты проверяют бюджет запросов эндпоинта. Для тестов в одном процессе
+есть query_budget().
+"""
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import IS_DEVELOPMENT
+
+SQL_QUERY_LOG_THRESHOLD = int(os.environ.get("SQL_QUERY_LOG_THRESHOLD", 20))
+SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get("SQL_N_PLUS_ONE_THRESHOLD", 5))
+SQL_STATS_HEADER = os.environ.get("SQL_STATS_HEADER", "1" if IS_DEVELOPMENT else "0") == "1"
+TOP_OFFENDERS = 3
+
+sql_logger = logging.getLogger("backend.sql")
+
+_IN_LIST = re.compile(r"\(\s*(\?|%s|%\(\w+\)s)(\s*,\s*(\?|%s|%\(\w+\)s))+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    return _IN_LIST.sub("(?...)", _WHITESPACE.sub(" ", statement).strip())
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes: Counter = Counter()
+        self.shape_time: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, statement: str, elapsed: float) -> None:
+        shape = statement_shape(statement)
+        with self._lock:
+            self.count += 1
+            self.total_time += elapsed
+            self.shapes[shape] += 1
+            self.shape_time[shape] += elapsed
+
+    def top(self, n: int = TOP_OFFENDERS) -> List[Tuple[str, int, float]]:
+        return [(shape, count, self.shape_time[shape]) for shape, count in self.shapes.most_common(n)]
+
+    def repeated(self) -> List[Tuple[str, int, float]]:
+        return [item for item in self.top() if item[1] >= SQL_N_PLUS_ONE_THRESHOLD]
+
+
+# Статистика текущего HTTP-запроса. Синхронные обработчики работают в threadpool с копией
+# контекста, поэтому в переменной лежит изменяемый объект, общий для всех потоков запроса.
+current_query_stats: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar(
+    "current_query_stats", default=None
+)
+
+# Активные query_budget(): считают всё, что выполняется в процессе, из любого потока
+_budgets: List[QueryStats] = []
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """
+    Открывает учёт для запроса. Вложенный вызов (несколько middleware) получает тот же
+    объект, поэтому порядок middleware не важен.
+    """
+    stats = current_query_stats.get()
+    if stats is not None:
+        yield stats
+        return
+    stats = QueryStats()
+    token = current_query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        current_query_stats.reset(token)
+
+
+def report_queries(stats: QueryStats, method: str, route: str) -> None:
+    repeated = stats.repeated()
+    if not repeated and stats.count <= SQL_QUERY_LOG_THRESHOLD:
+        return
+    top = repeated or stats.top()
+    sql_logger.warning(
+        "%s %s ran %d SQL statements in %.1fms%s; top: %s",
+        method,
+        route,
+        stats.count,
+        stats.total_time * 1000,
+        " (possible N+1)" if repeated else "",
+        "; ".join(f"{count}x {elapsed * 1000:.1f}ms {shape}" for shape, count, elapsed in top),
+        extra={
+            "route": route,
+            "queries": stats.count,
+            "sql_ms": round(stats.total_time * 1000, 2),
+            "top_statements": [
+                {"statement": shape, "count": count, "ms": round(elapsed * 1000, 2)} for shape, count, elapsed in top
+            ],
+        },
+    )
+
+
+def stats_headers(stats: QueryStats) -> List[Tuple[str, str]]:
+    if not SQL_STATS_HEADER:
+        return []
+    return [
+        ("X-DB-Queries", str(stats.count)),
+        ("X-DB-Time-Ms", f"{stats.total_time * 1000:.1f}"),
+    ]
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(max_queries: int) -> Iterator[QueryStats]:
+    """
+    Для тестов в одном процессе (TestClient):
+
+        with query_budget(5):
+            client.get("/me/dashboard/", headers=headers)
+    """
+    stats = QueryStats()
+    _budgets.append(stats)
+    try:
+        yield stats
+    finally:
+        _budgets.remove(stats)
+    if stats.count > max_queries:
+        details = "\n".join(f"  {count}x {shape}" for shape, count, _ in stats.top(10))
+        raise QueryBudgetExceeded(f"{stats.count} SQL statements, budget is {max_queries}:\n{details}")
+
+
+def instrument_engine(engine: Engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        stats = current_query_stats.get()
+        if stats is not None:
+            stats.add(statement, elapsed)
+        for budget in _budgets:
+            budget.add(statement, elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(exception_context):
+        started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+        if started:
+            started.pop()
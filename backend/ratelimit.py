@@ -0,0 +1,249 @@
+"""
+Ограничение частоты запросов и допуск к работе с БД.
+
+Частота — token bucket на (шаблон роута, субъект). Субъект — пользователь из access-токена,
+а без входа (и для правил by="ip") — IP клиента. Правила по умолчанию в RATE_LIMITS,
+переопределяются RATE_LIMIT_RULES="/auth/telegram/=60/60:ip,/users/search/=30/60,*=600/60"
+(limit/period_seconds, :ip — только по IP; "*" — все остальные роуты; limit 0 — без ограничения).
+Превышение — 429 с Retry-After. Включено вне разработки; RATE_LIMIT_ENABLED=1/0 — явно.
+
+Хранилище корзин — RATE_LIMIT_BACKEND: memory (по умолчанию, своё в каждом воркере, то есть
+при N воркерах фактический лимит до N раз выше) или redis://host:6379/0 — общее для всех
+воркеров и серверов (нужен пакет redis; при недоступности Redis запросы пропускаются).
+
+Допуск к БД: одновременно работать с БД могут не больше DB_MAX_IN_FLIGHT запросов
+(по умолчанию — размер пула плюс overflow). Остальные ждут до DB_ADMISSION_TIMEOUT секунд
+и получают 503 с Retry-After, вместо того чтобы копиться в очереди пула.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.engine import Engine
+
+from .auth import authenticate
+from .config import IS_DEVELOPMENT
+from .metrics import DB_IN_FLIGHT, REQUESTS_REJECTED
+
+try:
+    import redis
+except ImportError:  # redis нужен только для RATE_LIMIT_BACKEND=redis://...
+    redis = None
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "0" if IS_DEVELOPMENT else "1") == "1"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_RULES = os.environ.get("RATE_LIMIT_RULES", "")
+MEMORY_BACKEND_MAX_KEYS = 100_000
+DB_MAX_IN_FLIGHT = int(os.environ.get("DB_MAX_IN_FLIGHT", 0))
+DB_ADMISSION_TIMEOUT = float(os.environ.get("DB_ADMISSION_TIMEOUT", 2.0))
+DB_RETRY_AFTER = 1
+
+logger = logging.getLogger(__name__)
+
+
+class Rule(NamedTuple):
+    limit: int
+    period: float
+    by: str = "user"  # user — пользователь, а без входа IP; ip — всегда IP
+
+    @property
+    def rate(self) -> float:
+        return self.limit / self.period
+
+
+DEFAULT_ROUTE = "*"
+RATE_LIMITS: Dict[str, Rule] = {
+    "/auth/telegram/": Rule(60, 60, by="ip"),
+    "/auth/refresh/": Rule(30, 60, by="ip"),
+    "/users/search/": Rule(30, 60),
+    DEFAULT_ROUTE: Rule(600, 60),
+}
+EXEMPT_ROUTES = {"/metrics", "/healthz", "/readyz"}
+
+
+def parse_rules(spec: str) -> Dict[str, Rule]:
+    rules = {}
+    for part in spec.split(","):
+        if "=" not in part:
+            continue
+        route, value = part.rsplit("=", 1)
+        value, _, by = value.partition(":")
+        limit, _, period = value.partition("/")
+        rules[route.strip()] = Rule(int(limit), float(period or 60), by.strip() or "user")
+    return rules
+
+
+# ---------------------------------------------------------------------------
+# Хранилища корзин
+# ---------------------------------------------------------------------------
+class MemoryBackend:
+    """Корзины в памяти процесса; самые давно не использованные вытесняются."""
+
+    blocking = False
+
+    def __init__(self, max_keys: int = MEMORY_BACKEND_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, capacity: int) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+_REDIS_TAKE = """
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[1])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisBackend:
+    """Корзины в Redis (или совместимом сервере); атомарность — Lua-скрипт."""
+
+    blocking = True
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis://... requires the redis package")
+        self._client = redis.Redis.from_url(url, socket_timeout=0.1, socket_connect_timeout=0.1)
+        self._take = self._client.register_script(_REDIS_TAKE)
+
+    def take(self, key: str, rate: float, capacity: int) -> Tuple[bool, float]:
+        try:
+            allowed, tokens = self._take(keys=[key], args=[rate, capacity, time.time()])
+        except redis.RedisError as e:
+            logger.warning("Rate limit backend unavailable, letting request through: %s", e)
+            return True, 0.0
+        if allowed:
+            return True, 0.0
+        return False, (1 - float(tokens)) / rate
+
+
+def _make_backend(spec: str):
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(spec)
+    return MemoryBackend()
+
+
+_backend = None
+rules = {**RATE_LIMITS, **parse_rules(RATE_LIMIT_RULES)}
+
+
+def get_backend():
+    """Хранилище создаётся при первом запросе, а не при импорте."""
+    global _backend
+    if _backend is None:
+        _backend = _make_backend(RATE_LIMIT_BACKEND)
+    return _backend
+
+
+def _subject(request: Request, rule: Rule) -> str:
+    if rule.by == "user":
+        claims = authenticate(request)
+        if claims is not None:
+            return f"u:{claims.get('sub')}"
+    return f"ip:{request.client.host if request.client else '-'}"
+
+
+async def enforce(request: Request) -> None:
+    """
+    Зависимость уровня приложения: 429, если корзина субъекта на этом роуте пуста.
+    Запрос списывается один раз: склеенный (singleflight) вызывает enforce до ожидания лидера
+    и, если выполняется сам, второй раз не платит.
+    """
+    if not RATE_LIMIT_ENABLED or getattr(request.state, "rate_limit_charged", False):
+        return
+    route = getattr(request.scope.get("route"), "path", request.url.path)
+    if route in EXEMPT_ROUTES:
+        return
+    rule = rules.get(route) or rules.get(DEFAULT_ROUTE)
+    if rule is None or rule.limit <= 0:
+        return
+
+    key = f"rl:{route}:{_subject(request, rule)}"
+    backend = get_backend()
+    if backend.blocking:
+        allowed, retry_after = await run_in_threadpool(backend.take, key, rule.rate, rule.limit)
+    else:
+        allowed, retry_after = backend.take(key, rule.rate, rule.limit)
+    request.state.rate_limit_charged = True
+    if not allowed:
+        REQUESTS_REJECTED.labels(route=route, reason="rate_limit").inc()
+        logger.warning("Rate limit exceeded: %s", key)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+# ---------------------------------------------------------------------------
+# Допуск к БД
+# ---------------------------------------------------------------------------
+class DBAdmission:
+    def __init__(self):
+        self.capacity = 0
+        self._semaphore: Optional[threading.BoundedSemaphore] = None
+
+    def configure(self, engine: Engine) -> None:
+        """По умолчанию — сколько соединений может выдать пул: size + max_overflow."""
+        capacity = DB_MAX_IN_FLIGHT
+        if capacity <= 0:
+            pool = engine.pool
+            capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0) if hasattr(pool, "size") else 0
+        self.capacity = capacity
+        self._semaphore = threading.BoundedSemaphore(capacity) if capacity > 0 else None
+
+    @contextmanager
+    def admit(self, route: str = "") -> Iterator[None]:
+        """Блокирующий вход (вызывается из потоков threadpool); 503, если места нет за таймаут."""
+        semaphore = self._semaphore
+        if semaphore is None:
+            yield
+            return
+        if not semaphore.acquire(timeout=DB_ADMISSION_TIMEOUT):
+            REQUESTS_REJECTED.labels(route=route, reason="db_overload").inc()
+            logger.warning("DB admission rejected %s: %d requests already in flight", route, self.capacity)
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, try again later",
+                headers={"Retry-After": str(DB_RETRY_AFTER)},
+            )
+        DB_IN_FLIGHT.inc()
+        try:
+            yield
+        finally:
+            DB_IN_FLIGHT.dec()
+            semaphore.release()
+
+
+db_admission = DBAdmission()
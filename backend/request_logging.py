@@ -0,0 +1,99 @@
+"""
+ASGI-middleware журнала запросов.
+
+Одна запись на запрос: метод, шаблон пути (/listings/{listing_id}/, а не конкретный id),
+статус, размер ответа и длительность по монотонным часам. Тело запроса не читается,
+ответ не буферизуется — middleware только подсматривает сообщения http.response.*.
+id запроса берётся из заголовка X-Request-ID (если прислал прокси) или генерируется,
+кладётся в request_id_var и возвращается клиенту тем же заголовком.
+Запросы дольше SLOW_REQUEST_MS дополнительно попадают в slow.log (см. slowlog).
+"""
+import logging
+import secrets
+import time
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .logging_setup import request_id_var
+from .querystats import report_queries, stats_headers, track_queries
+from .slowlog import report_request, track_request
+
+REQUEST_ID_HEADER = "x-request-id"
+MAX_REQUEST_ID_LENGTH = 128
+
+request_logger = logging.getLogger("backend.requests")
+
+
+def route_template(scope: Scope) -> str:
+    """Шаблон пути сматченного роута; для несматченных запросов (404, static) — сам путь."""
+    route = scope.get("route")
+    return getattr(route, "path", None) or scope.get("path", "")
+
+
+class RequestLoggingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = Headers(scope=scope).get(REQUEST_ID_HEADER, "")[:MAX_REQUEST_ID_LENGTH] or secrets.token_hex(8)
+        token = request_id_var.set(request_id)
+        status_code = 500
+        response_bytes = 0
+        start = time.perf_counter()
+
+        with track_queries() as stats, track_request() as timings:
+
+            async def send_wrapper(message: Message) -> None:
+                nonlocal status_code, response_bytes
+                if message["type"] == "http.response.start":
+                    status_code = message["status"]
+                    timings.response_start = time.perf_counter()
+                    headers = MutableHeaders(scope=message)
+                    headers.append("X-Request-ID", request_id)
+                    # SQL, выполненный до начала ответа (у потоковых ответов — не весь)
+                    for name, value in stats_headers(stats):
+                        headers.append(name, value)
+                elif message["type"] == "http.response.body":
+                    response_bytes += len(message.get("body", b""))
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            except Exception:
+                request_logger.exception(
+                    "%s %s failed after %.1fms",
+                    scope["method"],
+                    route_template(scope),
+                    (time.perf_counter() - start) * 1000,
+                )
+                raise
+            else:
+                duration_ms = (time.perf_counter() - start) * 1000
+                route = route_template(scope)
+                request_logger.info(
+                    "%s %s %s %dB %.1fms %dq",
+                    scope["method"],
+                    route,
+                    status_code,
+                    response_bytes,
+                    duration_ms,
+                    stats.count,
+                    extra={
+                        "method": scope["method"],
+                        "route": route,
+                        "status": status_code,
+                        "bytes": response_bytes,
+                        "duration_ms": round(duration_ms, 2),
+                        "queries": stats.count,
+                        "sql_ms": round(stats.total_time * 1000, 2),
+                    },
+                )
+                report_queries(stats, scope["method"], route)
+                report_request(scope, route, status_code, duration_ms / 1000, start, stats, timings)
+            finally:
+                request_id_var.reset(token)
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 class UserBase(BaseModel):
     username: str
@@ -12,6 +12,7 @@ class UserProfile(UserBase):
     id: int
     telegram_id: int
     avatar: Optional[str] = None
+    completed_deals: int = 0
     created_at: datetime
 
     class Config:
@@ -26,13 +27,18 @@ class ListingBase(BaseModel):
 class ListingCreate(ListingBase):
     user_id: int
 
-class Listing(ListingBase):
+class ListingRef(ListingBase):
     id: int
     user_id: int
     worker_id: Optional[int] = None
     status: str
     created_at: datetime
     prepayment_transaction_id: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
+class Listing(ListingRef):
     creator: Optional[UserProfile] = None
     worker: Optional[UserProfile] = None
 
@@ -48,12 +54,17 @@ class TransactionCreate(TransactionBase):
     to_user_id: int
     transaction_type: str = "payment"
 
-class Transaction(TransactionBase):
+class TransactionRef(TransactionBase):
     id: int
     from_user_id: int
     to_user_id: int
     transaction_type: str
     created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class Transaction(TransactionRef):
     from_user: Optional[UserProfile] = None
     to_user: Optional[UserProfile] = None
 
@@ -66,15 +77,67 @@ class FriendBase(BaseModel):
 class FriendCreate(FriendBase):
     pass
 
-class Friend(FriendBase):
+class FriendRef(FriendBase):
     id: int
     user_id: int
     status: str
     created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class Friend(FriendRef):
     user: Optional[UserProfile] = None
     friend: Optional[UserProfile] = None
 
     class Config:
         from_attributes = True
 
+class Dashboard(BaseModel):
+    """Всё, что нужно профилю за один запрос: списки ссылаются на users по id."""
+    user: UserProfile
+    users: Dict[int, UserProfile]
+    friends: List[FriendRef]
+    pending_requests: List[FriendRef]
+    listings: List[ListingRef]
+    partner_ids: List[int]
+
+class SyncChanges(BaseModel):
+    listings: List[ListingRef] = []
+    transactions: List[TransactionRef] = []
+    friends: List[FriendRef] = []
+    users: List[UserProfile] = []
+
+class SyncResponse(BaseModel):
+    seq: int
+    has_more: bool
+    changes: SyncChanges
+    deleted: Dict[str, List[int]]
+
+class ListingAction(BaseModel):
+    listing_id: int
+    action: str  # apply, accept, reject, pay, complete, confirm, cancel
+
+class ListingBatchRequest(BaseModel):
+    actions: List[ListingAction]
+    atomic: bool = False
+
+class ListingActionResult(BaseModel):
+    listing_id: int
+    action: str
+    ok: bool
+    status_code: int
+    detail: Optional[str] = None
+    listing: Optional[ListingRef] = None
+
+class ListingCounts(BaseModel):
+    request: int = 0
+    offer: int = 0
+
+class Stats(BaseModel):
+    listings: Dict[str, ListingCounts]
+    completed_deals: int
+    hours_exchanged: float
+    users: int
+
 Listing.model_rebuild() 
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""
+Запуск в продакшене: миграции, затем gunicorn с воркерами uvicorn.
+
+    python -m backend.serve [--bind 0.0.0.0:8000] [--workers N] [--no-migrate]
+
+* Миграции (backend.migrations) — один раз в мастере, под блокировкой, до старта воркеров;
+  ошибка миграции останавливает запуск.
+* Приложение импортируется в мастере (preload), воркеры форкаются от готового процесса;
+  lifespan (БД, фоновые задачи) выполняется в каждом воркере.
+* Воркеров — WEB_CONCURRENCY, по умолчанию по числу доступных процессору ядер. uvloop и httptools
+  используются, если установлены (uvicorn[standard]).
+* Готовность — GET /readyz (503, пока воркер не прошёл старт и когда он останавливается), а не sleep.
+* Сигналы мастеру: HUP — плавный перезапуск воркеров, TERM — плавная остановка: воркер сначала
+  DRAIN_SECONDS (по умолчанию 5) отвечает 503 на /readyz и продолжает обслуживать запросы, чтобы
+  балансировщик успел его вывести, затем дожидается текущих запросов (до GRACEFUL_TIMEOUT, 30 с).
+  Новый код без простоя — USR2 (новый мастер), затем QUIT старому.
+
+Без gunicorn (Windows) — uvicorn --workers: без preload и плавного перезапуска.
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import shutil
+import signal
+import sys
+
+from .logging_setup import LOG_DIR
+
+try:
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.arbiter import Arbiter
+    from uvicorn.main import Server
+    from uvicorn.workers import UvicornWorker
+except ImportError:  # gunicorn есть только на Unix
+    BaseApplication = None
+
+BIND = os.environ.get("BIND", "0.0.0.0:8000")
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+DRAIN_SECONDS = float(os.environ.get("DRAIN_SECONDS", 5))
+WORKER_TIMEOUT = int(os.environ.get("WORKER_TIMEOUT", 60))
+KEEPALIVE = int(os.environ.get("KEEPALIVE", 5))
+
+logger = logging.getLogger("backend.serve")
+
+
+def default_workers() -> int:
+    if os.environ.get("WEB_CONCURRENCY"):
+        return int(os.environ["WEB_CONCURRENCY"])
+    # Учитывает ограничение по CPU (taskset, cgroups cpuset), в отличие от os.cpu_count()
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def prepare_metrics_dir(workers: int) -> None:
+    """Метрики нескольких воркеров суммируются через PROMETHEUS_MULTIPROC_DIR (см. metrics).
+    Задаётся до импорта prometheus_client и очищается при каждом запуске."""
+    if workers < 2 and not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return
+    path = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", str(LOG_DIR / "prometheus"))
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+if BaseApplication is not None:
+
+    class DrainingServer(Server):
+        """Первый SIGTERM: /readyz отвечает 503, а остановка начинается через DRAIN_SECONDS."""
+
+        draining = False
+
+        def handle_exit(self, sig, frame) -> None:
+            if sig == signal.SIGTERM and DRAIN_SECONDS > 0 and not self.draining:
+                from .main import app
+
+                self.draining = True
+                app.state.ready = False
+                logger.info("Draining worker %s for %.0fs", os.getpid(), DRAIN_SECONDS)
+                asyncio.get_running_loop().call_later(DRAIN_SECONDS, super().handle_exit, sig, frame)
+                return
+            super().handle_exit(sig, frame)
+
+    class Worker(UvicornWorker):
+        """
+        UvicornWorker с DrainingServer. Публичного способа подменить Server у воркера нет,
+        поэтому переопределён приватный _serve — копия версии из uvicorn 0.24.0 (версия
+        закреплена в requirements.txt; при обновлении uvicorn сверить с uvicorn/workers.py).
+        """
+
+        CONFIG_KWARGS = {"loop": "auto", "http": "auto", "lifespan": "on"}
+
+        async def _serve(self) -> None:
+            self.config.app = self.wsgi
+            server = DrainingServer(config=self.config)
+            self._install_sigquit_handler()
+            await server.serve(sockets=self.sockets)
+            if not server.started:
+                sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+    class Application(BaseApplication):
+        def __init__(self, options: dict):
+            self.options = options
+            super().__init__()
+
+        def load_config(self) -> None:
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from .main import app
+
+            return app
+
+    def post_fork(server, worker) -> None:
+        # Соединения пула не должны переходить из мастера в воркеры
+        from .database import engine
+
+        engine.dispose(close=False)
+
+    def child_exit(server, worker) -> None:
+        from . import metrics
+
+        metrics.mark_process_dead(worker.pid)
+
+    def when_ready(server) -> None:
+        server.log.info("Listening on %s with %d workers", server.cfg.bind, server.cfg.workers)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Time Banking API production server")
+    parser.add_argument("--bind", default=BIND)
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--no-migrate", action="store_true", help="не запускать миграции перед стартом")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    prepare_metrics_dir(args.workers)
+
+    # Воркерам миграции не нужны: либо они уже выполнены здесь, либо их запускают отдельно
+    os.environ["AUTO_MIGRATE"] = "0"
+    if not args.no_migrate:
+        from .migrations import upgrade_to_head
+
+        try:
+            upgrade_to_head()
+        except Exception:
+            logger.exception("Database migration failed, not starting")
+            return 1
+
+    if BaseApplication is None:
+        import uvicorn
+
+        logger.warning("gunicorn is not installed: running uvicorn workers without preload and graceful reload")
+        host, _, port = args.bind.rpartition(":")
+        uvicorn.run("backend.main:app", host=host or "0.0.0.0", port=int(port), workers=args.workers)
+        return 0
+
+    Application(
+        {
+            "bind": args.bind,
+            "workers": args.workers,
+            "worker_class": Worker,
+            "preload_app": True,
+            "graceful_timeout": GRACEFUL_TIMEOUT + math.ceil(DRAIN_SECONDS),
+            "timeout": WORKER_TIMEOUT,
+            "keepalive": KEEPALIVE,
+            "post_fork": post_fork,
+            "child_exit": child_exit,
+            "when_ready": when_ready,
+        }
+    ).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""
+Серверные сессии refresh-токенов.
+
+Каждый выданный refresh-токен — строка refresh_sessions (jti). Токены одного входа образуют
+семейство: /auth/refresh/ помечает предъявленный токен использованным и выдаёт следующий
+в том же семействе. Повторное предъявление уже использованного токена (кроме параллельных
+обновлений в пределах REFRESH_REUSE_GRACE_SECONDS) означает, что токен утёк, — семейство
+отзывается целиком. /auth/logout/ отзывает семейство текущего входа.
+
+Access-токены несут id семейства (sid). Их проверка не ходит в БД: отозванные семейства
+лежат в памяти (auth.revoked_sessions), локальные отзывы попадают туда сразу, а отзывы
+из других воркеров подтягиваются фоновым потоком раз в REVOCATION_REFRESH_SECONDS.
+"""
+import logging
+import os
+import secrets
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, Response
+from sqlalchemy.orm import Session
+
+from . import models
+from .auth import create_access_token, recent_logins, revoked_sessions
+from .config import JWT_ACCESS_TOKEN_EXPIRE_MINUTES
+from .database import SessionLocal
+
+REFRESH_TOKEN_EXPIRE_DAYS = 7
+REFRESH_REUSE_GRACE_SECONDS = float(os.environ.get("REFRESH_REUSE_GRACE_SECONDS", 5))
+REVOCATION_REFRESH_SECONDS = float(os.environ.get("REVOCATION_REFRESH_SECONDS", 30))
+COOKIE_OPTIONS = {"httponly": True, "secure": True, "samesite": "none", "path": "/"}
+
+logger = logging.getLogger("backend.auth.sessions")
+
+
+def issue_tokens(
+    db: Session, response: Response, user: models.User, family_id: Optional[str] = None
+) -> Tuple[str, str, str, str]:
+    """
+    Создаёт сессию (новое семейство, если family_id не задан), коммитит её вместе с уже
+    сделанными в db изменениями и кладёт пару токенов в cookies ответа.
+    Возвращает (access_token, refresh_token, family_id, jti).
+    """
+    jti = secrets.token_hex(16)
+    family_id = family_id or secrets.token_hex(16)
+    expires_at = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    db.add(models.RefreshSession(jti=jti, family_id=family_id, user_id=user.id, expires_at=expires_at))
+    db.commit()
+
+    claims = {
+        "sub": str(user.id),
+        "telegram_id": str(user.telegram_id),
+        "username": user.username,
+        "sid": family_id,
+    }
+    access_token = create_access_token({**claims, "type": "access"})
+    refresh_token = create_access_token({**claims, "type": "refresh", "jti": jti}, expires_at=expires_at)
+    set_token_cookies(response, access_token, refresh_token)
+    return access_token, refresh_token, family_id, jti
+
+
+def is_current(db: Session, jti: str) -> bool:
+    """Refresh-токен ещё не обменян, не отозван и не истёк — кем бы из воркеров это ни было сделано."""
+    return (
+        db.query(models.RefreshSession.jti)
+        .filter(
+            models.RefreshSession.jti == jti,
+            models.RefreshSession.used_at.is_(None),
+            models.RefreshSession.revoked_at.is_(None),
+            models.RefreshSession.expires_at > datetime.utcnow(),
+        )
+        .first()
+        is not None
+    )
+
+
+def set_token_cookies(response: Response, access_token: str, refresh_token: str) -> None:
+    response.set_cookie(
+        key="access_token",
+        value=access_token,
+        max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        **COOKIE_OPTIONS,
+    )
+    response.set_cookie(
+        key="refresh_token", value=refresh_token, max_age=REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60, **COOKIE_OPTIONS
+    )
+
+
+def rotate(db: Session, payload: dict, response: Response) -> models.User:
+    """
+    Обменивает refresh-токен (payload уже проверен auth.verify_refresh_token) на новую пару.
+    Использованный токен можно предъявить только один раз.
+    """
+    jti = payload.get("jti") or ""
+    now = datetime.utcnow()
+    # Условный UPDATE: из параллельных обновлений одним токеном выигрывает ровно одно
+    claimed = (
+        db.query(models.RefreshSession)
+        .filter(
+            models.RefreshSession.jti == jti,
+            models.RefreshSession.used_at.is_(None),
+            models.RefreshSession.revoked_at.is_(None),
+        )
+        .update({"used_at": now}, synchronize_session=False)
+    )
+    session = db.get(models.RefreshSession, jti)
+    if session is None or str(session.user_id) != str(payload.get("sub")):
+        db.rollback()
+        logger.warning("Unknown refresh session %s", jti[:8])
+        raise HTTPException(status_code=401, detail="Unknown refresh session")
+    if not claimed:
+        db.rollback()
+        if session.revoked_at is not None:
+            raise HTTPException(status_code=401, detail="Session revoked")
+        if session.used_at is not None and now - session.used_at <= timedelta(seconds=REFRESH_REUSE_GRACE_SECONDS):
+            # Параллельный запрос того же клиента уже получил новую пару
+            raise HTTPException(status_code=401, detail="Refresh token already used")
+        logger.warning("Refresh token reuse detected for user %s, revoking session family", session.user_id)
+        revoke_family(db, session.family_id)
+        raise HTTPException(status_code=401, detail="Refresh token reuse detected")
+
+    user = db.get(models.User, session.user_id)
+    if user is None:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="User not found")
+    recent_logins.discard_family(session.family_id)
+    issue_tokens(db, response, user, family_id=session.family_id)
+    return user
+
+
+def revoke_family(db: Session, family_id: str) -> None:
+    db.query(models.RefreshSession).filter(
+        models.RefreshSession.family_id == family_id,
+        models.RefreshSession.revoked_at.is_(None),
+    ).update({"revoked_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    revoked_sessions.add(family_id)
+    recent_logins.discard_family(family_id)
+
+
+# ---------------------------------------------------------------------------
+# Список отозванных семейств в памяти
+# ---------------------------------------------------------------------------
+def load_revocations(db: Session) -> int:
+    """
+    Перечитывает отозванные семейства. Старше срока жизни access-токена они не нужны:
+    выданные до отзыва access-токены к этому времени уже истекли.
+    """
+    cutoff = datetime.utcnow() - timedelta(minutes=JWT_ACCESS_TOKEN_EXPIRE_MINUTES)
+    rows = (
+        db.query(models.RefreshSession.family_id)
+        .filter(models.RefreshSession.revoked_at >= cutoff)
+        .distinct()
+        .all()
+    )
+    revoked_sessions.replace((row.family_id for row in rows), max_age=JWT_ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+    return len(rows)
+
+
+def _refresh_revocations(stop: threading.Event) -> None:
+    while not stop.wait(REVOCATION_REFRESH_SECONDS):
+        db = SessionLocal()
+        try:
+            load_revocations(db)
+        except Exception:
+            logger.exception("Failed to reload revoked sessions")
+        finally:
+            db.close()
+
+
+_refresher_stop: Optional[threading.Event] = None
+
+
+def start_revocation_refresher() -> None:
+    global _refresher_stop
+    if _refresher_stop is not None:
+        return
+    db = SessionLocal()
+    try:
+        load_revocations(db)
+    finally:
+        db.close()
+    _refresher_stop = threading.Event()
+    threading.Thread(
+        target=_refresh_revocations, args=(_refresher_stop,), name="revocation-refresher", daemon=True
+    ).start()
+
+
+def stop_revocation_refresher() -> None:
+    global _refresher_stop
+    if _refresher_stop is not None:
+        _refresher_stop.set()
+        _refresher_stop = None
@@ -0,0 +1,189 @@
+"""
+Склейка одинаковых одновременных запросов (singleflight).
+
+Mini App при открытии (несколько вкладок, ретраи) шлёт пачку одинаковых /auth/telegram/,
+/user/me/ и /listings/ в пределах миллисекунд. Для роутов из COALESCED_ROUTES запрос
+с тем же ключом — метод, путь, отсортированная строка запроса, хеш заголовков Authorization
+и Cookie, хеш тела — пока первый такой запрос ещё выполняется, не идёт в обработчик:
+он ждёт ответ первого и получает его копию (статус, заголовки, тело, включая Set-Cookie).
+
+Склеиваются только одновременные запросы и только в пределах воркера. Делится только
+успешный (2xx) ответ: если первый запрос упал, ответил ошибкой (в том числе 429) или его
+ответ оказался больше MAX_SHARED_BODY, ждавшие выполняются сами. Тело больше MAX_KEYED_BODY
+в память не читается: запрос с таким Content-Length (или потоковое тело, переросшее лимит)
+идёт в обработчик без склейки.
+
+Лимит частоты склеенный запрос тратит так же, как выполненный: ratelimit.enforce вызывается
+до ожидания (роуты COALESCED_ROUTES без параметров, так что путь и есть шаблон роута).
+Превысивший лимит получает свой 429, а не копию ответа лидера.
+Выключается REQUEST_COALESCING=0; склеенные запросы считаются в http_requests_coalesced_total.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from fastapi import HTTPException, Request
+from fastapi.exception_handlers import http_exception_handler
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import ratelimit
+from .metrics import REQUESTS_COALESCED
+
+REQUEST_COALESCING = os.environ.get("REQUEST_COALESCING", "1") == "1"
+COALESCED_ROUTES = {
+    ("GET", "/auth/telegram/"),
+    ("POST", "/auth/telegram/"),
+    ("GET", "/user/me/"),
+    ("GET", "/listings/"),
+}
+MAX_KEYED_BODY = 64 * 1024
+MAX_SHARED_BODY = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """Выполняющийся запрос-лидер; done выставляется, когда ответ записан (или не удался)."""
+
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.start: Optional[Message] = None
+        self.body: List[bytes] = []
+        self.size = 0
+        self.complete = False
+        self.route = None
+        self.user_id = None
+
+
+def _request_key(scope: Scope, body: bytes) -> str:
+    headers = Headers(scope=scope)
+    query = urlencode(sorted(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True)))
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (headers.get("authorization", ""), headers.get("cookie", "")):
+        digest.update(part.encode("latin-1"))
+        digest.update(b"\0")
+    digest.update(body)
+    return f"{scope['method']} {scope['path']}?{query} {digest.hexdigest()}"
+
+
+async def _read_body(receive: Receive, limit: int) -> Optional[Tuple[List[Message], bool]]:
+    """
+    Читает тело, пока оно не больше limit: (прочитанные сообщения, прочитано ли целиком).
+    None, если клиент отключился.
+    """
+    messages = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return None
+        messages.append(message)
+        size += len(message.get("body", b""))
+        if not message.get("more_body", False):
+            return messages, True
+        if size > limit:
+            return messages, False
+
+
+class CoalescingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._flights: Dict[str, _Flight] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            not REQUEST_COALESCING
+            or scope["type"] != "http"
+            or (scope["method"], scope["path"]) not in COALESCED_ROUTES
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length is not None and (not content_length.isdigit() or int(content_length) > MAX_KEYED_BODY):
+            await self.app(scope, receive, send)
+            return
+        read = await _read_body(receive, MAX_KEYED_BODY)
+        if read is None:
+            return
+        messages, complete = read
+        body = b"".join(message.get("body", b"") for message in messages)
+        replay = _replay(messages, receive)
+        if not complete or len(body) > MAX_KEYED_BODY:
+            await self.app(scope, replay, send)
+            return
+
+        key = _request_key(scope, body)
+        flight = self._flights.get(key)
+        if flight is not None:
+            request = Request(scope, replay)
+            try:
+                await ratelimit.enforce(request)
+            except HTTPException as exc:
+                response = await http_exception_handler(request, exc)
+                await response(scope, replay, send)
+                return
+            await flight.done.wait()
+            if flight.complete:
+                await self._send_shared(scope, flight, send)
+                return
+            await self.app(scope, replay, send)
+            return
+
+        flight = self._flights[key] = _Flight()
+        try:
+            await self.app(scope, replay, self._recording(flight, send))
+        finally:
+            del self._flights[key]
+            flight.route = scope.get("route")
+            flight.user_id = scope.get("state", {}).get("user_id")
+            flight.done.set()
+
+    @staticmethod
+    def _recording(flight: _Flight, send: Send) -> Send:
+        async def send_wrapper(message: Message) -> None:
+            # Копии снимаются до send: внешние middleware дописывают в message свои заголовки
+            if message["type"] == "http.response.start":
+                # Ошибки (4xx, 5xx) не делятся: ждавшие выполнятся сами
+                if 200 <= message["status"] < 300:
+                    flight.start = {**message, "headers": list(message.get("headers", []))}
+            elif message["type"] == "http.response.body" and flight.start is not None:
+                chunk = message.get("body", b"")
+                flight.size += len(chunk)
+                if flight.size <= MAX_SHARED_BODY:
+                    flight.body.append(chunk)
+                    flight.complete = not message.get("more_body", False)
+                else:
+                    flight.start = None
+            await send(message)
+
+        return send_wrapper
+
+    @staticmethod
+    async def _send_shared(scope: Scope, flight: _Flight, send: Send) -> None:
+        # Для журнала запросов и slow.log — роут и пользователь лидера
+        if flight.route is not None:
+            scope["route"] = flight.route
+        if flight.user_id is not None:
+            scope.setdefault("state", {})["user_id"] = flight.user_id
+        route = getattr(flight.route, "path", scope["path"])
+        REQUESTS_COALESCED.labels(route=route).inc()
+        logger.debug("Coalesced %s %s with an in-flight request", scope["method"], route)
+        await send({**flight.start, "headers": list(flight.start["headers"])})
+        await send({"type": "http.response.body", "body": b"".join(flight.body)})
+
+
+def _replay(messages: List[Message], receive: Receive) -> Receive:
+    """receive, отдающий уже прочитанное тело, а дальше — исходный поток (http.disconnect)."""
+    pending = list(messages)
+
+    async def replay_receive() -> Message:
+        if pending:
+            return pending.pop(0)
+        return await receive()
+
+    return replay_receive
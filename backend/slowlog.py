@@ -0,0 +1,239 @@
+"""
+Журнал медленных запросов и SQL (logs/slow.log).
+
+Запрос дольше SLOW_REQUEST_MS (по умолчанию 500) и SQL-выражение дольше SLOW_QUERY_MS (100)
+пишутся в backend.slow с контекстом: шаблон роута, id пользователя из токена, параметры
+(значения секретов заменены на ***), для запроса — разбивка по фазам (зависимости, обработчик,
+сериализация, SQL), для SQL — план выполнения (EXPLAIN QUERY PLAN в SQLite, EXPLAIN в остальных).
+
+Фазы отмечают обёртки TracedRoute (см. tracing) через record_phase(); медленные выражения
+внутри запроса копятся и пишутся по его завершении, когда известны роут и пользователь.
+"""
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional
+from urllib.parse import parse_qsl
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import Scope
+
+from .querystats import QueryStats
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 500))
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+MAX_PARAM_LENGTH = 200
+MAX_STATEMENT_LENGTH = 2000
+
+slow_logger = logging.getLogger("backend.slow")
+
+_SECRET_NAME = re.compile(r"token|secret|password|hash|init_data|signature|jti", re.IGNORECASE)
+_JWT_VALUE = re.compile(r"^[\w-]+\.[\w-]+\.[\w-]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def redact(name: Optional[str], value: Any) -> Any:
+    if name and _SECRET_NAME.search(name):
+        return "***"
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str):
+        if _JWT_VALUE.match(value) and len(value) > 40:
+            return "***"
+        if len(value) > MAX_PARAM_LENGTH:
+            return value[:MAX_PARAM_LENGTH] + "..."
+    return value
+
+
+class RequestTimings:
+    """Фазы одного запроса. Как и QueryStats, общий объект для всех потоков запроса."""
+
+    def __init__(self):
+        self.phases: Counter = Counter()
+        self.handler_end: Optional[float] = None
+        self.response_start: Optional[float] = None
+        self.slow_queries: List[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, elapsed: float) -> None:
+        with self._lock:
+            self.phases[phase] += elapsed
+
+    def add_query(self, query: dict) -> None:
+        with self._lock:
+            self.slow_queries.append(query)
+
+
+current_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "current_timings", default=None
+)
+
+
+@contextmanager
+def track_request() -> Iterator[RequestTimings]:
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+def record_phase(phase: str, elapsed: float, is_endpoint: bool = False) -> None:
+    timings = current_timings.get()
+    if timings is None:
+        return
+    timings.add(phase, elapsed)
+    if is_endpoint:
+        timings.handler_end = time.perf_counter()
+
+
+def _user_id(scope: Scope) -> Optional[str]:
+    """id пользователя, которого определила auth.authenticate() (request.state.user_id)."""
+    return scope.get("state", {}).get("user_id")
+
+
+def _query_params(scope: Scope) -> dict:
+    query = scope.get("query_string", b"").decode("latin-1")
+    return {name: redact(name, value) for name, value in parse_qsl(query, keep_blank_values=True)}
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def report_request(
+    scope: Scope,
+    route: str,
+    status_code: int,
+    duration: float,
+    started: float,
+    stats: QueryStats,
+    timings: RequestTimings,
+) -> None:
+    """Пишет медленный запрос и накопленные за него медленные SQL-выражения."""
+    slow_request = duration * 1000 >= SLOW_REQUEST_MS
+    if not slow_request and not timings.slow_queries:
+        return
+    user_id = _user_id(scope)
+    method = scope["method"]
+
+    for query in timings.slow_queries:
+        _log_query(query, route=f"{method} {route}", user_id=user_id)
+
+    if not slow_request:
+        return
+    phases = {
+        "dependencies_ms": _ms(timings.phases["dependencies"]),
+        "handler_ms": _ms(timings.phases["handler"]),
+        "serialize_ms": _ms(timings.response_start - timings.handler_end)
+        if timings.handler_end and timings.response_start and timings.response_start > timings.handler_end
+        else 0.0,
+        "sql_ms": _ms(stats.total_time),
+    }
+    if timings.response_start:
+        phases["send_ms"] = _ms(started + duration - timings.response_start)
+    params = _query_params(scope)
+    slow_logger.warning(
+        "slow request %s %s %s %.1fms user=%s queries=%d phases=%s params=%s",
+        method,
+        route,
+        status_code,
+        duration * 1000,
+        user_id,
+        stats.count,
+        " ".join(f"{name[:-3]}={value}ms" for name, value in phases.items()),
+        params,
+        extra={
+            "kind": "request",
+            "method": method,
+            "route": route,
+            "status": status_code,
+            "duration_ms": _ms(duration),
+            "user_id": user_id,
+            "queries": stats.count,
+            "phases": phases,
+            "params": params,
+            "top_statements": [
+                {"statement": shape, "count": count, "ms": _ms(elapsed)} for shape, count, elapsed in stats.top()
+            ],
+        },
+    )
+
+
+def _log_query(query: dict, route: Optional[str], user_id: Optional[str]) -> None:
+    slow_logger.warning(
+        "slow query %.1fms route=%s user=%s %s params=%s plan=%s",
+        query["duration_ms"],
+        route,
+        user_id,
+        query["statement"],
+        query["params"],
+        " | ".join(query["plan"]),
+        extra={"kind": "query", "route": route, "user_id": user_id, **query},
+    )
+
+
+# ---------------------------------------------------------------------------
+# SQL
+# ---------------------------------------------------------------------------
+def _bound_params(context, parameters) -> Any:
+    if isinstance(parameters, dict):
+        return {name: redact(name, value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        names = getattr(getattr(context, "compiled", None), "positiontup", None) or []
+        return [
+            redact(names[i] if i < len(names) else None, value) for i, value in enumerate(parameters)
+        ]
+    return parameters
+
+
+def _explain(engine: Engine, cursor, statement: str, parameters) -> List[str]:
+    if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+        return []
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        rows = explain_cursor.fetchall()
+    except Exception as exc:
+        return [f"EXPLAIN failed: {exc}"]
+    finally:
+        explain_cursor.close()
+    # SQLite: (id, parent, notused, detail); PostgreSQL/MySQL: строки плана
+    return [str(row[-1]) if engine.dialect.name == "sqlite" else " ".join(map(str, row)) for row in rows]
+
+
+def instrument_engine(engine: Engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["slow_started"].pop()
+        if elapsed * 1000 < SLOW_QUERY_MS:
+            return
+        query = {
+            "duration_ms": _ms(elapsed),
+            "statement": _WHITESPACE.sub(" ", statement).strip()[:MAX_STATEMENT_LENGTH],
+            "params": None if executemany else _bound_params(context, parameters),
+            "plan": [] if executemany else _explain(engine, cursor, statement, parameters),
+        }
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add_query(query)
+        else:
+            _log_query(query, route=None, user_id=None)
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(exception_context):
+        started = exception_context.connection.info.get("slow_started") if exception_context.connection else None
+        if started:
+            started.pop()
@@ -0,0 +1,170 @@
+"""
+Дельта-синхронизация: журнал изменений и сборка ответа для GET /sync/.
+
+Каждый flush сессии, затрагивающий listings, transactions, friends или users,
+одним INSERT ... ON CONFLICT DO UPDATE записывает в таблицу changes по строке на изменённую
+запись с новым seq, в той же транзакции.
+Клиент хранит последний полученный seq и запрашивает только то, что изменилось после него.
+
+Курсор (верхняя граница — max(seq) на момент запроса) надёжен в SQLite: запись в базу одна
+на всех, seq становятся видимы в порядке выдачи. В PostgreSQL seq выдаются при вставке,
+а видны после коммита: изменение из транзакции, закоммиченной позже соседней с большим seq,
+может оказаться ниже уже выданного клиенту курсора и не дойти до него через /sync/.
+"""
+from typing import Dict, List
+
+from sqlalchemy import event, func, literal_column, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+from .database import SessionLocal
+
+# Модель -> (таблица, схема ответа, функция «кому видно»)
+TRACKED_MODELS = {
+    models.Listing: ("listings", schemas.ListingRef, lambda obj: (None, None)),
+    models.User: ("users", schemas.UserProfile, lambda obj: (None, None)),
+    models.Transaction: ("transactions", schemas.TransactionRef, lambda obj: (obj.from_user_id, obj.to_user_id)),
+    models.Friend: ("friends", schemas.FriendRef, lambda obj: (obj.user_id, obj.friend_id)),
+}
+TABLE_MODELS = {table: model for model, (table, _, _) in TRACKED_MODELS.items()}
+
+DEFAULT_SYNC_LIMIT = 500
+# Строк в одном INSERT: по 5 параметров на строку, в пределах лимита SQLite (32766)
+RECORD_CHUNK_SIZE = 1000
+
+
+def _record_changes(session: Session, flush_context) -> None:
+    entries = {}
+
+    def track(obj, op):
+        spec = TRACKED_MODELS.get(type(obj))
+        if spec is None or obj.id is None:
+            return
+        table_name, _, audience = spec
+        entries[(table_name, obj.id)] = (op, *audience(obj))
+
+    for obj in session.new:
+        track(obj, "upsert")
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            track(obj, "upsert")
+    for obj in session.deleted:
+        track(obj, "delete")
+
+    if not entries:
+        return
+
+    record_changes(
+        session.connection(),
+        [
+            {"table_name": table_name, "row_id": row_id, "op": op, "user_id": user_id, "other_user_id": other_user_id}
+            for (table_name, row_id), (op, user_id, other_user_id) in entries.items()
+        ],
+    )
+
+
+def _upsert_changes_statement(dialect_name: str, entries: List[dict]):
+    """Новая строка или та же строка (table_name, row_id) с новым seq — последнее изменение."""
+    changes = models.Change.__table__
+    if dialect_name == "postgresql":
+        stmt = postgresql.insert(changes).values(entries)
+        next_seq = func.nextval(func.pg_get_serial_sequence(changes.name, changes.c.seq.name))
+    else:
+        stmt = sqlite.insert(changes).values(entries)
+        # seq больше всех выданных; AUTOINCREMENT дальше продолжит уже после него. Подзапрос
+        # связан с обновляемой строкой (иначе SQLite вычислит его один раз на всю вставку);
+        # SQLAlchemy не коррелирует с таблицей INSERT, поэтому ссылка на неё — literal_column
+        latest = changes.alias("latest")
+        current_seq = literal_column(f"{changes.name}.{changes.c.seq.name}")
+        next_seq = select(func.max(latest.c.seq) + 1).where(latest.c.seq >= current_seq).scalar_subquery()
+    return stmt.on_conflict_do_update(
+        index_elements=[changes.c.table_name, changes.c.row_id],
+        set_={
+            "seq": next_seq,
+            "op": stmt.excluded.op,
+            "user_id": stmt.excluded.user_id,
+            "other_user_id": stmt.excluded.other_user_id,
+            "created_at": func.now(),
+        },
+    )
+
+
+def record_changes(connection, entries: List[dict]) -> None:
+    """Записывает изменения строк одним запросом на RECORD_CHUNK_SIZE строк (ключи — колонки changes без seq)."""
+    for start in range(0, len(entries), RECORD_CHUNK_SIZE):
+        connection.execute(_upsert_changes_statement(connection.dialect.name, entries[start:start + RECORD_CHUNK_SIZE]))
+
+
+def record_change(connection, table_name: str, row_id: int, op: str = "upsert", user_id=None, other_user_id=None) -> None:
+    """Изменение одной строки. Нужна и напрямую — для записей мимо flush (INSERT ... RETURNING)."""
+    record_changes(
+        connection,
+        [{"table_name": table_name, "row_id": row_id, "op": op, "user_id": user_id, "other_user_id": other_user_id}],
+    )
+
+
+event.listen(SessionLocal, "after_flush", _record_changes)
+
+
+def current_seq(db: Session) -> int:
+    return db.query(func.max(models.Change.seq)).scalar() or 0
+
+
+def collect_changes(db: Session, user_id: int, since: int, limit: int = DEFAULT_SYNC_LIMIT) -> schemas.SyncResponse:
+    """
+    Изменения, видимые пользователю, с seq > since. Если их больше limit,
+    возвращается первая порция и has_more=True; клиент повторяет запрос с новым seq.
+    Граница upper без пропусков только в SQLite (см. описание модуля).
+    """
+    # Верхнюю границу фиксируем до выборки, чтобы не пропустить изменения, записанные между запросами
+    upper = current_seq(db)
+    rows = (
+        db.query(models.Change)
+        .filter(models.Change.seq > since, models.Change.seq <= upper)
+        .filter(
+            or_(
+                models.Change.user_id.is_(None),
+                models.Change.user_id == user_id,
+                models.Change.other_user_id == user_id,
+            )
+        )
+        .order_by(models.Change.seq)
+        .limit(limit + 1)
+        .all()
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    upserts: Dict[str, List[int]] = {}
+    deleted: Dict[str, List[int]] = {}
+    for change in rows:
+        target = deleted if change.op == "delete" else upserts
+        target.setdefault(change.table_name, []).append(change.row_id)
+
+    changed = {}
+    for table_name, row_ids in upserts.items():
+        model = TABLE_MODELS[table_name]
+        schema = TRACKED_MODELS[model][1]
+        objects = db.query(model).filter(model.id.in_(row_ids)).all()
+        changed[table_name] = [schema.model_validate(obj) for obj in objects]
+
+    # Без has_more курсор сдвигаем на upper, чтобы не перечитывать невидимые пользователю изменения
+    seq = rows[-1].seq if has_more else max(upper, since)
+
+    return schemas.SyncResponse(
+        seq=seq,
+        has_more=has_more,
+        changes=schemas.SyncChanges(**changed),
+        deleted=deleted,
+    )
+
+
+def cursor_response(db: Session) -> schemas.SyncResponse:
+    """Только текущий seq: с него клиент начинает после первичной загрузки списков."""
+    return schemas.SyncResponse(
+        seq=current_seq(db),
+        has_more=False,
+        changes=schemas.SyncChanges(),
+        deleted={},
+    )
@@ -0,0 +1,403 @@
+"""
+Лёгкая трассировка запросов.
+
+Корневой span открывает TracingMiddleware, дочерние — TracedRoute (обработчик и его
+зависимости: get_current_user и т.п.), слушатели движка (каждый SQL), отдельные участки
+кода через span(...) (проверка hash Telegram, переходы листингов) и TracedJSONResponse
+(сериализация ответа). Вне сэмплированного запроса span() ничего не делает.
+
+Готовый трейс пишется одной строкой в logs/traces.log в формате OTLP/JSON
+(ExportTraceServiceRequest) — через ту же очередь, что и остальные логи. Такой файл
+читает otlpjsonfile receiver OpenTelemetry Collector, оттуда — в Jaeger/Tempo.
+
+Настройки: TRACE_SAMPLE_RATE (доля запросов, по умолчанию 1.0 в разработке и 0.01
+в продакшене), OTEL_SERVICE_NAME. Входящий заголовок traceparent (W3C) продолжает
+трейс вызывающей стороны и её решение о сэмплировании.
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from fastapi.dependencies.models import Dependant
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import IS_DEVELOPMENT
+from .logging_setup import request_id_var
+from .slowlog import record_phase
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0" if IS_DEVELOPMENT else "0.01"))
+SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "time-banking-api")
+MAX_STATEMENT_LENGTH = 2000
+
+# Значения из спецификации OTLP
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+trace_logger = logging.getLogger("backend.traces")
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:
+    __slots__ = (
+        "trace",
+        "span_id",
+        "parent_id",
+        "name",
+        "kind",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "status_code",
+        "status_message",
+    )
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: int, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.status_code = STATUS_UNSET
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_error(self, exc: BaseException) -> None:
+        self.status_code = STATUS_ERROR
+        self.status_message = f"{type(exc).__name__}: {getattr(exc, 'detail', None) or exc}"
+
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": self.status_code},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_error(self, exc: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """Все span'ы одного запроса; дочерние могут создаваться из потоков threadpool."""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        # Открытый span сериализации: начинается по возврату обработчика, закрывается в render()
+        self.serialize_span: Optional[Span] = None
+        self._lock = threading.Lock()
+
+    def start_span(self, name: str, parent: Optional[Span], kind: int = SPAN_KIND_INTERNAL, **attributes) -> Span:
+        span = Span(self, name, parent.span_id if parent else None, kind, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def export(self) -> None:
+        with self._lock:
+            spans = [span.to_otlp() for span in self.spans]
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                    "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+                }
+            ]
+        }
+        trace_logger.info(json.dumps(payload, separators=(",", ":"), default=str))
+
+
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+@contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes) -> Iterator[Any]:
+    parent = current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    child = parent.trace.start_span(name, parent, kind, **attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.set_error(exc)
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+
+def traced(name: str) -> Callable:
+    """Декоратор для синхронных функций: вызов целиком — один span."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _parse_traceparent(value: Optional[str]):
+    """W3C traceparent: 00-<trace_id>-<parent_id>-<flags>. Возвращает (trace_id, parent_id, sampled)."""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+
+def _route_name(scope: Scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or scope.get("path", "")
+
+
+class TracingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        parent = _parse_traceparent(Headers(scope=scope).get("traceparent"))
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id, sampled = secrets.token_hex(16), None, random.random() < TRACE_SAMPLE_RATE
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(trace_id)
+        root = trace.start_span(f"{scope['method']} {scope['path']}", None, SPAN_KIND_SERVER)
+        root.parent_id = parent_id
+        root.set_attribute("http.method", scope["method"])
+        token = current_span.set(root)
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                root.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    root.status_code = STATUS_ERROR
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as exc:
+            root.set_error(exc)
+            raise
+        finally:
+            current_span.reset(token)
+            route = _route_name(scope)
+            root.name = f"{scope['method']} {route}"
+            root.set_attribute("http.route", route)
+            request_id = request_id_var.get()
+            if request_id:
+                root.set_attribute("request_id", request_id)
+            if trace.serialize_span is not None:
+                trace.serialize_span.end()
+            root.end()
+            trace.export()
+
+
+# ---------------------------------------------------------------------------
+# Обработчики и зависимости FastAPI
+# ---------------------------------------------------------------------------
+_traced_calls: Dict[Callable, Callable] = {}
+_traced_wrappers = set()
+# Внутри зависимости: вложенные вызовы уже входят в её время и в фазу второй раз не попадают
+_in_dependency: contextvars.ContextVar[bool] = contextvars.ContextVar("in_dependency", default=False)
+
+
+def _traced_call(call: Callable, name: str, is_endpoint: bool) -> Callable:
+    """
+    Оборачивает функцию обработчика/зависимости в span, сохраняя sync/async. Обёртка
+    одна на функцию — FastAPI кэширует зависимости внутри запроса по самой функции.
+    Время вызова уходит в фазы запроса для slow.log; у зависимостей — только внешних,
+    чтобы вложенная не считалась дважды (в своём времени и во времени внешней).
+    """
+    if call in _traced_wrappers:
+        return call
+    key = (call, is_endpoint)
+    if key in _traced_calls:
+        return _traced_calls[key]
+    phase = "handler" if is_endpoint else "dependencies"
+
+    def enter():
+        if is_endpoint:
+            return True, None
+        return not _in_dependency.get(), _in_dependency.set(True)
+
+    def leave(outermost, token, elapsed):
+        if token is not None:
+            _in_dependency.reset(token)
+        if outermost:
+            record_phase(phase, elapsed, is_endpoint)
+
+    def open_serialize():
+        parent = current_span.get()
+        if is_endpoint and parent is not None:
+            parent.trace.serialize_span = parent.trace.start_span("serialize", parent)
+
+    if asyncio.iscoroutinefunction(call):
+
+        @functools.wraps(call)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outermost, token = enter()
+            try:
+                with span(name):
+                    result = await call(*args, **kwargs)
+            finally:
+                leave(outermost, token, time.perf_counter() - start)
+            open_serialize()
+            return result
+
+    else:
+
+        @functools.wraps(call)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outermost, token = enter()
+            try:
+                with span(name):
+                    result = call(*args, **kwargs)
+            finally:
+                leave(outermost, token, time.perf_counter() - start)
+            open_serialize()
+            return result
+
+    _traced_calls[key] = wrapper
+    _traced_wrappers.add(wrapper)
+    return wrapper
+
+
+def _trace_dependencies(dependant: Dependant) -> None:
+    for sub in dependant.dependencies:
+        _trace_dependencies(sub)
+        call = sub.call
+        # Генераторы (get_db) FastAPI открывает и закрывает в разных потоках — их не оборачиваем
+        if call is None or inspect.isgeneratorfunction(call) or inspect.isasyncgenfunction(call):
+            continue
+        if not inspect.isfunction(call):
+            continue
+        sub.call = _traced_call(call, f"depends {call.__name__}", is_endpoint=False)
+
+
+class TracedRoute(APIRoute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _trace_dependencies(self.dependant)
+        if inspect.isfunction(self.dependant.call):
+            self.dependant.call = _traced_call(self.dependant.call, f"handler {self.name}", is_endpoint=True)
+
+
+class TracedJSONResponse(JSONResponse):
+    """JSONResponse, закрывающий span сериализации после кодирования тела."""
+
+    def render(self, content: Any) -> bytes:
+        body = super().render(content)
+        parent = current_span.get()
+        if parent is not None and parent.trace.serialize_span is not None:
+            parent.trace.serialize_span.set_attribute("http.response_bytes", len(body))
+            parent.trace.serialize_span.end()
+            parent.trace.serialize_span = None
+        return body
+
+
+# ---------------------------------------------------------------------------
+# SQL
+# ---------------------------------------------------------------------------
+def instrument_engine(engine: Engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = current_span.get()
+        if parent is None:
+            return
+        sql_span = parent.trace.start_span(
+            f"SQL {statement.split(None, 1)[0].upper() if statement else ''}",
+            parent,
+            SPAN_KIND_CLIENT,
+            **{"db.system": engine.dialect.name, "db.statement": statement[:MAX_STATEMENT_LENGTH]},
+        )
+        conn.info.setdefault("trace_spans", []).append(sql_span)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_span.get() is not None and conn.info.get("trace_spans"):
+            conn.info["trace_spans"].pop().end()
+
+    @event.listens_for(engine, "handle_error")
+    def _on_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and current_span.get() is not None and connection.info.get("trace_spans"):
+            sql_span = connection.info["trace_spans"].pop()
+            sql_span.set_error(exception_context.original_exception)
+            sql_span.end()
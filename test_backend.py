@@ -0,0 +1,409 @@
+"""
+Тесты бэкенда без запущенного сервера: приложение в процессе (TestClient), своя база во временной папке.
+
+    python -m pytest test_backend.py      # или python test_backend.py
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sys
+import tempfile
+import time
+import unittest
+import urllib.parse
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+TMP_DIR = tempfile.mkdtemp(prefix="time_banking_test_")
+os.environ["DATABASE_URL"] = f"sqlite:///{TMP_DIR}/time_banking.db"
+os.environ["LOG_DIR"] = f"{TMP_DIR}/logs"
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+from fastapi import Request  # noqa: E402
+from fastapi.responses import PlainTextResponse  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from jose import jwt  # noqa: E402
+
+from backend import logging_setup, logsearch, models, ratelimit, sessions, singleflight, slowlog, tracing  # noqa: E402
+from backend.config import BOT_TOKEN  # noqa: E402
+from backend.database import SessionLocal  # noqa: E402
+from backend.main import app  # noqa: E402
+from backend.querystats import query_budget  # noqa: E402
+
+
+def signed_init_data(telegram_id: int, username: str) -> str:
+    """init_data Telegram WebApp с настоящей подписью (ключ — HMAC("WebAppData", BOT_TOKEN))."""
+    fields = {
+        "auth_date": str(int(time.time())),
+        "query_id": secrets.token_hex(8),
+        "user": json.dumps({"id": telegram_id, "first_name": "Test", "username": username}),
+    }
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(fields, quote_via=urllib.parse.quote)
+
+
+class ApiTestCase(unittest.TestCase):
+    """Приложение с lifespan и вошедший пользователь (cookies secure, поэтому https)."""
+
+    telegram_id = 700000001
+    username = "api_test_user"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(app, base_url="https://testserver")
+        cls.client.__enter__()
+        response = cls.client.post("/auth/telegram/", json={"init_data": signed_init_data(cls.telegram_id, cls.username)})
+        assert response.status_code == 200, response.text
+        cls.user_id = response.json()["user"]["id"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.__exit__(None, None, None)
+
+    def create_listing(self, title: str) -> dict:
+        response = self.client.post(
+            "/listings/",
+            json={"listing_type": "offer", "title": title, "description": "test", "hours": 1.0, "user_id": self.user_id},
+        )
+        self.assertEqual(response.status_code, 200, response.text)
+        return response.json()
+
+    def login(self, init_data: str) -> str:
+        """Вход по init_data; возвращает выданный refresh-токен."""
+        response = self.client.post("/auth/telegram/", json={"init_data": init_data})
+        self.assertEqual(response.status_code, 200, response.text)
+        return response.cookies["refresh_token"]
+
+
+class TestDashboardSyncStats(ApiTestCase):
+    def test_dashboard_references_resolve(self):
+        self.create_listing("Dashboard offer")
+
+        dashboard = self.client.get("/me/dashboard/").json()
+
+        users = dashboard["users"]
+        self.assertEqual(dashboard["user"]["id"], self.user_id)
+        self.assertIn(str(self.user_id), users)
+        for friend in dashboard["friends"] + dashboard["pending_requests"]:
+            self.assertIn(str(friend["user_id"]), users)
+            self.assertIn(str(friend["friend_id"]), users)
+        for listing in dashboard["listings"]:
+            self.assertIn(str(listing["user_id"]), users)
+        for partner_id in dashboard["partner_ids"]:
+            self.assertIn(str(partner_id), users)
+
+    def test_delta_sync_returns_new_listing(self):
+        seq = self.client.get("/sync/").json()["seq"]
+
+        listing = self.create_listing("Sync offer")
+        delta = self.client.get(f"/sync/?since={seq}").json()
+
+        self.assertGreater(delta["seq"], seq)
+        self.assertIn(listing["id"], [item["id"] for item in delta["changes"]["listings"]])
+
+    def test_delta_sync_returns_changed_listings_again(self):
+        listings = [self.create_listing("Sync batch 1"), self.create_listing("Sync batch 2")]
+        seq = self.client.get("/sync/").json()["seq"]
+
+        response = self.client.post(
+            "/listings/batch/",
+            json={"actions": [{"listing_id": listing["id"], "action": "cancel"} for listing in listings]},
+        )
+        self.assertTrue(all(result["ok"] for result in response.json()), response.text)
+        delta = self.client.get(f"/sync/?since={seq}").json()
+
+        self.assertGreater(delta["seq"], seq)
+        changed = {item["id"]: item["status"] for item in delta["changes"]["listings"]}
+        for listing in listings:
+            self.assertEqual(changed.get(listing["id"]), "cancelled")
+
+    def test_stats_follow_writes(self):
+        before = self.client.get("/stats/").json()
+
+        self.create_listing("Stats offer")
+        after = self.client.get("/stats/").json()
+
+        self.assertEqual(after["listings"]["active"]["offer"], before["listings"]["active"]["offer"] + 1)
+        self.assertEqual(
+            after["completed_deals"],
+            after["listings"]["completed"]["request"] + after["listings"]["completed"]["offer"],
+        )
+        self.assertGreaterEqual(after["users"], 1)
+
+
+class TestLogDir(ApiTestCase):
+    """/admin/logs/ читает файлы из LOG_DIR (в тестах — временная папка, а не logs/ репозитория)."""
+
+    def test_view_logs_reads_log_dir(self):
+        line = "2024-01-01 00:00:00 - backend.slow - WARNING - slow request from LOG_DIR"
+        (logging_setup.LOG_DIR / "slow.log").write_text(line + "\n", encoding="utf-8")
+
+        response = self.client.get("/admin/logs/slow/")
+
+        self.assertEqual(response.status_code, 200, response.text)
+        self.assertEqual(response.json()["status"], "success", response.text)
+        self.assertIn(line, "".join(response.json()["content"]))
+
+
+class TestRepeatedLogin(ApiTestCase):
+    """Повтор init_data отдаёт выданную пару, пока её семейство не сменили в БД (в любом воркере)."""
+
+    def test_repeat_reuses_tokens(self):
+        init_data = signed_init_data(700000101, "repeat_user")
+
+        self.assertEqual(self.login(init_data), self.login(init_data))
+
+    def test_repeat_after_rotation_elsewhere_logs_in_again(self):
+        init_data = signed_init_data(700000102, "rotated_user")
+        refresh_token = self.login(init_data)
+
+        # Обмен в другом воркере: строка в БД помечена, локальный кэш этого воркера не тронут
+        jti = jwt.get_unverified_claims(refresh_token)["jti"]
+        with SessionLocal() as db:
+            db.query(models.RefreshSession).filter(models.RefreshSession.jti == jti).update(
+                {"used_at": datetime.utcnow()}
+            )
+            db.commit()
+
+        self.assertNotEqual(self.login(init_data), refresh_token)
+
+
+class TestRefreshRotation(ApiTestCase):
+    """Refresh-токен живёт REFRESH_TOKEN_EXPIRE_DAYS, одноразовый, повтор вне grace отзывает семейство."""
+
+    def refresh(self, refresh_token: str):
+        # Отдельный клиент без cookie-jar: предъявляется ровно этот токен
+        client = TestClient(app, base_url="https://testserver")
+        return client.get("/auth/refresh/", headers={"Cookie": f"refresh_token={refresh_token}"})
+
+    def test_refresh_token_expiry(self):
+        refresh_token = self.login(signed_init_data(700000201, "refresh_expiry_user"))
+
+        expires_in = jwt.get_unverified_claims(refresh_token)["exp"] - time.time()
+
+        self.assertAlmostEqual(expires_in, sessions.REFRESH_TOKEN_EXPIRE_DAYS * 24 * 60 * 60, delta=60)
+
+    def test_rotation_issues_new_jti(self):
+        old_token = self.login(signed_init_data(700000202, "refresh_rotate_user"))
+
+        response = self.refresh(old_token)
+
+        self.assertEqual(response.status_code, 200, response.text)
+        old_claims = jwt.get_unverified_claims(old_token)
+        new_claims = jwt.get_unverified_claims(response.cookies["refresh_token"])
+        self.assertNotEqual(new_claims["jti"], old_claims["jti"])
+        self.assertEqual(new_claims["sid"], old_claims["sid"])
+        with SessionLocal() as db:
+            self.assertIsNotNone(db.get(models.RefreshSession, old_claims["jti"]).used_at)
+
+    def test_reuse_outside_grace_revokes_family(self):
+        old_token = self.login(signed_init_data(700000203, "refresh_reuse_user"))
+        self.assertEqual(self.refresh(old_token).status_code, 200)
+        claims = jwt.get_unverified_claims(old_token)
+        with SessionLocal() as db:
+            db.query(models.RefreshSession).filter(models.RefreshSession.jti == claims["jti"]).update(
+                {"used_at": datetime.utcnow() - timedelta(seconds=sessions.REFRESH_REUSE_GRACE_SECONDS + 60)}
+            )
+            db.commit()
+
+        response = self.refresh(old_token)
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()["detail"], "Refresh token reuse detected")
+        with SessionLocal() as db:
+            family = db.query(models.RefreshSession).filter(models.RefreshSession.family_id == claims["sid"]).all()
+        self.assertEqual(len(family), 2)
+        self.assertTrue(all(session.revoked_at is not None for session in family))
+
+
+class TestCoalescing(unittest.TestCase):
+    """Склеиваются только успешные ответы; большое тело идёт в обработчик без склейки."""
+
+    def run_concurrently(self, endpoint, method: str, path: str, content: bytes = b""):
+        middleware = singleflight.CoalescingMiddleware(endpoint)
+
+        async def run():
+            transport = httpx.ASGITransport(app=middleware)
+            async with httpx.AsyncClient(transport=transport, base_url="https://testserver") as client:
+                return await asyncio.gather(
+                    client.request(method, path, content=content), client.request(method, path, content=content)
+                )
+
+        return asyncio.run(run())
+
+    def test_success_is_shared(self):
+        calls = []
+
+        async def endpoint(scope, receive, send):
+            calls.append(scope["path"])
+            await asyncio.sleep(0.05)
+            await PlainTextResponse("me")(scope, receive, send)
+
+        responses = self.run_concurrently(endpoint, "GET", "/user/me/")
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([response.text for response in responses], ["me", "me"])
+
+    def test_error_is_not_shared(self):
+        calls = []
+
+        async def endpoint(scope, receive, send):
+            calls.append(scope["path"])
+            await asyncio.sleep(0.05)
+            status_code = 500 if len(calls) == 1 else 200
+            await PlainTextResponse("me", status_code=status_code)(scope, receive, send)
+
+        responses = self.run_concurrently(endpoint, "GET", "/user/me/")
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(response.status_code for response in responses), [200, 500])
+
+    def test_large_body_is_not_coalesced(self):
+        received = []
+
+        async def endpoint(scope, receive, send):
+            received.append(len(await Request(scope, receive).body()))
+            await asyncio.sleep(0.05)
+            await PlainTextResponse("ok")(scope, receive, send)
+
+        content = b"x" * (singleflight.MAX_KEYED_BODY + 1)
+        responses = self.run_concurrently(endpoint, "POST", "/auth/telegram/", content)
+
+        self.assertEqual(received, [len(content), len(content)])
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+
+
+class TestCoalescedRateLimit(unittest.TestCase):
+    """Склеенный запрос тратит лимит частоты, как если бы выполнялся сам."""
+
+    def setUp(self):
+        patchers = [
+            mock.patch.object(ratelimit, "RATE_LIMIT_ENABLED", True),
+            mock.patch.object(ratelimit, "rules", {"/user/me/": ratelimit.Rule(1, 60, "ip")}),
+            mock.patch.object(ratelimit, "_backend", ratelimit.MemoryBackend()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_follower_is_charged(self):
+        calls = []
+
+        async def endpoint(scope, receive, send):
+            await ratelimit.enforce(Request(scope, receive))
+            calls.append(scope["path"])
+            await asyncio.sleep(0.05)
+            await PlainTextResponse("me")(scope, receive, send)
+
+        middleware = singleflight.CoalescingMiddleware(endpoint)
+
+        async def run():
+            transport = httpx.ASGITransport(app=middleware)
+            async with httpx.AsyncClient(transport=transport, base_url="https://testserver") as client:
+                return await asyncio.gather(client.get("/user/me/"), client.get("/user/me/"))
+
+        responses = asyncio.run(run())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(response.status_code for response in responses), [200, 429])
+
+
+class TestDependencyPhase(unittest.TestCase):
+    """Фаза dependencies в slow.log — время внешних зависимостей, вложенные не добавляются."""
+
+    def test_nested_dependency_counted_once(self):
+        def inner():
+            time.sleep(0.05)
+
+        inner_traced = tracing._traced_call(inner, "depends inner", is_endpoint=False)
+
+        def outer():
+            time.sleep(0.05)
+            inner_traced()
+
+        outer_traced = tracing._traced_call(outer, "depends outer", is_endpoint=False)
+
+        with slowlog.track_request() as timings:
+            started = time.perf_counter()
+            outer_traced()
+            elapsed = time.perf_counter() - started
+
+        self.assertLessEqual(timings.phases["dependencies"], elapsed)
+        self.assertIs(tracing._traced_call(outer_traced, "depends outer", is_endpoint=False), outer_traced)
+
+
+class TestQueryBudget(ApiTestCase):
+    """Число SQL-запросов на эндпоинт не зависит от объёма данных."""
+
+    BUDGETS = {
+        "/listings/": 2,
+        "/friends/": 3,
+        "/me/dashboard/": 8,
+        "/stats/": 2,
+    }
+
+    def test_budgets(self):
+        for title in ("Budget offer 1", "Budget offer 2", "Budget offer 3"):
+            self.create_listing(title)
+        for path, budget in self.BUDGETS.items():
+            with self.subTest(path=path), query_budget(budget):
+                self.assertEqual(self.client.get(path).status_code, 200)
+
+
+class TestTraceLogSearch(unittest.TestCase):
+    """Поиск по traces.log: запись — строка OTLP/JSON без времени в начале."""
+
+    def setUp(self):
+        self.log_dir = Path(tempfile.mkdtemp(dir=TMP_DIR))
+        patchers = [
+            mock.patch.object(logsearch, "LOG_DIR", self.log_dir),
+            mock.patch.object(logsearch, "INDEX_DIR", self.log_dir / ".index"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_traces(self, traces):
+        """traces — [(request_id, время начала в секундах)]; строки — как их пишет tracing."""
+        lines = []
+        for request_id, started in traces:
+            trace = tracing.Trace(secrets.token_hex(16))
+            root = trace.start_span("GET /user/me/", None, tracing.SPAN_KIND_SERVER, request_id=request_id)
+            trace.start_span("SELECT users", root, tracing.SPAN_KIND_CLIENT)
+            for span in trace.spans:
+                span.start_ns = started * 1_000_000_000
+                span.end()
+            with self.assertLogs("backend.traces") as captured:
+                trace.export()
+            lines.extend(record.getMessage() for record in captured.records)
+        (self.log_dir / "traces.log").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    def test_search_by_request_id(self):
+        self.write_traces([("req-000001", 1_700_000_000), ("req-000002", 1_700_000_060)])
+
+        results = list(logsearch.search("traces", request_id="req-000002"))
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["request_id"], "req-000002")
+        self.assertIn('"resourceSpans"', results[0]["text"])
+
+    def test_search_since(self):
+        # 1_700_000_000 — 2023-11-14 22:13:20 UTC
+        self.write_traces([("req-000001", 1_700_000_000), ("req-000002", 1_700_000_060)])
+
+        results = list(logsearch.search("traces", since="2023-11-14 22:14:00"))
+
+        self.assertEqual([r["request_id"] for r in results], ["req-000002"])
+        self.assertEqual(results[0]["ts"], "2023-11-14 22:14:20")
+
+
+if __name__ == "__main__":
+    unittest.main()